@@ -1 +1,18 @@
 from .proto_test import *
+from .hybi_test import *
+from .admission_test import *
+from .pollingsession_test import *
+from .statesync_test import *
+from .scheduler_test import *
+from .conn_test import *
+from .registry_test import *
+from .outbound_test import *
+from .eventloop_test import *
+from .testing_test import *
+from .snapshot_test import *
+from .codec_test import *
+from .balance_test import *
+from .fanout_test import *
+from .server_test import *
+from .persistentsession_test import *
+from .flashserver_test import *
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.admission_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import admission, session
+from tornadio.conn import SocketConnection
+from tornadio.router import get_router
+from tornadio.testing import SimulatedLoop
+
+class FakeLoop(object):
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+        return callback
+
+def test_admit():
+    loop = FakeLoop()
+    control = admission.AdmissionControl(loop, 1, burst=2, queue_size=1)
+
+    calls = []
+
+    # Burst is admitted right away
+    assert control.admit(lambda: calls.append(1))
+    assert control.admit(lambda: calls.append(2))
+    eq_(calls, [1, 2])
+
+    # Next one is queued
+    assert control.admit(lambda: calls.append(3))
+    eq_(calls, [1, 2])
+    eq_(control.queued, 1)
+    eq_(len(loop.timeouts), 1)
+
+    # Queue is full
+    assert not control.admit(lambda: calls.append(4))
+    eq_(control.rejected, 1)
+
+    # Queued handshake is admitted once there is capacity
+    control.tokens = 1
+    loop.timeouts.pop()[1]()
+    eq_(calls, [1, 2, 3])
+    eq_(control.queued, 0)
+    eq_(control.admitted, 3)
+
+def test_queue_timeout():
+    loop = SimulatedLoop()
+    control = admission.AdmissionControl(loop, 0.1, burst=1, queue_size=10,
+                                         queue_timeout=8)
+
+    calls = []
+
+    assert control.admit(lambda: calls.append(1))
+    assert control.admit(lambda: calls.append(2),
+                         lambda: calls.append('rejected'))
+
+    # Next token is 10 seconds away, so queued handshake times out first
+    loop.advance(8)
+    eq_(calls, [1, 'rejected'])
+    eq_(control.queued, 0)
+    eq_(control.rejected, 1)
+
+    assert control.admit(lambda: calls.append(3))
+    loop.advance(3)
+    eq_(calls, [1, 'rejected', 3])
+
+class Request(object):
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+class Connection(SocketConnection):
+    def on_message(self, message):
+        pass
+
+def test_is_resume():
+    router = get_router(Connection, io_loop=SimulatedLoop())
+    router._sessions.create(session.Session, session_id='known')
+
+    xhr = router._protocols['xhr-polling']
+    websocket = router._protocols['websocket']
+    eventsource = router._protocols['eventsource']
+
+    def is_resume(protocol, session_id, headers=None):
+        return router(None, Request(headers))._is_resume(protocol,
+                                                         session_id)
+
+    assert is_resume(xhr, 'known')
+    assert not is_resume(xhr, None)
+
+    # Made up session IDs don't bypass admission
+    assert not is_resume(xhr, 'unknown')
+    assert not is_resume(eventsource, None, {'Last-Event-ID': 'fake:1'})
+    assert is_resume(eventsource, None, {'Last-Event-ID': 'known:1'})
+
+    # Websocket ignores session ID unless sessions are resumable
+    assert not is_resume(websocket, 'known')
+    router.settings['websocket_resume'] = True
+    assert is_resume(websocket, 'known')
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.balance_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import balance, registry, scheduler
+from tornadio.conn import SocketConnection
+from tornadio.testing import SimulatedLoop
+
+class Protocol(object):
+    def close(self):
+        pass
+
+class Connection(SocketConnection):
+    def on_message(self, message):
+        pass
+
+def test_connection_count():
+    loop = SimulatedLoop()
+    reg = registry.Registry()
+
+    conns = [Connection(Protocol(), loop, 12) for _ in xrange(3)]
+    for conn in conns:
+        conn.set_registry(reg)
+    eq_(reg.connections, 3)
+
+    conns[0].handle_close()
+    conns[0].handle_close()
+    conns[1].detach()
+    eq_(reg.connections, 1)
+
+def test_load():
+    loop = SimulatedLoop()
+    reg = registry.Registry()
+    sched = scheduler.Scheduler(loop)
+
+    monitor = balance.LoadMonitor(loop, reg, sched,
+                                  max_connections=4, max_lag=1.0)
+    monitor.start()
+
+    reg.connections = 2
+    loop.advance(5)
+    eq_(monitor.load, 0.5)
+    eq_(monitor.overloaded, False)
+
+    # Event loop lag
+    sched.lag = 1.5
+    loop.advance(5)
+    eq_(monitor.load, 1.5)
+    eq_(monitor.overloaded, True)
+
+    report = monitor.report()
+    eq_(report['connections'], 2)
+    eq_(report['lag'], 1.5)
+    eq_(report['overloaded'], True)
+
+def test_late_checks():
+    loop = SimulatedLoop()
+    monitor = balance.LoadMonitor(loop, registry.Registry(),
+                                  scheduler.Scheduler(loop), max_lag=1.0)
+    monitor.start()
+
+    # Loop was blocked, so check runs two seconds late
+    loop.now += 7
+    loop.advance(0)
+    eq_(monitor.lag, 2)
+    eq_(monitor.overloaded, True)
+
+    loop.advance(5)
+    eq_(monitor.overloaded, False)
+
+def test_pick_peer():
+    loop = SimulatedLoop()
+    monitor = balance.LoadMonitor(loop, registry.Registry(),
+                                  scheduler.Scheduler(loop),
+                                  max_connections=10, interval=5)
+    monitor.load = 1.2
+
+    eq_(monitor.pick_peer(), None)
+
+    monitor.update_peer('http://a', 0.8)
+    monitor.update_peer('http://b', 0.3)
+    monitor.update_peer('http://c', 1.5)
+    eq_(monitor.pick_peer(), 'http://b')
+
+    # Unavailable peer
+    monitor.update_peer('http://b', None)
+    eq_(monitor.pick_peer(), 'http://a')
+
+    # Stale reports are not used
+    loop.advance(20)
+    eq_(monitor.pick_peer(), None)
+
+    # Peers which are more loaded than this node are not used
+    monitor.load = 0.5
+    monitor.update_peer('http://a', 0.8)
+    eq_(monitor.pick_peer(), None)
+
+def test_check():
+    loop = SimulatedLoop()
+    reg = registry.Registry()
+    monitor = balance.LoadMonitor(loop, reg, scheduler.Scheduler(loop),
+                                  max_connections=10, recover=0.8)
+    monitor.start()
+
+    # Connection limit is checked between samples
+    reg.connections = 9
+    eq_(monitor.check(), False)
+    reg.connections = 10
+    eq_(monitor.check(), True)
+
+    # Node takes new sessions again once load drops below recovery level
+    reg.connections = 9
+    loop.advance(5)
+    eq_(monitor.check(), True)
+
+    reg.connections = 7
+    loop.advance(5)
+    eq_(monitor.check(), False)
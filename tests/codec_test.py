@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.codec_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import threading
+import decimal
+
+from nose.tools import eq_, raises
+
+from tornado import ioloop, web, httpserver
+
+from tornadio import codec, proto, testing
+from tornadio.conn import SocketConnection
+from tornadio.router import get_router
+
+MSGPACK = codec.CODECS['msgpack']
+
+def test_pack():
+    # Values from the MessagePack specification
+    eq_(codec.pack(None), '\xc0')
+    eq_(codec.pack([True, False]), '\x92\xc3\xc2')
+    eq_(codec.pack(1), '\x01')
+    eq_(codec.pack(-1), '\xff')
+    eq_(codec.pack(200), '\xcc\xc8')
+    eq_(codec.pack(-200), '\xd1\xff\x38')
+    eq_(codec.pack(1.5), '\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00')
+    eq_(codec.pack(u'abc'), '\xa3abc')
+
+    # Byte strings are text, same as with JSON, unless they are not UTF-8
+    eq_(codec.pack('abc'), '\xa3abc')
+    eq_(codec.pack('\xff'), '\xc4\x01\xff')
+    eq_(codec.pack({u'a': 1}), '\x81\xa1a\x01')
+
+    # Decimals are packed as floats, same as with JSON
+    eq_(codec.pack(decimal.Decimal('1.5')), codec.pack(1.5))
+
+def test_unpack():
+    values = [None, True, False, 0, 127, 128, -32, -33, 65536, -65536,
+              2 ** 40, -2 ** 40, 2 ** 64 - 1, 0.25, u'', u'x' * 40,
+              u'ф' * 70000, 'bytes', 'b' * 300, [], range(20),
+              {u'nested': {u'list': [1, [2, {}]]}},
+              dict((i, i) for i in xrange(20))]
+
+    for value in values:
+        eq_(codec.unpack(codec.pack(value)), value)
+
+    # Tuples are packed as arrays
+    eq_(codec.unpack(codec.pack((1, 2))), [1, 2])
+
+@raises(ValueError)
+def test_unpack_truncated():
+    codec.unpack(codec.pack([1, 2, 3])[:-1])
+
+@raises(ValueError)
+def test_unpack_extra():
+    codec.unpack(codec.pack(1) + '\x01')
+
+@raises(ValueError)
+def test_unpack_deep():
+    codec.unpack('\x91' * 100000 + '\xc0')
+
+@raises(ValueError)
+def test_unpack_unhashable():
+    codec.unpack('\x81\x90\x01')
+
+def test_str_values():
+    # Messages with byte strings look same to the client as with JSON
+    eq_(MSGPACK.loads(MSGPACK.dumps({'event': 'x'})), {u'event': u'x'})
+
+def test_negotiate():
+    eq_(codec.negotiate('msgpack', ['msgpack']), MSGPACK)
+    eq_(codec.negotiate('msgpack', []), None)
+    eq_(codec.negotiate('unknown', ['unknown']), None)
+    eq_(codec.negotiate(None, ['msgpack']), None)
+
+def test_proto():
+    message = {'values': [1, 2.5, -3]}
+
+    # Polling transports carry base64-encoded payload
+    data = proto.encode(['text', message], MSGPACK)
+    assert '~j~' not in data
+
+    eq_(proto.decode(data, codec=MSGPACK),
+        [(proto.FRAME, 'text'), (proto.BINARY, {u'values': [1, 2.5, -3]})])
+
+    # Binary websocket frames carry raw payload
+    data = proto.encode(message, MSGPACK, True)
+    eq_(data, '~m~%d~m~~b~%s' % (len(MSGPACK.dumps(message)) + 3,
+                                 MSGPACK.dumps(message)))
+    eq_(proto.decode(data, codec=MSGPACK, binary=True)[0][1], message)
+
+    # Without negotiated codec, message is just a string
+    eq_(proto.decode(proto.encode('~b~abc'))[0][1], '~b~abc')
+
+class Echo(SocketConnection):
+    def on_open(self, *args, **kwargs):
+        self.send(self.codec.name if self.codec else 'json')
+
+    def on_message(self, message):
+        self.send(message)
+
+def test_clients():
+    loop = ioloop.IOLoop()
+
+    router = get_router(Echo, {'payload_codecs': ['msgpack'],
+                               'enabled_protocols': ['websocket',
+                                                     'xhr-polling']},
+                        io_loop=loop)
+
+    server = httpserver.HTTPServer(web.Application([router.route()]),
+                                   io_loop=loop)
+    server.listen(0, '127.0.0.1')
+    port = server._socket.getsockname()[1]
+
+    thread = threading.Thread(target=loop.start)
+    thread.start()
+
+    message = {'sensor': 1, 'values': [0.5, 100, -7]}
+
+    try:
+        url = 'http://127.0.0.1:%d/socket.io' % port
+
+        client = testing.PollingClient(url, MSGPACK, timeout=5)
+        eq_(client.receive(), ['msgpack'])
+        client.send(message)
+        eq_(client.receive(), [message])
+
+        client = testing.WebSocketClient(url, MSGPACK, timeout=5)
+        ok = client.receive() == ['msgpack'] and client.binary
+        client.send(message)
+        eq_(client.receive(), [message])
+        client.close()
+        assert ok
+
+        # Server does not use codecs which client did not ask for
+        client = testing.WebSocketClient(url, timeout=5)
+        eq_(client.receive(), ['json'])
+        client.send(message)
+        eq_(client.receive(), [message])
+        client.close()
+    finally:
+        # Tornado IOLoop.add_callback is not thread-safe, stop() is
+        loop.stop()
+        thread.join()
+        server.stop()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.conn_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import proto
+from tornadio.conn import SocketConnection
+from tornadio.testing import SimulatedLoop
+
+class Connection(SocketConnection):
+    def on_message(self, message):
+        pass
+
+class Protocol(object):
+    def __init__(self):
+        self.heartbeats = []
+        self.direct = True
+
+    def send_heartbeat(self, number):
+        self.heartbeats.append(number)
+        return self.direct
+
+def test_heartbeat_rtt():
+    protocol = Protocol()
+    conn = Connection(protocol, None, 12)
+
+    conn.send_heartbeat()
+    conn.send_heartbeat()
+    eq_(protocol.heartbeats, [1, 2])
+    eq_(conn._missed_heartbeats, 2)
+    eq_(conn.rtt, None)
+
+    # Unknown heartbeats are ignored
+    conn.raw_message(proto.encode('~h~10'))
+    eq_(conn._missed_heartbeats, 2)
+
+    # Reply to the later heartbeat acknowledges earlier ones
+    conn.raw_message(proto.encode('~h~2'))
+    eq_(conn._missed_heartbeats, 0)
+    assert conn.rtt is not None and conn.rtt >= 0
+
+    # Duplicates are ignored
+    rtt = conn.rtt
+    conn.heartbeat_received('2')
+    eq_(conn.rtt, rtt)
+
+    # Queued heartbeats are acknowledged, but not used for round trip time
+    protocol.direct = False
+    conn.send_heartbeat()
+    conn.heartbeat_received('3')
+    eq_(conn._missed_heartbeats, 0)
+    eq_(conn.rtt, rtt)
+
+class AdaptiveConnection(Connection):
+    adaptive_heartbeat = True
+
+def test_adaptive_interval():
+    loop = SimulatedLoop()
+    conn = AdaptiveConnection(Protocol(), loop, 10)
+    conn.reset_heartbeat()
+
+    # Interval grows while client sends data
+    for _ in xrange(3):
+        loop.advance(5)
+        conn.raw_message(proto.encode('hi'))
+        loop.advance(conn._heartbeat_timer.callback_time / 1000.0 - 5)
+
+    interval = conn._heartbeat_timer.callback_time
+    assert interval > 10000
+
+    # Polling transports reset heartbeats with every request
+    conn.stop_heartbeat()
+    conn.reset_heartbeat()
+    eq_(conn._heartbeat_timer.callback_time, interval)
+
+class Sender(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message, priority):
+        self.messages.append(message)
+
+class HibernatingConnection(SocketConnection):
+    hibernate_after = 60
+    hibernate_attrs = ('profile', 'history')
+
+    def on_message(self, message):
+        self.history.append(message)
+
+def test_hibernation():
+    sender = Sender()
+    conn = HibernatingConnection(sender, None, 12)
+    conn.profile = {'name': 'user'}
+    conn.history = []
+    conn.room = room = set()
+
+    assert conn.hibernate()
+    assert conn.is_hibernating
+    assert 'profile' not in conn.__dict__
+    assert '_protocol' not in conn.__dict__
+    assert conn.room is room
+
+    # Sending does not need application state
+    conn.send('hello')
+    eq_(sender.messages, ['hello'])
+    assert conn.is_hibernating
+
+    # Probing for unknown attributes does not wake connection up
+    assert not hasattr(conn, 'missing')
+    eq_(getattr(conn, 'missing', None), None)
+    assert conn.is_hibernating
+
+    # Access to saved attribute restores state
+    eq_(conn.profile, {'name': 'user'})
+    assert not conn.is_hibernating
+    assert conn.__dict__['_protocol'] is sender
+
+    # So does incoming message
+    conn.hibernate()
+    conn.raw_message(proto.encode('hi'))
+    assert not conn.is_hibernating
+    eq_(conn.history, ['hi'])
+
+    conn.hibernate()
+    conn.wake()
+    assert not conn.is_hibernating
+
+    try:
+        conn.missing
+        assert False, 'AttributeError expected'
+    except AttributeError:
+        pass
+
+class HeartbeatSender(Sender):
+    heartbeats = 0
+    connection = None
+    closed = False
+
+    def send_heartbeat(self, number):
+        self.heartbeats += 1
+
+        # Live client has replied to the previous heartbeat by now
+        if self.connection is not None and number > 1:
+            self.connection.heartbeat_received(str(number - 1))
+
+    def close(self):
+        self.closed = True
+
+def test_hibernation_timer():
+    loop = SimulatedLoop()
+    sender = HeartbeatSender()
+    conn = HibernatingConnection(sender, loop, 12)
+    conn.history = []
+    conn.reset_heartbeat(20000)
+    sender.connection = conn
+
+    # Activity postpones hibernation
+    loop.advance(50)
+    conn.raw_message(proto.encode('hi'))
+    loop.advance(50)
+    assert not conn.is_hibernating
+    eq_(sender.heartbeats, 5)
+
+    # Heartbeat timer is released while connection is hibernating, but
+    # heartbeats are still sent
+    loop.advance(20)
+    assert conn.is_hibernating
+    eq_(conn._heartbeat_timer, None)
+    loop.advance(100)
+    eq_(sender.heartbeats, 10)
+    assert conn.is_hibernating
+
+    # Timer is restored with the same interval on wake
+    conn.wake()
+    eq_(conn._heartbeat_timer.callback_time, 20000)
+    loop.advance(20)
+    eq_(sender.heartbeats, 11)
+
+    # Closed connection does not hibernate
+    conn.raw_message(proto.encode('hi'))
+    conn.handle_close()
+    conn.stop_heartbeat()
+    loop.advance(100)
+    assert not conn.is_hibernating
+    eq_(len(loop), 0)
+
+def test_hibernated_dead_peer():
+    loop = SimulatedLoop()
+    sender = HeartbeatSender()
+    conn = HibernatingConnection(sender, loop, 12)
+    conn.history = []
+    conn.reset_heartbeat(20000)
+
+    loop.advance(70)
+    assert conn.is_hibernating
+    assert not sender.closed
+
+    # Client stopped replying, so hibernated connection is closed anyway
+    loop.advance(100)
+    assert sender.closed
+    assert conn.is_hibernating
+    eq_(conn._hibernate_timeout, None)
+
+class BatchConnection(SocketConnection):
+    def __init__(self, *args, **kwargs):
+        super(BatchConnection, self).__init__(*args, **kwargs)
+        self.batches = []
+
+    def on_messages(self, messages):
+        self.batches.append(messages)
+
+def test_on_messages():
+    conn = BatchConnection(Protocol(), None, 12)
+
+    conn.raw_message(proto.encode(['a', '~h~1', {'b': 1}, 'c']))
+    eq_(conn.batches, [['a', {'b': 1}, 'c']])
+
+    # Heartbeats alone do not make a batch
+    conn.raw_message(proto.encode('~h~2'))
+    eq_(len(conn.batches), 1)
+
+    # Messages decoded before oversized one are delivered
+    try:
+        conn.raw_message(proto.encode(['d', 'x' * 100]), 10)
+        assert False, 'Oversized message was accepted'
+    except proto.MessageTooBig:
+        pass
+
+    eq_(conn.batches[1], ['d'])
+
+def test_on_messages_fallback():
+    received = []
+
+    class OneByOne(SocketConnection):
+        def on_message(self, message):
+            received.append(message)
+
+    OneByOne(Protocol(), None, 12).raw_message(proto.encode(['a', 'b']))
+    eq_(received, ['a', 'b'])
+
+def test_on_messages_errors():
+    class FailingBatch(BatchConnection):
+        def on_messages(self, messages):
+            super(FailingBatch, self).on_messages(messages)
+            raise KeyError()
+
+    conn = FailingBatch(Protocol(), None, 12)
+
+    # Decoding error is not replaced with application error
+    try:
+        conn.raw_message(proto.encode(['a', 'x' * 100]), 10)
+        assert False, 'Oversized message was accepted'
+    except proto.MessageTooBig:
+        pass
+
+    eq_(conn.batches, [['a']])
+
+def test_on_message_incremental():
+    received = []
+
+    class OneByOne(SocketConnection):
+        def on_message(self, message):
+            received.append(message)
+
+    # Messages are handled as they are decoded
+    try:
+        OneByOne(Protocol(), None, 12).raw_message(
+            proto.encode('a') + '~m~5~m~~j~{x')
+        assert False, 'Invalid JSON was accepted'
+    except ValueError:
+        pass
+
+    eq_(received, ['a'])
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.eventloop_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import time
+
+from nose.tools import eq_
+
+from tornado import ioloop
+
+from tornadio import eventloop, periodic, testing
+
+def test_get_loop():
+    io_loop = ioloop.IOLoop()
+    eq_(eventloop.get_loop(io_loop), io_loop)
+    eq_(eventloop.get_loop(), ioloop.IOLoop.instance())
+
+    # Idle simulated loop is not replaced
+    loop = testing.SimulatedLoop()
+    assert eventloop.get_loop(loop) is loop
+
+def test_get_clock():
+    eq_(eventloop.get_clock(ioloop.IOLoop()), time.time)
+
+    loop = testing.SimulatedLoop()
+    clock = eventloop.get_clock(loop)
+    loop.advance(10)
+    eq_(clock(), loop.now)
+
+def test_tornado_loop():
+    io_loop = ioloop.IOLoop()
+    events = []
+
+    def on_periodic():
+        events.append('periodic')
+        timer.stop()
+        io_loop.add_timeout(time.time() + 0.05, io_loop.stop)
+
+    io_loop.add_callback(lambda: events.append('callback'))
+    io_loop.add_timeout(time.time() + 0.01, lambda: events.append('timeout'))
+
+    timer = periodic.Callback(on_periodic, 30, io_loop)
+    timer.start()
+
+    io_loop.start()
+
+    eq_(events, ['callback', 'timeout', 'periodic'])
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.fanout_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import proto
+from tornadio.fanout import FanOut
+from tornadio.registry import Registry
+from tornadio.testing import SimulatedLoop
+
+class Connection(object):
+    """Connection which takes `cost` seconds of loop time to send"""
+    def __init__(self, loop, log, name, cost=0.001):
+        self.loop = loop
+        self.log = log
+        self.name = name
+        self.cost = cost
+        self.is_closed = False
+        self.codec = None
+        self.binary = False
+
+    def send(self, message, priority):
+        self.loop.now += self.cost
+        self.log.append((self.name, message))
+
+def test_slices():
+    loop = SimulatedLoop()
+    fanout = FanOut(loop, budget=0.01, chunk_size=5)
+
+    log = []
+    conns = [Connection(loop, log, i) for i in xrange(100)]
+    conns[10].is_closed = True
+
+    done = []
+    broadcast = fanout.send(conns, 'hi', callback=done.append)
+
+    # Nothing is sent until next loop iteration
+    eq_(log, [])
+    eq_(len(fanout), 1)
+    eq_(fanout.pending, 100)
+
+    loop.advance(0)
+
+    eq_(done, [broadcast])
+    assert broadcast.done
+    eq_(broadcast.sent, 99)
+    eq_(broadcast.skipped, 1)
+    eq_(broadcast.progress, 1.0)
+    eq_(round(broadcast.duration, 3), 0.099)
+
+    # Message is encoded once
+    eq_(set(id(msg) for _, msg in log), set([id(log[0][1])]))
+    eq_(log[0][1], proto.encode('hi'))
+
+    # Time is checked between chunks, so slice may exceed the budget by
+    # at most one chunk
+    eq_(fanout.slices, 10)
+    assert fanout.max_slice < 0.0151
+    eq_(len(fanout), 0)
+    eq_(fanout.completed, 1)
+
+def test_fairness():
+    loop = SimulatedLoop()
+    fanout = FanOut(loop, budget=1, chunk_size=2)
+
+    log = []
+    big = fanout.send([Connection(loop, log, 'big') for _ in xrange(10)],
+                      'big')
+    small = fanout.send([Connection(loop, log, 'small') for _ in xrange(2)],
+                        'small')
+
+    loop.advance(0)
+
+    # Small broadcast does not wait for the big one
+    eq_([name for name, _ in log[:4]], ['big', 'big', 'small', 'small'])
+    assert small.finished < big.finished
+
+def test_cancel():
+    loop = SimulatedLoop()
+    fanout = FanOut(loop, budget=0.002, chunk_size=1)
+
+    log = []
+    done = []
+    broadcast = fanout.send([Connection(loop, log, i) for i in xrange(10)],
+                            'hi', callback=done.append)
+
+    # Run one slice
+    fanout._run()
+    eq_(broadcast.sent, 2)
+    eq_(broadcast.remaining, 8)
+
+    broadcast.cancel()
+    fanout._run()
+
+    eq_(done, [broadcast])
+    eq_(broadcast.sent, 2)
+    eq_(len(fanout), 0)
+
+def test_registry_broadcast():
+    loop = SimulatedLoop()
+    registry = Registry(FanOut(loop))
+
+    log = []
+    conns = [Connection(loop, log, i) for i in xrange(3)]
+
+    registry.add(conns[0], 'a')
+    registry.add(conns[1], 'a', 'b')
+    registry.add(conns[2], 'c')
+
+    broadcast = registry.broadcast(['a', 'b'], 'hi')
+    eq_(broadcast.total, 2)
+
+    loop.advance(0)
+    eq_(sorted(name for name, _ in log), [0, 1])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.flashserver_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from nose.tools import eq_
+
+from tornado import ioloop
+
+from tornadio.flashserver import FlashPolicyServer, POLICY_REQUEST
+
+from .server_test import free_port
+
+POLICY = '<cross-domain-policy></cross-domain-policy>'
+
+def write_policy(path, data, mtime):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    os.utime(path, (mtime, mtime))
+
+def request_policy(port, request=POLICY_REQUEST):
+    sock = socket.create_connection(('127.0.0.1', port), 5)
+
+    try:
+        if request:
+            sock.sendall(request)
+
+        data = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return ''.join(data)
+            data.append(chunk)
+    finally:
+        sock.close()
+
+class PolicyServer(object):
+    """Runs policy server on its own IOLoop in a thread"""
+    def __init__(self, policy_file, **kwargs):
+        self.port = free_port()
+        self.loop = ioloop.IOLoop()
+        self.server = FlashPolicyServer(self.loop, self.port, policy_file,
+                                        **kwargs)
+
+        self.thread = threading.Thread(target=self.loop.start)
+        self.thread.start()
+
+    def stop(self):
+        # Tornado IOLoop.add_callback is not thread-safe, stop() is
+        self.loop.stop()
+        self.thread.join()
+        self.server.stop()
+
+def test_policy():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    write_policy(path, POLICY, 1000)
+    server = PolicyServer(path, check_interval=0)
+
+    try:
+        eq_(request_policy(server.port), POLICY + '\0')
+
+        # Response is cached, missing file does not break it
+        os.unlink(path)
+        eq_(request_policy(server.port), POLICY + '\0')
+
+        # Changed file is reloaded
+        write_policy(path, POLICY.replace('><', '>\n<'), 2000)
+        eq_(request_policy(server.port), POLICY.replace('><', '>\n<') + '\0')
+
+        # Unknown requests are not answered
+        eq_(request_policy(server.port, 'x' * len(POLICY_REQUEST)), '')
+    finally:
+        server.stop()
+        os.unlink(path)
+
+def test_reload():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    write_policy(path, POLICY, 1000)
+    server = FlashPolicyServer(ioloop.IOLoop(), free_port(), path,
+                               check_interval=3600)
+
+    try:
+        # File is not checked for changes until check_interval passes
+        write_policy(path, 'changed', 2000)
+        eq_(server.get_policy(), POLICY + '\0')
+
+        server.reload()
+        eq_(server.get_policy(), 'changed\0')
+    finally:
+        server.stop()
+        os.unlink(path)
+
+def test_limits():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    write_policy(path, POLICY, 1000)
+    server = PolicyServer(path, max_connections=1, read_timeout=0.2)
+
+    try:
+        # Silent client holds the only slot
+        silent = socket.create_connection(('127.0.0.1', server.port), 5)
+
+        # Connections over the limit are dropped right away
+        start = time.time()
+        eq_(request_policy(server.port, None), '')
+        assert time.time() - start < 0.2
+
+        # Silent client is disconnected on timeout
+        eq_(silent.recv(100), '')
+        assert time.time() - start >= 0.1
+        silent.close()
+
+        # And its slot is available again
+        eq_(request_policy(server.port), POLICY + '\0')
+    finally:
+        server.stop()
+        os.unlink(path)
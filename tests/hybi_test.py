@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.hybi_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import hybi
+
+def test_accept_key():
+    # Example from the RFC 6455
+    eq_(hybi.accept_key('dGhlIHNhbXBsZSBub25jZQ=='),
+        's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+def test_frame():
+    # Short frame
+    eq_(hybi.frame(hybi.OP_TEXT, 'abc'), '\x81\x03abc')
+
+    # 16-bit length
+    eq_(hybi.frame(hybi.OP_BINARY, 'a' * 200)[:4], '\x82\x7e\x00\xc8')
+
+    # 64-bit length
+    eq_(hybi.frame(hybi.OP_TEXT, 'a' * 70000)[:10],
+        '\x81\x7f\x00\x00\x00\x00\x00\x01\x11\x70')
+
+    # Control frame
+    eq_(hybi.frame(hybi.OP_PING, '1'), '\x89\x011')
+
+    # Masked client frame, example from the RFC 6455
+    eq_(hybi.frame(hybi.OP_TEXT, 'Hello', '\x37\xfa\x21\x3d'),
+        '\x81\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58')
+
+def test_unmask():
+    # Example from the RFC 6455
+    eq_(hybi.unmask('\x37\xfa\x21\x3d', '\x7f\x9f\x4d\x51\x58'), 'Hello')
+
+    # Empty payload
+    eq_(hybi.unmask('\x37\xfa\x21\x3d', ''), '')
+
+    # Leading zero bytes are preserved
+    eq_(hybi.unmask('\x00\x00\x00\x00', '\x00\x00a'), '\x00\x00a')
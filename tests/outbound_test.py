@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.outbound_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import proto, outbound
+
+def test_strict():
+    queue = outbound.OutboundQueue('strict', bulk_size=20)
+
+    queue.append('b1' * 5, outbound.BULK)
+    queue.append('n1')
+    queue.append('b2' * 5, outbound.BULK)
+    queue.append('b3' * 5, outbound.BULK)
+    queue.conflate('k', 'n2')
+    queue.append('h1', outbound.HIGH)
+    queue.append('c1', outbound.CONTROL)
+    queue.conflate('k', 'n3')
+
+    eq_(len(queue), 7)
+
+    # Bulk messages are encoded and paced by size
+    bulk = proto.encode('b1' * 5)
+    eq_(queue.bulk_bytes, len(bulk) * 3)
+    eq_(queue.pop(), ['c1', 'h1', 'n1', 'n3', bulk, proto.encode('b2' * 5)])
+    eq_(queue.bulk_bytes, len(bulk))
+
+    queue.append('n4')
+    eq_(queue.pop(), ['n4', proto.encode('b3' * 5)])
+    eq_(len(queue), 0)
+    eq_(queue.bulk_bytes, 0)
+
+def test_fifo():
+    queue = outbound.OutboundQueue('fifo', bulk_size=1)
+
+    queue.append('b1', outbound.BULK)
+    queue.append('n1')
+    queue.append('c1', outbound.CONTROL)
+
+    eq_(queue.pop(), ['b1', 'n1', 'c1'])
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.persistentsession_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import proto, router, session, testing
+from tornadio.conn import SocketConnection
+from tornadio.persistentsession import PersistentSession
+from tornadio.registry import Registry
+
+class Connection(SocketConnection):
+    def on_open(self, *args, **kwargs):
+        self.opened = getattr(self, 'opened', 0) + 1
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.closed = True
+
+def make_router(buffer_size=64):
+    class Router(object):
+        connection = Connection
+        loop = testing.SimulatedLoop()
+        clock = loop.time
+        request = None
+        settings = dict(router.DEFAULT_SETTINGS,
+                        websocket_resume_buffer=buffer_size)
+        registry = Registry()
+        scheduler = None
+
+    return Router()
+
+class Handler(object):
+    codec = None
+    binary = False
+
+    def __init__(self):
+        self.frames = []
+        self.is_closed = False
+
+    def send(self, frame):
+        self.frames.append(frame)
+
+    def send_heartbeat(self, number):
+        pass
+
+    def close(self):
+        self.is_closed = True
+
+def frame(seq, message):
+    return proto.encode('~s~%d' % seq) + proto.encode(message)
+
+def test_resume():
+    handler = Handler()
+    sess = PersistentSession('abc', 30, make_router(), handler, (), {})
+
+    # Session ID is not numbered
+    sess.send('a')
+    sess.send('b')
+    eq_(handler.frames, ['abc', frame(1, 'a'), frame(2, 'b')])
+
+    assert sess.detach(handler)
+    sess.send('c')
+
+    # Client saw first frame, so it gets the rest
+    resumed = Handler()
+    assert sess.resume(resumed, 1)
+    eq_(resumed.frames, ['abc', frame(2, 'b'), frame(3, 'c')])
+    eq_(sess.connection.opened, 1)
+
+    # Session is attached to another websocket
+    assert not sess.resume(Handler(), 3)
+    assert not sess.is_closed
+
+def make_session(buffer_size, count):
+    handler = Handler()
+    sess = PersistentSession('abc', 30, make_router(buffer_size), handler,
+                             (), {})
+
+    for n in xrange(count):
+        sess.send(n)
+
+    sess.detach(handler)
+    return sess
+
+def test_resume_buffer():
+    sess = make_session(2, 4)
+
+    # Only last frames are kept
+    eq_([seq for seq, _ in sess.replay_buffer], [3, 4])
+
+    resumed = Handler()
+    assert sess.resume(resumed, 2)
+    eq_(resumed.frames, ['abc', frame(3, 2), frame(4, 3)])
+
+    # Missed frame is not available anymore, so session is closed and
+    # client has to start over
+    sess = make_session(2, 4)
+    assert not sess.resume(Handler(), 1)
+    assert sess.is_closed
+    assert sess.connection.closed
+
+    # Client can't have seen frames which were not sent
+    sess = make_session(2, 4)
+    assert not sess.resume(Handler(), 5)
+    assert sess.is_closed
+
+    # Nothing was missed
+    sess = make_session(2, 4)
+    resumed = Handler()
+    assert sess.resume(resumed, 4)
+    eq_(resumed.frames, ['abc'])
+
+def test_grace_period():
+    rt = make_router()
+    sessions = session.SessionContainer(rt.clock)
+
+    handler = Handler()
+    sess = sessions.create(PersistentSession, 30, router=rt, handler=handler,
+                           args=(), kwargs={})
+
+    # Attached session does not expire
+    rt.loop.advance(40)
+    sessions.expire()
+    assert sessions.get(sess.session_id) is sess
+
+    # Detached session waits for client to reconnect
+    sess.detach(handler)
+    rt.loop.advance(20)
+    sessions.expire()
+    assert sessions.get(sess.session_id) is sess
+    assert not sess.is_closed
+
+    rt.loop.advance(11)
+    sessions.expire()
+    eq_(sessions.get(sess.session_id), None)
+    assert sess.is_closed
+    eq_(len(sess.replay_buffer), 0)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.pollingsession_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import proto, router, pollingsession, outbound, testing
+from tornadio import scheduler
+from tornadio.conn import SocketConnection
+from tornadio.registry import Registry
+
+class Connection(SocketConnection):
+    def on_message(self, message):
+        pass
+
+class Router(object):
+    connection = Connection
+    loop = testing.SimulatedLoop()
+    clock = loop.time
+    request = None
+    settings = router.DEFAULT_SETTINGS
+    registry = Registry()
+    scheduler = None
+
+class Handler(object):
+    def __init__(self):
+        self.data = []
+
+    def data_available(self, raw_data):
+        self.data.append(raw_data)
+
+def test_send_conflated():
+    session = pollingsession.PollingSession('abc', 15, Router(), (), {})
+    session.send_queue.pop()
+
+    # Messages with same key replace each other while there is no handler
+    session.send_conflated('a', 1)
+    session.send('x')
+    session.send_conflated('b', 2)
+    session.send_conflated('a', 3)
+    eq_(session.send_queue.lanes[outbound.NORMAL], [3, 'x', 2])
+
+    # Everything is sent once handler is available
+    handler = Handler()
+    session.set_handler(handler)
+    session.flush()
+    eq_(handler.data, [proto.encode([3, 'x', 2])])
+
+    # New messages are not replaced after flush
+    session.remove_handler(handler)
+    session.send_conflated('a', 4)
+    eq_(session.send_queue.pop(), [4])
+
+def test_send_priority():
+    session = pollingsession.PollingSession('abc', 15, Router(), (), {})
+    session.send_queue.pop()
+
+    session.send('a')
+    session.send('bulk', outbound.BULK)
+
+    # Heartbeat waits for the poll
+    eq_(session.send_heartbeat(1), False)
+    session.send('b', outbound.HIGH)
+
+    handler = Handler()
+    session.set_handler(handler)
+    session.flush()
+    eq_(handler.data, [proto.encode(['~h~1', 'b', 'a', 'bulk'])])
+
+    eq_(session.send_heartbeat(2), True)
+    eq_(handler.data[-1], proto.encode('~h~2'))
+
+def test_heartbeat_rate():
+    session = pollingsession.PollingSession('abc', 15, Router(), (), {})
+
+    rate = session.message_rate()
+
+    # Heartbeats are not messages, idle session stays idle
+    for n in xrange(10):
+        session.send_heartbeat(n)
+    eq_(session.message_rate(), rate)
+
+    session.send('a')
+    assert session.message_rate() > rate
+
+class EventHandler(Handler):
+    def __init__(self, session):
+        super(EventHandler, self).__init__()
+        self.session = session
+        self.events = []
+
+    def data_available(self, raw_data):
+        self.send_event(self.session.event_id, raw_data)
+
+    def send_event(self, event_id, raw_data):
+        self.events.append((event_id, raw_data))
+
+def test_eventsource_history():
+    class HistoryRouter(Router):
+        settings = dict(router.DEFAULT_SETTINGS, eventsource_history=2)
+
+    session = pollingsession.EventSourceSession('abc', 15, HistoryRouter(),
+                                                (), {})
+    # Messages queued while there is no GET request are sent as one event
+    session.send('a')
+    handler = EventHandler(session)
+    session.set_handler(handler)
+    session.flush()
+
+    session.send('b')
+    session.send('c')
+    eq_(handler.events, [(1, proto.encode(['abc', 'a'])),
+                         (2, proto.encode('b')),
+                         (3, proto.encode('c'))])
+
+    # Only events after the given one are replayed, and only last ones
+    # are kept
+    handler.events = []
+    session.replay(2)
+    eq_(handler.events, [(3, proto.encode('c'))])
+
+    handler.events = []
+    session.replay(0)
+    eq_([event_id for event_id, _ in handler.events], [2, 3])
+
+    # Numbering and history survive moving session to another process
+    state = session.dump(0)
+    restored = pollingsession.EventSourceSession('abc', 15, HistoryRouter(),
+                                                 (), {}, state)
+    eq_(restored.event_id, 3)
+    eq_(list(restored.history), list(session.history))
+
+class HibernatingConnection(Connection):
+    hibernate_after = 60
+    hibernate_attrs = ('profile',)
+
+    def on_open(self, *args, **kwargs):
+        self.profile = {'name': 'user'}
+
+def test_hibernation():
+    class HibernatingRouter(Router):
+        connection = HibernatingConnection
+        loop = testing.SimulatedLoop()
+        clock = loop.time
+        scheduler = scheduler.Scheduler(loop)
+
+    session = pollingsession.PollingSession('abc', 15, HibernatingRouter(),
+                                            (), {})
+    conn = session.connection
+
+    # Polling sessions do not run heartbeats, but still hibernate
+    HibernatingRouter.loop.advance(61)
+    assert conn.is_hibernating
+
+    session.raw_message(proto.encode('hi'))
+    assert not conn.is_hibernating
+    eq_(conn.profile, {'name': 'user'})
+
+class LegacyConnection(Connection):
+    def __init__(self, protocol, io_loop, heartbeat_interval):
+        super(LegacyConnection, self).__init__(protocol, io_loop,
+                                               heartbeat_interval)
+        self.legacy = True
+
+def test_connection_init():
+    class LegacyRouter(Router):
+        connection = LegacyConnection
+        registry = Registry()
+
+    # Connections which override constructor still get the registry
+    session = pollingsession.PollingSession('abc', 15, LegacyRouter(), (), {})
+    conn = session.connection
+    assert conn.legacy
+
+    conn.register('all')
+    eq_(LegacyRouter.registry.get('all'), set([conn]))
+    eq_(LegacyRouter.registry.connections, 1)
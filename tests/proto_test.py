@@ -10,6 +10,7 @@
 from nose.tools import eq_
 
 from tornadio import proto
+from tornadio.codec import CODECS
 
 def test_encode():
     # Test string encode
@@ -28,6 +29,62 @@ def test_encode():
     # Test special characters encoding
     eq_(proto.encode('~m~'), '~m~3~m~~m~')
 
+def test_prepare():
+    # Prepared messages are not encoded again
+    msg = proto.prepare({'a':'b'})
+    eq_(msg, '~m~13~m~~j~{"a": "b"}')
+    assert proto.encode(msg) is msg
+
+    # Single prepared message in a list is passed as is
+    assert proto.encode([msg]) is msg
+
+    # Prepared messages can be mixed with regular ones
+    eq_(proto.encode([msg, 'a']), '~m~13~m~~j~{"a": "b"}~m~1~m~a')
+
+def test_encode_cache():
+    cache = proto.EncodeCache(max_items=2, max_bytes=64)
+
+    # Strings are cached by content
+    msg = cache.encode('abc')
+    eq_(msg, '~m~3~m~abc')
+    assert cache.encode('abc') is msg
+    eq_((cache.hits, cache.misses), (1, 1))
+
+    # Objects are cached by identity
+    obj = {'a': 'b'}
+    msg = cache.encode(obj)
+    assert cache.encode(obj) is msg
+    assert cache.encode({'a': 'b'}) is not msg
+
+    # Least recently used item is evicted
+    eq_(len(cache), 2)
+    assert cache.encode('abc') is not None
+    eq_(cache.evictions, 2)
+
+    # Explicit keys
+    eq_(cache.encode({'a': 'c'}, 'key'), '~m~13~m~~j~{"a": "c"}')
+    eq_(cache.encode({'a': 'd'}, 'key'), '~m~13~m~~j~{"a": "c"}')
+
+    # Memory limit, string keys count as well
+    cache.encode('x' * 70)
+    eq_(len(cache), 2)
+    assert cache.bytes <= 64
+
+    cache.clear()
+    cache.encode('x' * 20)
+    eq_(cache.bytes, 20 + len('~m~20~m~') + 20)
+
+    # Each codec gets its own copy
+    codec = CODECS['msgpack']
+    msg = cache.encode({'a': 'c'}, 'key', codec, True)
+    eq_(msg, proto.encode({'a': 'c'}, codec, True))
+    assert cache.encode({'a': 'c'}, 'key', codec, True) is msg
+    assert cache.encode({'a': 'c'}, 'key') is not msg
+
+    cache.invalidate('key')
+    eq_(len(cache), 0)
+    eq_(cache.bytes, 0)
+
 def test_decode():
     # Test string decode
     eq_(proto.decode(proto.encode('abc')), [('~m~', 'abc')])
@@ -40,6 +97,36 @@ def test_decode():
     eq_(proto.decode(proto.encode({'a':'b'})),
         [('~m~', {'a':'b'})])
 
+    # Test heartbeat and sequence decode
+    eq_(proto.decode(proto.encode(['~h~1', '~s~2'])),
+        [('~h~', '1'), ('~s~', '2')])
+
     # Test seprate messages decoding
     eq_(proto.decode(proto.encode(['a','b'])),
         [('~m~', 'a'), ('~m~', 'b')])
+
+def test_decode_lazy():
+    msg = proto.decode(proto.encode({'a':'b'}), True)[0][1]
+
+    eq_(msg.raw, '{"a": "b"}')
+    eq_(msg.value, {'a':'b'})
+    eq_(msg['a'], 'b')
+    assert msg.value is msg.value
+
+    # Strings are not affected
+    eq_(proto.decode(proto.encode('abc'), True), [('~m~', 'abc')])
+
+def test_decode_max_size():
+    data = proto.encode(['abc', 'x' * 100, 'def'])
+
+    eq_(len(proto.decode(data, max_size=100)), 3)
+
+    # Messages are decoded one by one, up to the oversized one
+    messages = proto.iterdecode(data, max_size=99)
+    eq_(messages.next(), (proto.FRAME, 'abc'))
+
+    try:
+        messages.next()
+        assert False, 'MessageTooBig expected'
+    except proto.MessageTooBig:
+        pass
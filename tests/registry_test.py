@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.registry_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import proto, codec
+from tornadio.conn import SocketConnection
+from tornadio.registry import Registry
+
+class Connection(SocketConnection):
+    def on_message(self, message):
+        pass
+
+class Protocol(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message, priority):
+        self.messages.append(message)
+
+def connect(registry):
+    conn = Connection(Protocol(), None, 12)
+    conn.set_registry(registry)
+    return conn
+
+def test_registry():
+    registry = Registry()
+
+    conns = [connect(registry) for _ in range(3)]
+
+    conns[0].register(('user', 1), 'admins')
+    conns[1].register(('user', 1))
+    conns[2].register(('user', 2), 'admins')
+
+    eq_(len(registry), 3)
+    eq_(registry.get(('user', 1)), set(conns[:2]))
+    eq_(registry.keys_of(conns[0]), set([('user', 1), 'admins']))
+
+    # Each connection receives message once, encoded once
+    eq_(registry.send_to([('user', 1), 'admins', 'unknown'], 'hi'), 3)
+    messages = [c._protocol.messages[0] for c in conns]
+    eq_(messages, [proto.encode('hi')] * 3)
+    assert isinstance(messages[0], proto.EncodedMessage)
+    assert messages[0] is messages[1] is messages[2]
+
+    conns[2].unregister('admins')
+    eq_(registry.get('admins'), set([conns[0]]))
+
+    # Closed connections are removed from the registry
+    conns[0].handle_close()
+    assert conns[0].is_closed
+    eq_(registry.get(('user', 1)), set([conns[1]]))
+    assert 'admins' not in registry
+    eq_(len(registry), 2)
+
+    eq_(registry.send_to(['admins'], 'hi'), 0)
+
+def test_send_to_codecs():
+    registry = Registry()
+    msgpack = codec.CODECS['msgpack']
+
+    conns = [connect(registry) for _ in range(2)]
+    conns[1]._protocol.codec = msgpack
+    conns[1]._protocol.binary = True
+
+    for conn in conns:
+        conn.register('all')
+
+    # Message is encoded for the codec each connection negotiated
+    eq_(registry.send_to(['all'], {'a': 1}), 2)
+    eq_(conns[0]._protocol.messages, [proto.encode({'a': 1})])
+    eq_(conns[1]._protocol.messages, [proto.encode({'a': 1}, msgpack, True)])
+
+def test_no_registry():
+    conn = Connection(Protocol(), None, 12)
+    eq_(conn.registry_keys(), set())
+
+    try:
+        conn.register('all')
+        assert False, 'ValueError expected'
+    except ValueError:
+        pass
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.scheduler_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import time
+
+from nose.tools import eq_
+
+from tornadio import scheduler
+from tornadio.testing import SimulatedLoop
+
+class FakeLoop(object):
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append((deadline, callback))
+        return callback
+
+def test_scheduler():
+    loop = FakeLoop()
+    sched = scheduler.Scheduler(loop, 0.5)
+
+    calls = []
+    now = time.time()
+
+    # Only one IOLoop timeout for many timers
+    sched.add(now - 1, lambda: calls.append(1))
+    timer = sched.add(now - 1, lambda: calls.append(2))
+    sched.add(now + 60, lambda: calls.append(3))
+    eq_(len(loop.timeouts), 1)
+    eq_(len(sched), 3)
+
+    # Cancelled timers do not run
+    sched.remove(timer)
+    eq_(len(sched), 2)
+
+    # Expired timers run on tick
+    loop.timeouts.pop()[1]()
+    eq_(calls, [1])
+    eq_(len(sched), 1)
+
+    # Scheduler keeps ticking while there are timers
+    eq_(len(loop.timeouts), 1)
+
+def test_rounding():
+    loop = SimulatedLoop()
+    sched = scheduler.Scheduler(loop, 0.5)
+
+    fired = []
+    deadline = loop.time() + 1.2
+    sched.add(deadline, lambda: fired.append(loop.time()))
+
+    # Timers never fire early and at most one resolution late
+    loop.advance(1.19)
+    eq_(fired, [])
+    loop.advance(1)
+    eq_(len(fired), 1)
+    assert deadline <= fired[0] <= deadline + 0.5
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.server_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import os
+import json
+import socket
+import struct
+import threading
+import time
+import urllib
+import urllib2
+
+from nose.tools import eq_
+
+from tornado import ioloop, web
+
+from tornadio import hybi, outbound, proto, testing
+from tornadio.conn import SocketConnection
+from tornadio.router import get_router
+from tornadio.server import SocketServer
+
+class Echo(SocketConnection):
+    def on_message(self, message):
+        self.send(message)
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def test_limits():
+    loop = ioloop.IOLoop()
+    port = free_port()
+
+    router = get_router(Echo, {'max_request_size': 100}, io_loop=loop)
+    application = web.Application([router.route()],
+                                  socket_io_port=port,
+                                  socket_io_address='127.0.0.1')
+
+    server = SocketServer(application, io_loop=loop, auto_start=False)
+
+    thread = threading.Thread(target=loop.start)
+    thread.start()
+
+    try:
+        # Oversized body is rejected before it is decoded
+        sock = socket.create_connection(('127.0.0.1', port), 5)
+        sock.sendall('POST /socket.io/xhr-polling/1/send HTTP/1.1\r\n'
+                     'Content-Length: 200\r\n\r\n' + 'x' * 200)
+        eq_(sock.recv(100).split('\r\n')[0],
+            'HTTP/1.1 413 Request Entity Too Large')
+        sock.close()
+
+        url = 'http://127.0.0.1:%d/socket.io' % port
+
+        client = testing.WebSocketClient(url, timeout=5)
+        client.send('hi')
+        eq_(client.receive(), ['hi'])
+
+        # Control frames can't be larger than 125 bytes
+        client.sock.sendall(hybi.frame(hybi.OP_PING, 'x' * 126,
+                                       os.urandom(4)))
+        eq_(client._recv(4), '\x88\x02' + struct.pack('!H', 1002))
+        client.close()
+    finally:
+        # Tornado IOLoop.add_callback is not thread-safe, stop() is
+        loop.stop()
+        thread.join()
+        server.stop()
+
+class EventStream(object):
+    """Reads EventSource events from the chunked response"""
+    def __init__(self, port, last_event_id=None):
+        self.sock = socket.create_connection(('127.0.0.1', port), 5)
+        self.file = self.sock.makefile()
+
+        headers = 'GET /socket.io/eventsource/ HTTP/1.1\r\nHost: test\r\n'
+        if last_event_id is not None:
+            headers += 'Last-Event-ID: %s\r\n' % last_event_id
+        self.sock.sendall(headers + '\r\n')
+
+        self.status = self.file.readline().split(' ', 2)[1]
+        while self.file.readline() != '\r\n':
+            pass
+
+    def next_event(self):
+        size = int(self.file.readline(), 16)
+        data = self.file.read(size)
+        self.file.readline()
+        return data
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def reconnect(port, last_event_id):
+    # Server might not have noticed that previous stream was closed yet
+    for _ in xrange(50):
+        stream = EventStream(port, last_event_id)
+        if stream.status == '200':
+            return stream
+
+        stream.close()
+        time.sleep(0.05)
+
+    assert False, 'Could not reconnect'
+
+def test_eventsource():
+    loop = ioloop.IOLoop()
+    port = free_port()
+
+    router = get_router(Echo, {'eventsource_history': 2}, io_loop=loop)
+    application = web.Application([router.route()],
+                                  socket_io_port=port,
+                                  socket_io_address='127.0.0.1')
+
+    server = SocketServer(application, io_loop=loop, auto_start=False)
+
+    thread = threading.Thread(target=loop.start)
+    thread.start()
+
+    try:
+        stream = EventStream(port)
+        eq_(stream.status, '200')
+
+        # Event ID is session ID and sequence number
+        event = stream.next_event()
+        session_id = event.split('\n')[0][len('id: '):].split(':')[0]
+        eq_(event, 'id: %s:1\ndata: %s\n\n' % (session_id,
+                                                  proto.encode(session_id)))
+
+        def post(message):
+            data = urllib.urlencode({'data': proto.encode(message)})
+            urllib2.urlopen('http://127.0.0.1:%d/socket.io/eventsource/%s'
+                            % (port, session_id), data, timeout=5).read()
+
+        # Lines are sent as separate data fields
+        post('a\nb')
+        eq_(stream.next_event(),
+            'id: %s:2\ndata: %s\n\n'
+            % (session_id, proto.encode('a\nb').replace('\n', '\ndata: ')))
+
+        # Carriage returns can't be in the event stream, so such batch is
+        # sent as JSON encoded string
+        post('c\rd')
+        eq_(stream.next_event(),
+            'id: %s:3\nevent: json\ndata: %s\n\n'
+            % (session_id, json.dumps(proto.encode('c\rd'))))
+        stream.close()
+
+        # Events after the last seen one are sent again
+        stream = reconnect(port, '%s:2' % session_id)
+        eq_(stream.next_event().split('\n')[0], 'id: %s:3' % session_id)
+
+        post('e')
+        eq_(stream.next_event().split('\n')[0], 'id: %s:4' % session_id)
+        stream.close()
+
+        # Only last `eventsource_history` events are kept
+        stream = reconnect(port, '%s:0' % session_id)
+        eq_(stream.next_event().split('\n')[0], 'id: %s:3' % session_id)
+        eq_(stream.next_event().split('\n')[0], 'id: %s:4' % session_id)
+        stream.close()
+
+        # Session is picked up without replay if sequence is malformed
+        stream = reconnect(port, '%s:x' % session_id)
+        post('f')
+        eq_(stream.next_event().split('\n')[0], 'id: %s:5' % session_id)
+        stream.close()
+    finally:
+        loop.stop()
+        thread.join()
+        server.stop()
+
+class ResumingClient(testing.WebSocketClient):
+    """Websocket client which resumes session"""
+    def __init__(self, url, session_id, last_seen):
+        self.resume_query = '/%s?seq=%s' % (session_id, last_seen)
+
+        super(ResumingClient, self).__init__(url, timeout=5)
+
+    def _query(self):
+        return self.resume_query
+
+def test_websocket_resume():
+    loop = ioloop.IOLoop()
+    port = free_port()
+
+    router = get_router(Echo, {'websocket_resume': True}, io_loop=loop)
+    application = web.Application([router.route()],
+                                  socket_io_port=port,
+                                  socket_io_address='127.0.0.1')
+
+    server = SocketServer(application, io_loop=loop, auto_start=False)
+
+    thread = threading.Thread(target=loop.start)
+    thread.start()
+
+    try:
+        url = 'http://127.0.0.1:%d/socket.io' % port
+
+        client = testing.WebSocketClient(url, timeout=5)
+        session_id = client.session_id
+
+        client.send('a')
+        eq_(client.receive(), ['a'])
+        client.send('b')
+        eq_(client.receive(), ['b'])
+        client.close()
+
+        # Server might not have noticed that websocket was closed yet, then
+        # new session is created
+        for _ in xrange(50):
+            client = ResumingClient(url, session_id, 1)
+            if client.session_id == session_id:
+                break
+
+            client.close()
+            time.sleep(0.05)
+
+        # Frame client missed is sent again
+        eq_(client.session_id, session_id)
+        eq_(client.receive(), ['b'])
+        client.close()
+
+        # Malformed sequence number means client saw nothing, but the
+        # replay buffer starts with the first frame
+        for _ in xrange(50):
+            client = ResumingClient(url, session_id, 'x')
+            if client.session_id == session_id:
+                break
+
+            client.close()
+            time.sleep(0.05)
+
+        eq_(client.session_id, session_id)
+
+        received = client.receive()
+        if len(received) < 2:
+            received += client.receive()
+        eq_(received, ['a', 'b'])
+        client.close()
+    finally:
+        loop.stop()
+        thread.join()
+        server.stop()
+
+class Flood(SocketConnection):
+    def on_open(self, *args, **kwargs):
+        self.events = []
+
+    def on_message(self, message):
+        if message == 'events':
+            self.send({'events': self.events})
+            return
+
+        priority = outbound.BULK if message == 'bulk' else outbound.NORMAL
+        for n in xrange(20):
+            self.send('%02d' % n + 'x' * 10000, priority)
+
+    def on_congested(self):
+        self.events.append('congested')
+
+    def on_drained(self):
+        self.events.append('drained')
+
+def receive(client, count):
+    received = []
+    while len(received) < count:
+        received += client.receive()
+    return received
+
+def test_write_buffer():
+    loop = ioloop.IOLoop()
+    port = free_port()
+
+    router = get_router(Flood, {'write_buffer_high_watermark': 50000,
+                                'write_buffer_low_watermark': 10000,
+                                'bulk_write_size': 10000},
+                        io_loop=loop)
+    application = web.Application([router.route()],
+                                  socket_io_port=port,
+                                  socket_io_address='127.0.0.1')
+
+    server = SocketServer(application, io_loop=loop, auto_start=False)
+
+    thread = threading.Thread(target=loop.start)
+    thread.start()
+
+    try:
+        url = 'http://127.0.0.1:%d/socket.io' % port
+        client = testing.WebSocketClient(url, timeout=5)
+
+        # Paced bulk messages do not make connection congested
+        client.send('bulk')
+        eq_(len(receive(client, 20)), 20)
+        client.send('events')
+        eq_(client.receive(), [{'events': []}])
+
+        # Connection is notified, but nothing is dropped by default
+        client.send('flood')
+        eq_([msg[:2] for msg in receive(client, 20)],
+            ['%02d' % n for n in xrange(20)])
+
+        # Drain check runs periodically
+        time.sleep(0.3)
+        client.send('events')
+        eq_(client.receive(), [{'events': ['congested', 'drained']}])
+        client.close()
+    finally:
+        loop.stop()
+        thread.join()
+        server.stop()
+
+class Prices(SocketConnection):
+    def on_message(self, message):
+        # Fill the write buffer, so connection becomes congested
+        for n in xrange(10):
+            self.send('%02d' % n + 'x' * 10000)
+
+        for n in xrange(100):
+            self.send_conflated('a', {'a': n})
+            self.send_conflated('b', {'b': n})
+
+def test_conflation():
+    loop = ioloop.IOLoop()
+    port = free_port()
+
+    router = get_router(Prices, {'write_buffer_high_watermark': 50000,
+                                 'write_buffer_low_watermark': 10000},
+                        io_loop=loop)
+    application = web.Application([router.route()],
+                                  socket_io_port=port,
+                                  socket_io_address='127.0.0.1')
+
+    server = SocketServer(application, io_loop=loop, auto_start=False)
+
+    thread = threading.Thread(target=loop.start)
+    thread.start()
+
+    try:
+        url = 'http://127.0.0.1:%d/socket.io' % port
+        client = testing.WebSocketClient(url, timeout=5)
+
+        # With the default policy nothing else is dropped, but only the
+        # latest value for each key is sent once connection drained
+        client.send('go')
+        received = receive(client, 10)
+        eq_([msg[:2] for msg in received[:10]],
+            ['%02d' % n for n in xrange(10)])
+
+        received = received[10:]
+        if len(received) < 2:
+            received += receive(client, 2 - len(received))
+        eq_(received, [{'a': 99}, {'b': 99}])
+        client.close()
+    finally:
+        loop.stop()
+        thread.join()
+        server.stop()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.snapshot_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import os
+import shutil
+import stat
+import tempfile
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_
+
+from tornadio import outbound, pollingsession
+from tornadio.conn import SocketConnection
+from tornadio.router import get_router
+from tornadio.testing import SimulatedLoop
+
+class Connection(SocketConnection):
+    hibernate_attrs = ('user',)
+
+    def on_open(self, *args, **kwargs):
+        self.events = ['open']
+
+    def on_restore(self):
+        self.events = ['restore']
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.events.append('close')
+
+class Handler(object):
+    def __init__(self):
+        self.suspended = False
+
+    def suspend(self):
+        self.suspended = True
+
+def create_session(router, session_class=pollingsession.PollingSession):
+    router = router(None, None)
+    return router.sessions.create(session_class, 30,
+                                  router=router,
+                                  args=(),
+                                  kwargs={})
+
+def test_save_load():
+    old_router = get_router(Connection, io_loop=SimulatedLoop())
+
+    sess = create_session(old_router)
+    sess.connection.user = 'joe'
+    sess.connection.register(('user', 'joe'))
+    sess.send('bulk', outbound.BULK)
+    sess.send('urgent', outbound.HIGH)
+
+    events = create_session(old_router, pollingsession.EventSourceSession)
+    events.event_id = 5
+    events.history.append((5, 'data'))
+
+    create_session(old_router).close()
+
+    handler = sess.handler = Handler()
+
+    f = StringIO()
+    eq_(old_router.save_sessions(f), 2)
+
+    # Old process stops serving sessions without closing them
+    ok_(handler.suspended)
+    ok_(sess.is_closed)
+    eq_(sess.connection.events, ['open'])
+    eq_(len(old_router.registry), 0)
+
+    new_router = get_router(Connection, io_loop=SimulatedLoop())
+
+    f.seek(0)
+    eq_(new_router.load_sessions(f), 2)
+
+    restored = new_router(None, None).sessions.get(sess.session_id)
+    eq_(restored.send_queue.items(),
+        [(outbound.HIGH, 'urgent'),
+         (outbound.NORMAL, sess.session_id),
+         (outbound.BULK, '~m~4~m~bulk')])
+    eq_(restored.connection.user, 'joe')
+    eq_(restored.connection.events, ['restore'])
+    eq_(new_router.registry.get(('user', 'joe')), set([restored.connection]))
+
+    restored = new_router(None, None).sessions.get(events.session_id)
+    eq_(restored.event_id, 5)
+    eq_(list(restored.history), [(5, 'data')])
+
+def test_load_expired():
+    loop = SimulatedLoop()
+    old_router = get_router(Connection, io_loop=loop)
+    create_session(old_router)
+
+    f = StringIO()
+    old_router.save_sessions(f)
+
+    # Session expires before new process starts
+    loop.advance(60)
+
+    new_router = get_router(Connection, io_loop=loop)
+
+    f.seek(0)
+    eq_(new_router.load_sessions(f), 0)
+
+def test_load_missing_file():
+    router = get_router(Connection, io_loop=SimulatedLoop())
+    eq_(router.load_sessions('/nonexistent/sessions'), 0)
+
+def test_save_file():
+    loop = SimulatedLoop()
+    old_router = get_router(Connection, io_loop=loop)
+    create_session(old_router)
+
+    path = tempfile.mkdtemp()
+    try:
+        name = os.path.join(path, 'sessions')
+        eq_(old_router.save_sessions(name), 1)
+
+        # Snapshot has session IDs, so only owner can read it
+        eq_(stat.S_IMODE(os.stat(name).st_mode), 0600)
+
+        new_router = get_router(Connection, io_loop=loop)
+        eq_(new_router.load_sessions(name), 1)
+    finally:
+        shutil.rmtree(path)
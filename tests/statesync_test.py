@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.statesync_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import copy
+
+from nose.tools import eq_
+
+from tornadio import statesync
+
+def test_diff():
+    old = {'a': 1, 'b': {'c': [1, 2], 'd': 'x'}, 'e/f': 1, 'g': [1]}
+    new = {'a': 1, 'b': {'c': [1, 3], 'n': None}, 'e/f': 2, 'g': [1, 2]}
+
+    patch = statesync.diff(old, new)
+
+    eq_(sorted(patch),
+        sorted([{'op': 'remove', 'path': '/b/d'},
+                {'op': 'add', 'path': '/b/n', 'value': None},
+                {'op': 'replace', 'path': '/b/c/1', 'value': 3},
+                {'op': 'replace', 'path': '/e~1f', 'value': 2},
+                {'op': 'replace', 'path': '/g', 'value': [1, 2]}]))
+
+    eq_(statesync.apply_patch(copy.deepcopy(old), patch), new)
+
+    # Nothing changed
+    eq_(statesync.diff(old, copy.deepcopy(old)), [])
+
+    # Root replaced
+    eq_(statesync.apply_patch(old, statesync.diff(old, [1])), [1])
+
+def test_state_sync():
+    doc = {'title': 'x' * 100, 'count': 1}
+
+    state = statesync.StateSync('doc', doc)
+    eq_(state.snapshot(), {'state': 'doc', 'version': 1, 'snapshot': doc})
+
+    # Small change is sent as patch
+    doc['count'] = 2
+    eq_(state.update(doc),
+        {'state': 'doc', 'version': 2,
+         'patch': [{'op': 'replace', 'path': '/count', 'value': 2}]})
+
+    # Large change is sent as snapshot
+    doc = {'other': 1}
+    eq_(state.update(doc), {'state': 'doc', 'version': 3, 'snapshot': doc})
+
+def test_state_copy():
+    doc = {'items': [{'id': 1, 'tags': ('a', 'b')}], 'big': {'x': 'y' * 100},
+           1: 'one'}
+
+    state = statesync.StateSync('doc', doc)
+    big = state.data['big']
+
+    # Nothing changed, so there is nothing to send and version is the same.
+    # Tuples and non-string keys are compared the way they are encoded.
+    eq_(state.update(doc), None)
+    eq_(state.version, 1)
+
+    # State is copied, so changes to nested values are detected
+    doc['items'][0]['tags'] = ('a', 'c')
+    eq_(state.update(doc)['patch'],
+        [{'op': 'replace', 'path': '/items/0/tags/1', 'value': 'c'}])
+    eq_(state.version, 2)
+
+    # Unchanged parts are not copied again
+    assert state.data['big'] is big
+
+    # Same value of other type is a change
+    doc[1] = 'one'
+    doc['items'][0]['id'] = 1.0
+    eq_(state.update(doc)['patch'],
+        [{'op': 'replace', 'path': '/items/0/id', 'value': 1.0}])
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.tests.testing_test
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+
+from nose.tools import eq_
+
+from tornadio import session, periodic, scheduler, proto
+from tornadio.conn import SocketConnection
+from tornadio.testing import SimulatedLoop
+
+def test_loop():
+    loop = SimulatedLoop(0)
+    calls = []
+
+    loop.add_timeout(10, lambda: calls.append(('a', loop.time())))
+    loop.remove_timeout(loop.add_timeout(5, lambda: calls.append('x')))
+    loop.add_timeout(5, lambda: loop.add_callback(lambda: calls.append('b')))
+    loop.add_timeout(5, lambda: calls.append('c'))
+
+    loop.advance(7)
+    eq_(calls, ['b', 'c'])
+    eq_(loop.time(), 7)
+
+    loop.advance(7)
+    eq_(calls, ['b', 'c', ('a', 10)])
+    eq_(loop.time(), 14)
+
+def test_session_expiry():
+    loop = SimulatedLoop()
+    container = session.SessionContainer(loop.time)
+
+    periodic.Callback(container.expire, 15000, loop).start()
+
+    items = [container.create(session.Session, 30, clock=loop.time)
+             for _ in xrange(10000)]
+
+    loop.advance(20)
+    for item in items[::2]:
+        item.promote()
+
+    loop.advance(25)
+    eq_(len(container._items), 5000)
+
+    loop.advance(30)
+    eq_(len(container._items), 0)
+
+class Protocol(object):
+    def __init__(self):
+        self.heartbeats = []
+        self.closed = False
+
+    def send_heartbeat(self, number):
+        self.heartbeats.append(number)
+
+    def close(self):
+        self.closed = True
+
+class Connection(SocketConnection):
+    def on_message(self, message):
+        pass
+
+def test_heartbeats():
+    loop = SimulatedLoop()
+
+    alive, dead = Protocol(), Protocol()
+    conns = [Connection(alive, loop, 12), Connection(dead, loop, 12)]
+
+    for conn in conns:
+        conn.reset_heartbeat()
+
+    # Only one of the clients replies to heartbeats
+    for _ in xrange(10):
+        loop.advance(12)
+
+        if alive.heartbeats:
+            conns[0].raw_message(proto.encode('~h~%d' % alive.heartbeats[-1]))
+
+    eq_(len(alive.heartbeats), 10)
+    assert not alive.closed
+
+    eq_(len(dead.heartbeats), 6)
+    assert dead.closed
+
+def test_scheduler():
+    loop = SimulatedLoop()
+    sched = scheduler.Scheduler(loop, 0.5)
+
+    fired = []
+    for i in xrange(1000):
+        sched.add(loop.time() + i % 20, lambda i=i: fired.append(i))
+
+    loop.advance(10)
+    eq_(len(fired), 550)
+    eq_(sched.lag, 0.0)
+
+    loop.advance(10)
+    eq_(len(fired), 1000)
+    eq_(len(sched), 0)
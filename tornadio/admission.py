@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.admission
+    ~~~~~~~~~~~~~~~~~~
+
+    Token bucket based admission control for new sessions.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import logging
+
+from collections import deque
+
+from tornadio import eventloop
+
+class AdmissionControl(object):
+    """Limits rate of new sessions.
+
+    Up to `burst` handshakes are admitted right away, after that handshakes
+    are admitted at `rate` per second. Handshakes which can't be admitted
+    right away are queued (up to `queue_size` of them) and run once there is
+    capacity, so reconnecting clients are spread over time. If queue is
+    full, handshake is rejected. Handshakes which waited in the queue for
+    more than `queue_timeout` seconds are rejected as well.
+    """
+    def __init__(self, io_loop, rate, burst=None, queue_size=0,
+                 queue_timeout=None):
+        self.io_loop = eventloop.get_loop(io_loop)
+        self.clock = eventloop.get_clock(self.io_loop)
+        self.rate = float(rate)
+        self.burst = burst or max(self.rate, 1)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+
+        self.tokens = self.burst
+        self.updated = self.clock()
+        self.queue = deque()
+        self._timeout = None
+
+        # Statistics
+        self.admitted = 0
+        self.rejected = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def admit(self, callback, reject=None):
+        """Run `callback` now or later, when there is capacity for it.
+
+        Returns False if handshake was rejected right away. If queued
+        handshake times out, `reject` is called instead of `callback`.
+        """
+        now = self.clock()
+        self._refill(now)
+
+        if not self.queue and self.tokens >= 1:
+            self.tokens -= 1
+            self.admitted += 1
+            callback()
+            return True
+
+        if len(self.queue) >= self.queue_size:
+            self.rejected += 1
+            return False
+
+        self.queue.append((now, callback, reject))
+        self._schedule()
+        return True
+
+    @property
+    def queued(self):
+        """Number of handshakes waiting for admission"""
+        return len(self.queue)
+
+    def _schedule(self):
+        if self._timeout is None and self.queue:
+            deadline = self.updated + (1 - self.tokens) / self.rate
+
+            # Wake up to reject handshake which waited for too long
+            if self.queue_timeout is not None:
+                deadline = min(deadline, self.queue[0][0] + self.queue_timeout)
+
+            self._timeout = self.io_loop.add_timeout(deadline, self._drain)
+
+    def _expire(self, now):
+        # Queue is ordered by time, so expired handshakes are at its head
+        deadline = now - self.queue_timeout
+
+        while self.queue and self.queue[0][0] <= deadline:
+            _, _, reject = self.queue.popleft()
+            self.rejected += 1
+
+            if reject is not None:
+                self._run(reject)
+
+    def _run(self, callback):
+        try:
+            callback()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            logging.error('Error in queued handshake', exc_info=True)
+
+    def _drain(self):
+        self._timeout = None
+
+        now = self.clock()
+        self._refill(now)
+
+        if self.queue_timeout is not None:
+            self._expire(now)
+
+        while self.queue and self.tokens >= 1:
+            self.tokens -= 1
+            self.admitted += 1
+
+            _, callback, _ = self.queue.popleft()
+            self._run(callback)
+
+        self._schedule()
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.balance
+    ~~~~~~~~~~~~~~~~
+
+    Node load reporting and shedding of new sessions to less loaded peers.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import sys
+import time
+import socket
+import logging
+
+from urlparse import urlparse
+
+from tornado import ioloop, iostream
+from tornado.web import RequestHandler
+
+from tornadio import periodic, eventloop
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def memory_usage():
+    """Return resident memory of the process, in bytes, or None if it is
+    not known"""
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * resource.getpagesize()
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError, AttributeError):
+        pass
+
+    if resource is None:
+        return None
+
+    # Only peak usage is available
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin':
+        return rss
+
+    return rss * 1024
+
+class LoadMonitor(object):
+    """Tracks load of the node and of its peers.
+
+    Load is the highest ratio of live connection count, event loop lag
+    (`scheduler.lag` or how late periodic checks are) and resident memory
+    to their limits, so node with load of 1 or more is overloaded. Limits
+    which are None are not checked. Overloaded node stays overloaded until
+    its load drops below `recover`, so it does not flap around the limit.
+
+    Every `interval` seconds, load is sampled and load reports of `peers`
+    (base URLs, like `http://10.0.0.2:8001`) are fetched from
+    `report_path`, so new sessions can be sent to the least loaded one.
+    Use IP addresses for peers - host names are resolved synchronously.
+    """
+    def __init__(self, io_loop, registry, scheduler, max_connections=None,
+                 max_lag=None, max_memory=None, peers=(), interval=5,
+                 report_path='/socket.io-load', recover=0.9):
+        self.io_loop = eventloop.get_loop(io_loop)
+        self.clock = eventloop.get_clock(self.io_loop)
+        self.registry = registry
+        self.scheduler = scheduler
+
+        self.max_connections = max_connections
+        self.max_lag = max_lag
+        self.max_memory = max_memory
+
+        self.peers = list(peers)
+        self.interval = interval
+        self.report_path = report_path
+        self.recover = recover
+
+        # Peer reports are fetched with Tornado IOStream
+        if isinstance(io_loop, ioloop.IOLoop):
+            self._http_loop = io_loop
+        else:
+            self._http_loop = ioloop.IOLoop.instance()
+
+        self.memory = None
+        self.lag = 0.0
+        self.load = 0.0
+        self.overloaded = False
+
+        # Peer URL to (load, time when it was received)
+        self.peer_loads = {}
+
+        self._timer = None
+        self._last_check = None
+
+    @property
+    def enabled(self):
+        """Check if any of the limits is set"""
+        return (self.max_connections is not None
+                or self.max_lag is not None
+                or self.max_memory is not None)
+
+    def start(self):
+        self._last_check = self.clock()
+        self.sample()
+
+        self._timer = periodic.Callback(self._check,
+                                        self.interval * 1000,
+                                        self.io_loop)
+        self._timer.start()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def sample(self):
+        """Measure load of the node"""
+        self.memory = memory_usage()
+
+        ratios = [0.0]
+
+        if self.max_connections:
+            ratios.append(float(self.registry.connections)
+                          / self.max_connections)
+
+        if self.max_lag:
+            ratios.append(self.lag / self.max_lag)
+
+        if self.max_memory and self.memory is not None:
+            ratios.append(float(self.memory) / self.max_memory)
+
+        self.load = max(ratios)
+
+        if self.overloaded:
+            self.overloaded = self.load >= self.recover
+        else:
+            self.overloaded = self.load >= 1
+
+    def check(self):
+        """Check if node is overloaded. Connection count is compared with
+        the limit right away, so burst of new sessions between samples does
+        not go past it."""
+        if (not self.overloaded
+            and self.max_connections
+            and self.registry.connections >= self.max_connections):
+            self.sample()
+
+        return self.overloaded
+
+    def report(self):
+        """Return load report of the node"""
+        # Load is not sampled periodically if monitor was not started
+        if self._timer is None:
+            self.sample()
+
+        return dict(connections=self.registry.connections,
+                    lag=self.lag,
+                    memory=self.memory,
+                    load=self.load,
+                    overloaded=self.overloaded)
+
+    def update_peer(self, peer, load):
+        """Remember load of the peer. Load of None means peer is not
+        available."""
+        if load is None:
+            self.peer_loads.pop(peer, None)
+        else:
+            self.peer_loads[peer] = (load, self.clock())
+
+    def pick_peer(self):
+        """Return URL of the least loaded peer which is not overloaded and
+        is less loaded than this node, or None"""
+        expired = self.clock() - self.interval * 3
+
+        best = None
+        best_load = min(self.load, 1)
+
+        for peer, (load, updated) in self.peer_loads.iteritems():
+            if updated >= expired and load < best_load:
+                best = peer
+                best_load = load
+
+        return best
+
+    def _check(self):
+        # Scheduler only measures lag while it has timers, so measure how
+        # late this check is as well
+        now = self.clock()
+        late = max(0.0, now - self._last_check - self.interval)
+        self._last_check = now
+
+        self.lag = max(self.scheduler.lag, late)
+
+        self.sample()
+
+        for peer in self.peers:
+            fetch_load(self._http_loop,
+                       peer.rstrip('/') + self.report_path,
+                       lambda load, peer=peer: self.update_peer(peer, load),
+                       self.interval)
+
+def fetch_load(io_loop, url, callback, timeout=5):
+    """Fetch load report from `url` and call `callback` with the reported
+    load, or with None if it could not be fetched."""
+    parts = urlparse(url)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+
+    stream = iostream.IOStream(sock, io_loop)
+    state = dict(done=False, timeout=None)
+
+    def finish(load):
+        if state['done']:
+            return
+
+        state['done'] = True
+
+        if state['timeout'] is not None:
+            io_loop.remove_timeout(state['timeout'])
+
+        stream.close()
+
+        try:
+            callback(load)
+        except Exception:
+            logging.error('Error in load report callback', exc_info=True)
+
+    def on_connect():
+        stream.write('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' %
+                     (parts.path or '/', parts.netloc))
+        stream.read_until('\r\n\r\n', on_headers)
+
+    def on_headers(data):
+        lines = data.split('\r\n')
+
+        try:
+            status = lines[0].split()[1]
+
+            length = None
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+        except (IndexError, ValueError):
+            finish(None)
+            return
+
+        if status != '200' or not length:
+            finish(None)
+            return
+
+        stream.read_bytes(length, on_body)
+
+    def on_body(data):
+        try:
+            finish(float(json.loads(data)['load']))
+        except (ValueError, KeyError, TypeError):
+            finish(None)
+
+    stream.set_close_callback(lambda: finish(None))
+    state['timeout'] = io_loop.add_timeout(time.time() + timeout,
+                                           lambda: finish(None))
+
+    try:
+        stream.connect((parts.hostname, parts.port or 80), on_connect)
+    except socket.error:
+        finish(None)
+
+class LoadReportHandler(RequestHandler):
+    """Serves load report of the node as JSON, so peers can fetch it"""
+    def initialize(self, monitor):
+        self.monitor = monitor
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(json.dumps(self.monitor.report()))
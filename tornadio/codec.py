@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.codec
+    ~~~~~~~~~~~~~~
+
+    Compact payload codecs, negotiated per connection.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import struct
+import decimal
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class Codec(object):
+    """Payload codec. Non-string messages are sent to the clients which
+    negotiated the codec as `~b~` messages with payload encoded by `dumps`
+    instead of JSON.
+
+    Derive from this class and `register` it to add your own codec.
+    """
+    # Name client uses to ask for the codec
+    name = None
+
+    def dumps(self, message):
+        """Encode message to byte string"""
+        raise NotImplementedError()
+
+    def loads(self, data):
+        """Decode message from byte string. Raises ValueError if data is
+        invalid."""
+        raise NotImplementedError()
+
+def _default(obj):
+    # Decimals are sent as floats, same as with JSON
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+
+    raise TypeError('Can not pack %r' % obj)
+
+def _pack_text(data, out):
+    size = len(data)
+
+    if size < 0x20:
+        out.append(chr(0xa0 | size))
+    elif size <= 0xff:
+        out.append(struct.pack('>BB', 0xd9, size))
+    elif size <= 0xffff:
+        out.append(struct.pack('>BH', 0xda, size))
+    else:
+        out.append(struct.pack('>BI', 0xdb, size))
+
+    out.append(data)
+
+def _pack_bytes(data, out):
+    size = len(data)
+
+    if size <= 0xff:
+        out.append(struct.pack('>BB', 0xc4, size))
+    elif size <= 0xffff:
+        out.append(struct.pack('>BH', 0xc5, size))
+    else:
+        out.append(struct.pack('>BI', 0xc6, size))
+
+    out.append(data)
+
+def _pack(obj, out):
+    if obj is None:
+        out.append('\xc0')
+    elif obj is True:
+        out.append('\xc3')
+    elif obj is False:
+        out.append('\xc2')
+    elif isinstance(obj, (int, long)):
+        if 0 <= obj < 0x80:
+            out.append(chr(obj))
+        elif -0x20 <= obj < 0:
+            out.append(struct.pack('b', obj))
+        elif 0 <= obj <= 0xff:
+            out.append(struct.pack('>BB', 0xcc, obj))
+        elif 0 <= obj <= 0xffff:
+            out.append(struct.pack('>BH', 0xcd, obj))
+        elif 0 <= obj <= 0xffffffff:
+            out.append(struct.pack('>BI', 0xce, obj))
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out.append(struct.pack('>BQ', 0xcf, obj))
+        elif -0x80 <= obj < 0:
+            out.append(struct.pack('>Bb', 0xd0, obj))
+        elif -0x8000 <= obj < 0:
+            out.append(struct.pack('>Bh', 0xd1, obj))
+        elif -0x80000000 <= obj < 0:
+            out.append(struct.pack('>Bi', 0xd2, obj))
+        elif -0x8000000000000000 <= obj < 0:
+            out.append(struct.pack('>Bq', 0xd3, obj))
+        else:
+            raise ValueError('Integer %d is too big to pack' % obj)
+    elif isinstance(obj, float):
+        out.append(struct.pack('>Bd', 0xcb, obj))
+    elif isinstance(obj, unicode):
+        _pack_text(obj.encode('utf-8'), out)
+    elif isinstance(obj, str):
+        # Byte strings are text, same as with JSON, unless they are not
+        # valid UTF-8
+        try:
+            obj.decode('utf-8')
+        except UnicodeDecodeError:
+            _pack_bytes(obj, out)
+        else:
+            _pack_text(obj, out)
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+
+        if size < 0x10:
+            out.append(chr(0x90 | size))
+        elif size <= 0xffff:
+            out.append(struct.pack('>BH', 0xdc, size))
+        else:
+            out.append(struct.pack('>BI', 0xdd, size))
+
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        size = len(obj)
+
+        if size < 0x10:
+            out.append(chr(0x80 | size))
+        elif size <= 0xffff:
+            out.append(struct.pack('>BH', 0xde, size))
+        else:
+            out.append(struct.pack('>BI', 0xdf, size))
+
+        for key, value in obj.iteritems():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        _pack(_default(obj), out)
+
+def pack(obj):
+    """Pack object to the MessagePack format.
+
+    Unicode and UTF-8 byte strings are packed as strings, other byte
+    strings as binary data.
+    """
+    out = []
+    _pack(obj, out)
+    return ''.join(out)
+
+# Fixed size types: code -> (struct format, size)
+_FIXED = {
+    0xca: ('>f', 4),
+    0xcb: ('>d', 8),
+    0xcc: ('>B', 1),
+    0xcd: ('>H', 2),
+    0xce: ('>I', 4),
+    0xcf: ('>Q', 8),
+    0xd0: ('>b', 1),
+    0xd1: ('>h', 2),
+    0xd2: ('>i', 4),
+    0xd3: ('>q', 8),
+    }
+
+# Types with length prefix: code -> (length format, length size, kind)
+_SIZED = {
+    0xc4: ('>B', 1, 'bin'),
+    0xc5: ('>H', 2, 'bin'),
+    0xc6: ('>I', 4, 'bin'),
+    0xd9: ('>B', 1, 'str'),
+    0xda: ('>H', 2, 'str'),
+    0xdb: ('>I', 4, 'str'),
+    0xdc: ('>H', 2, 'array'),
+    0xdd: ('>I', 4, 'array'),
+    0xde: ('>H', 2, 'map'),
+    0xdf: ('>I', 4, 'map'),
+    }
+
+def _read(data, idx, size):
+    end = idx + size
+
+    if end > len(data):
+        raise ValueError('Truncated MessagePack data')
+
+    return data[idx:end], end
+
+# Maximum nesting of arrays and maps in unpacked data
+MAX_DEPTH = 64
+
+def _unpack(data, idx, depth=0):
+    code, idx = _read(data, idx, 1)
+    code = ord(code)
+
+    if code < 0x80:
+        return code, idx
+    elif code >= 0xe0:
+        return code - 0x100, idx
+    elif code < 0x90:
+        kind, size = 'map', code & 0x0f
+    elif code < 0xa0:
+        kind, size = 'array', code & 0x0f
+    elif code < 0xc0:
+        kind, size = 'str', code & 0x1f
+    elif code == 0xc0:
+        return None, idx
+    elif code == 0xc2:
+        return False, idx
+    elif code == 0xc3:
+        return True, idx
+    elif code in _FIXED:
+        fmt, size = _FIXED[code]
+        value, idx = _read(data, idx, size)
+        return struct.unpack(fmt, value)[0], idx
+    elif code in _SIZED:
+        fmt, size, kind = _SIZED[code]
+        value, idx = _read(data, idx, size)
+        size = struct.unpack(fmt, value)[0]
+    else:
+        raise ValueError('Unsupported MessagePack type 0x%x' % code)
+
+    if kind in ('array', 'map'):
+        depth += 1
+
+        if depth > MAX_DEPTH:
+            raise ValueError('MessagePack data is nested too deep')
+
+    if kind == 'bin':
+        return _read(data, idx, size)
+    elif kind == 'str':
+        value, idx = _read(data, idx, size)
+        return value.decode('utf-8'), idx
+    elif kind == 'array':
+        items = []
+        for _ in xrange(size):
+            item, idx = _unpack(data, idx, depth)
+            items.append(item)
+        return items, idx
+    else:
+        items = {}
+        for _ in xrange(size):
+            key, idx = _unpack(data, idx, depth)
+            value, idx = _unpack(data, idx, depth)
+
+            try:
+                items[key] = value
+            except TypeError:
+                raise ValueError('Unhashable MessagePack map key')
+        return items, idx
+
+def unpack(data):
+    """Unpack object from the MessagePack format. Raises ValueError if
+    data is invalid or nested deeper than `MAX_DEPTH`."""
+    obj, idx = _unpack(data, 0)
+
+    if idx != len(data):
+        raise ValueError('Extra data after MessagePack object')
+
+    return obj
+
+class MsgPackCodec(Codec):
+    """MessagePack codec. Uses `msgpack` package if it is installed,
+    bundled implementation otherwise.
+
+    Strings are packed as MessagePack strings, so clients receive same
+    values as with JSON.
+    """
+    name = 'msgpack'
+
+    def dumps(self, message):
+        if msgpack is not None:
+            return msgpack.packb(message, use_bin_type=False,
+                                 default=_default)
+
+        return pack(message)
+
+    def loads(self, data):
+        if msgpack is not None:
+            # Same as bundled implementation, invalid data raises ValueError
+            try:
+                return msgpack.unpackb(data, raw=False)
+            except ValueError:
+                raise
+            except Exception, ex:
+                raise ValueError('Invalid MessagePack data: %s' % ex)
+
+        return unpack(data)
+
+# Available codecs by name
+CODECS = {}
+
+def register(codec):
+    """Make codec available for negotiation"""
+    CODECS[codec.name] = codec
+
+register(MsgPackCodec())
+
+def negotiate(name, enabled):
+    """Return codec client asked for, if it is available and listed in
+    `enabled` names. Returns None otherwise."""
+    if name is None or name not in enabled:
+        return None
+
+    return CODECS.get(name)
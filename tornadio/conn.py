@@ -8,9 +8,14 @@
     :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
     :license: Apache, see LICENSE for more details.
 """
-import logging, time
+import sys, logging, zlib, weakref
 
-from tornadio import proto, periodic
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from tornadio import proto, periodic, outbound, eventloop
 
 class SocketConnection(object):
     """This class represents basic connection class that you will derive
@@ -19,8 +24,14 @@ class SocketConnection(object):
     You can override following methods:
 
     1. on_open, called on incoming client connection
-    2. on_message, called on incoming client message. Required.
+    2. on_message, called on incoming client message. Required, unless
+    on_messages is overridden
     3. on_close, called when connection was closed due to error or timeout
+    4. on_congested, called when client does not keep up with outgoing data
+    5. on_drained, called when congested client caught up
+    6. on_messages, called with all messages received in one transport read
+    7. on_restore, called instead of on_open when polling session was
+    restored from the snapshot saved by another process
 
     For example:
 
@@ -33,20 +44,61 @@ class SocketConnection(object):
 
             def on_close(self):
                 print 'Client disconnected'
+
+    Set `lazy_json` to True to receive JSON messages as `proto.LazyJSON`
+    objects, which are only parsed when their `value` is accessed. Useful
+    if messages are mostly forwarded somewhere as is.
+
+    Set `adaptive_heartbeat` to True to adapt heartbeat interval to the
+    connection: it grows up to `heartbeat_max_interval` seconds while client
+    answers heartbeats or sends data (no heartbeat is sent if client sent
+    something since last one) and shrinks down to `heartbeat_min_interval`
+    seconds when heartbeats are missed. Only use it if your client-side does
+    not depend on receiving heartbeats.
+
+    Round trip time, measured with heartbeats, is available as `rtt`.
+
+    Use `register` to index connection in the router registry by your own
+    keys, so it can be found or messaged with `router.registry.send_to`.
+
+    Set `hibernate_after` to put connections which did not receive any
+    message for that many seconds to hibernation: attributes listed in
+    `hibernate_attrs` are pickled, compressed and released, heartbeat timer
+    is replaced with a lightweight one on the router scheduler and only a
+    weak reference to the transport protocol is kept.
+    State is restored on the next incoming message, when any of the saved
+    attributes is accessed or when `wake` is called.
+
+    Same attributes are saved with the polling session when sessions are
+    moved to another process with `router.save_sessions`.
     """
+    lazy_json = False
+
+    # Adaptive heartbeats
+    adaptive_heartbeat = False
+    heartbeat_min_interval = 5
+    heartbeat_max_interval = 60
+
+    # Hibernation
+    hibernate_after = None
+    hibernate_attrs = ()
+
     def __init__(self, protocol, io_loop, heartbeat_interval):
         """Default constructor.
 
         `protocol`
             Transport protocol implementation object.
         `io_loop`
-            Tornado IOLoop instance
+            Tornado IOLoop or other loop with the same timer methods,
+            like `testing.SimulatedLoop`
         `heartbeat_interval`
             Heartbeat interval for this connection, in seconds.
         """
         self._protocol = protocol
+        self._registry = None
 
-        self._io_loop = io_loop
+        self._io_loop = eventloop.get_loop(io_loop)
+        self._clock = eventloop.get_clock(self._io_loop)
 
         # Initialize heartbeats
         self._heartbeat_timer = None
@@ -54,6 +106,22 @@ class SocketConnection(object):
         self._missed_heartbeats = 0
         self._heartbeat_delay = None
         self._heartbeat_interval = heartbeat_interval * 1000
+        self._pending_heartbeats = {}
+        self._last_received = None
+
+        # Hibernation state. Timer checks for inactivity while connection
+        # is awake and sends heartbeats while it is hibernating.
+        self._scheduler = None
+        self._last_active = self._clock()
+        self._hibernated = None
+        self._hibernate_timeout = None
+
+        if self.hibernate_after is not None:
+            self._schedule_hibernation()
+
+        # Smoothed round trip time and its variation, in seconds
+        self.rtt = None
+        self.rtt_var = None
 
         # Connection is not closed right after creation
         self.is_closed = False
@@ -66,17 +134,79 @@ class SocketConnection(object):
         """Default on_message handler. Must be overridden"""
         raise NotImplementedError()
 
+    def on_messages(self, messages):
+        """Called with list of all messages received from the client in
+        one transport read (POST request or websocket frame). Override it
+        to handle messages in batch, for example with one bulk insert.
+
+        If it is not overridden, messages are passed to `on_message` as
+        they are decoded.
+        """
+        for message in messages:
+            self.on_message(message)
+
     def on_close(self):
         """Default on_close handler."""
         pass
 
-    def send(self, message):
+    def on_restore(self):
+        """Called when connection was restored from the session snapshot,
+        after attributes returned by `hibernate_state` were set back."""
+        pass
+
+    def on_congested(self):
+        """Called when amount of data buffered for the client went above
+        high watermark. Depending on `write_buffer_policy` setting, outgoing
+        messages will be dropped, conflated or connection will be closed."""
+        pass
+
+    def on_drained(self):
+        """Called when buffered data of the congested connection went below
+        low watermark."""
+        pass
+
+    @property
+    def buffered_bytes(self):
+        """Amount of data, in bytes, waiting to be sent to the client"""
+        return getattr(self._protocol, 'buffered_bytes', 0)
+
+    @property
+    def codec(self):
+        """Payload codec negotiated with the client, if any"""
+        return getattr(self._protocol, 'codec', None)
+
+    @property
+    def binary(self):
+        """Check if codec payloads are sent in binary websocket frames"""
+        return getattr(self._protocol, 'binary', False)
+
+    def send(self, message, priority=outbound.NORMAL):
         """Send message to the client.
 
         `message`
             Message to send.
+        `priority`
+            Message priority, one of `outbound.CONTROL`, `outbound.HIGH`,
+            `outbound.NORMAL` or `outbound.BULK`. Higher priority messages
+            overtake queued lower priority ones, bulk messages are paced.
         """
-        self._protocol.send(message)
+        self._protocol.send(message, priority)
+
+    def send_conflated(self, key, message):
+        """Send message to the client, replacing any not yet sent message
+        with the same key.
+
+        If client is not ready to receive data (there is no on going polling
+        request or websocket is congested), only the most recent message for
+        each key is kept. Use it for data where only the latest value
+        matters, like price updates.
+
+        `key`
+            Message key, any hashable value.
+        `message`
+            Message to send.
+        """
+        self._protocol.send_conflated(key, message)
 
     def close(self):
         """Focibly close client connection.
@@ -84,25 +214,307 @@ class SocketConnection(object):
         self.stop_heartbeat()
         self._protocol.close()
 
-    def raw_message(self, message):
+    def set_registry(self, registry):
+        """Attach connection to the router registry. Called by transports
+        once connection was created, so subclasses can keep the
+        constructor signature."""
+        self._registry = registry
+        registry.connections += 1
+
+    def set_scheduler(self, scheduler):
+        """Use shared router scheduler for hibernation timers. Called by
+        transports once connection was created."""
+        pending = self._hibernate_timeout is not None
+        if pending:
+            self._remove_timer(self._hibernate_timeout)
+            self._hibernate_timeout = None
+
+        self._scheduler = scheduler
+
+        if pending:
+            self._schedule_hibernation()
+
+    def register(self, *keys):
+        """Register connection in the router registry under given keys"""
+        if self._registry is None:
+            raise ValueError('Connection is not attached to a registry')
+
+        self._registry.add(self, *keys)
+
+    def unregister(self, *keys):
+        """Remove connection from given registry keys or, if no keys were
+        passed, from the registry"""
+        if self._registry is None:
+            raise ValueError('Connection is not attached to a registry')
+
+        self._registry.remove(self, *keys)
+
+    def registry_keys(self):
+        """Return set of keys connection is registered under"""
+        if self._registry is None:
+            return set()
+
+        return self._registry.keys_of(self)
+
+    def handle_close(self):
+        """Called by transport protocol when connection was closed. Notifies
+        application and removes connection from the registry."""
+        try:
+            self.on_close()
+        finally:
+            self._set_closed()
+
+    def _set_closed(self):
+        if self.is_closed:
+            return
+
+        self.is_closed = True
+
+        if self._hibernate_timeout is not None:
+            self._remove_timer(self._hibernate_timeout)
+            self._hibernate_timeout = None
+
+        if self._registry is not None:
+            self._registry.connections -= 1
+            self._registry.remove(self)
+
+    def detach(self):
+        """Mark connection as closed without notifying application. Used
+        when connection was moved to another process."""
+        self.stop_heartbeat()
+        self._set_closed()
+
+    def raw_message(self, message, max_size=None, binary=False):
         """Called when raw message was received by underlying transport protocol
+
+        Messages are passed to `on_message` as they are decoded or, if
+        `on_messages` was overridden, to `on_messages` at once. If
+        `max_size` is set, `proto.MessageTooBig` is raised once message
+        larger than `max_size` bytes is encountered. `binary` is True for
+        websocket binary frames, their codec payloads are not
+        base64-encoded.
         """
-        for msg in proto.decode(message):
-            if msg[0] == proto.FRAME or msg[0] == proto.JSON:
-                self.on_message(msg[1])
-            elif msg[0] == proto.HEARTBEAT:
-                # TODO: Verify incoming heartbeats
-                logging.debug('Incoming Heartbeat')
-                self._missed_heartbeats -= 1
+        self._last_received = self._clock()
+
+        # Messages are collected only if on_messages was overridden
+        batch = None
+        if type(self).on_messages != SocketConnection.on_messages:
+            batch = []
+
+        try:
+            for msg in proto.iterdecode(message, self.lazy_json, max_size,
+                                        self.codec, binary):
+                if msg[0] in (proto.FRAME, proto.JSON, proto.BINARY):
+                    self._last_active = self._last_received
+                    self.wake()
+
+                    if batch is None:
+                        self.on_message(msg[1])
+                    else:
+                        batch.append(msg[1])
+                elif msg[0] == proto.HEARTBEAT:
+                    self.heartbeat_received(msg[1])
+        except:
+            exc_info = sys.exc_info()
+
+            # Messages decoded before the bad one are still delivered, but
+            # decoding error is what caller gets
+            if batch:
+                try:
+                    self.on_messages(batch)
+                except:
+                    logging.error('Error in on_messages', exc_info=True)
+
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        if batch:
+            self.on_messages(batch)
+
+    # Hibernation
+    @property
+    def is_hibernating(self):
+        """Check if connection is hibernating"""
+        return self._hibernated is not None
+
+    def hibernate_state(self):
+        """Return dictionary of attributes which are released while
+        connection is hibernating. Must be picklable.
+
+        Default implementation returns attributes listed in
+        `hibernate_attrs`.
+        """
+        attrs = self.__dict__
+
+        return dict((name, attrs[name])
+                    for name in self.hibernate_attrs
+                    if name in attrs)
+
+    def restore_state(self, state):
+        """Restore attributes returned by `hibernate_state`"""
+        self.__dict__.update(state)
+
+    def hibernate(self):
+        """Serialize and release application state.
+
+        Returns False if connection can't be put to hibernation.
+        """
+        if self._hibernated is not None or self.is_closed:
+            return False
+
+        state = self.hibernate_state()
+
+        try:
+            data = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            logging.debug('Failed to hibernate connection', exc_info=True)
+            return False
+
+        # Heartbeat timer is restarted with the same interval on wake.
+        # Meanwhile, heartbeats are sent from the scheduler, so dead peers
+        # are still detected.
+        timer = self._heartbeat_timer
+        if timer is not None:
+            timer.stop()
+
+        if self._hibernate_timeout is not None:
+            self._remove_timer(self._hibernate_timeout)
+            self._hibernate_timeout = None
+
+        # Rebuild attribute dictionary, so it does not keep space for the
+        # released attributes. Transport keeps protocol alive while the
+        # connection is open, so weak reference is enough.
+        attrs = self.__dict__
+        self.__dict__ = dict((name, value)
+                             for name, value in attrs.iteritems()
+                             if name not in state and name != '_protocol')
+        self._protocol_ref = weakref.ref(attrs['_protocol'])
+        self._heartbeat_timer = None
+        self._heartbeat_paused = timer is not None
+        self._hibernated = data
+        self._hibernated_attrs = tuple(state)
+
+        if self._heartbeat_paused:
+            self._schedule_heartbeat()
+
+        return True
+
+    def wake(self):
+        """Restore state of the hibernating connection"""
+        attrs = self.__dict__
+        data = attrs.get('_hibernated')
+
+        if data is None:
+            return
+
+        protocol = attrs.pop('_protocol_ref')()
+        if protocol is not None:
+            self._protocol = protocol
+
+        paused = attrs.pop('_heartbeat_paused')
+        del self._hibernated_attrs
+        self._hibernated = None
+
+        if self._hibernate_timeout is not None:
+            self._remove_timer(self._hibernate_timeout)
+            self._hibernate_timeout = None
+
+        self.restore_state(pickle.loads(zlib.decompress(data)))
+
+        if paused and not self.is_closed:
+            self.reset_heartbeat()
+
+        # Woken connection is kept awake for another `hibernate_after`
+        # seconds
+        if self.hibernate_after is not None and not self.is_closed:
+            self._last_active = self._clock()
+            self._schedule_hibernation()
+
+    def __getattr__(self, name):
+        # Only called for missing attributes - they might be released by
+        # hibernation. Other probes (hasattr and such) do not wake
+        # connection up.
+        attrs = self.__dict__
+
+        if attrs.get('_hibernated') is not None:
+            if name == '_protocol':
+                protocol = attrs['_protocol_ref']()
+                if protocol is not None:
+                    return protocol
+            elif name in attrs['_hibernated_attrs']:
+                self.wake()
+                return getattr(self, name)
+
+        raise AttributeError(name)
+
+    def _add_timer(self, deadline, callback):
+        if self._scheduler is not None:
+            return self._scheduler.add(deadline, callback)
+
+        return self._io_loop.add_timeout(deadline, callback)
+
+    def _remove_timer(self, timer):
+        if self._scheduler is not None:
+            self._scheduler.remove(timer)
+        else:
+            self._io_loop.remove_timeout(timer)
+
+    def _schedule_hibernation(self):
+        if self._hibernate_timeout is not None:
+            self._remove_timer(self._hibernate_timeout)
+
+        self._hibernate_timeout = self._add_timer(
+            self._last_active + self.hibernate_after, self._check_hibernation)
+
+    def _schedule_heartbeat(self, deadline=None):
+        if deadline is None:
+            deadline = (self._clock() +
+                        self._heartbeat_interval / 1000.0)
+
+        self._hibernate_timeout = self._add_timer(deadline,
+                                                  self._hibernated_heartbeat)
+
+    def _hibernated_heartbeat(self):
+        self._hibernate_timeout = None
+
+        if self.is_closed or self._hibernated is None:
+            return
+
+        delay = self._heartbeat()
+
+        # Heartbeats are stopped once connection is closed
+        if (self._hibernated is not None and self._heartbeat_paused
+            and self._hibernate_timeout is None):
+            self._schedule_heartbeat(delay)
+
+    def _check_hibernation(self):
+        self._hibernate_timeout = None
+
+        if self.is_closed or self._hibernated is not None:
+            return
+
+        # Reschedule if connection was active meanwhile
+        if self._clock() - self._last_active < self.hibernate_after:
+            self._schedule_hibernation()
+        else:
+            self.hibernate()
 
     # Heartbeat management
     def reset_heartbeat(self, interval=None):
-        """Reset (stop/start) heartbeat timeout"""
+        """Reset (stop/start) heartbeat timeout. Unless `interval` (in
+        milliseconds) is passed, last used interval is kept, including the
+        adapted one."""
         self.stop_heartbeat()
 
-        # TODO: Configurable heartbeats
         if interval is None:
             interval = self._heartbeat_interval
+        else:
+            self._heartbeat_interval = interval
+
+        # Hibernating connection sends heartbeats from the scheduler
+        if self._hibernated is not None:
+            self._heartbeat_paused = True
+            self._schedule_heartbeat()
+            return
 
         self._heartbeat_timer = periodic.Callback(self._heartbeat,
                                                   interval,
@@ -115,25 +527,108 @@ class SocketConnection(object):
             self._heartbeat_timer.stop()
             self._heartbeat_timer = None
 
+        if self._hibernated is not None:
+            self._heartbeat_paused = False
+
+            if self._hibernate_timeout is not None:
+                self._remove_timer(self._hibernate_timeout)
+                self._hibernate_timeout = None
+
     def delay_heartbeat(self):
         """Delay heartbeat sending"""
         if self._heartbeat_timer is not None:
             self._heartbeat_delay = self._heartbeat_timer.calculate_next_run()
 
     def send_heartbeat(self):
-        """Send heartbeat message to the client"""
+        """Send heartbeat message to the client.
+
+        Round trip time is only measured with heartbeats which protocol wrote
+        to the client right away. Queued ones, like heartbeats waiting for
+        the next poll, would include the time they spent in the queue.
+        """
         self._heartbeats += 1
         self._missed_heartbeats += 1
-        self.send('~h~%d' % self._heartbeats)
+
+        now = self._clock()
+        if self._protocol.send_heartbeat(self._heartbeats):
+            self._pending_heartbeats[self._heartbeats] = now
+        else:
+            self._pending_heartbeats[self._heartbeats] = None
+
+    def heartbeat_received(self, data):
+        """Called when client replied to the heartbeat, either with the
+        `~h~` message or with the websocket pong frame."""
+        try:
+            number = int(data)
+        except (TypeError, ValueError):
+            number = None
+
+        if number not in self._pending_heartbeats:
+            logging.debug('Unexpected heartbeat %r', data)
+            return
+
+        sent = self._pending_heartbeats.pop(number)
+
+        logging.debug('Incoming Heartbeat')
+
+        # Reply to the later heartbeat means client is alive
+        for pending in self._pending_heartbeats.keys():
+            if pending < number:
+                del self._pending_heartbeats[pending]
+
+        self._missed_heartbeats = len(self._pending_heartbeats)
+
+        if sent is not None:
+            self._update_rtt(self._clock() - sent)
+
+    def _update_rtt(self, sample):
+        """Update smoothed round trip time (RFC 6298)"""
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            self.rtt_var = 0.75 * self.rtt_var + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+    def _adapt_heartbeat(self, now):
+        """Change heartbeat interval depending on how connection behaves.
+
+        Returns True if client proved it is alive since the last heartbeat.
+        """
+        interval = self._heartbeat_interval
+
+        alive = (self._last_received is not None
+                 and now - self._last_received < interval / 1000.0)
+
+        if alive:
+            self._pending_heartbeats.clear()
+            self._missed_heartbeats = 0
+
+        if self._missed_heartbeats:
+            interval = max(self.heartbeat_min_interval * 1000, interval / 2)
+        else:
+            interval = min(self.heartbeat_max_interval * 1000, interval * 1.5)
+
+        self._heartbeat_interval = interval
+
+        if self._heartbeat_timer is not None:
+            self._heartbeat_timer.callback_time = interval
+
+        return alive
 
     def _heartbeat(self):
         """Heartbeat callback. Sends heartbeat to the client."""
+        now = self._clock()
+
         if (self._heartbeat_delay is not None
-            and time.time() < self._heartbeat_delay):
+            and now < self._heartbeat_delay):
             delay = self._heartbeat_delay
             self._heartbeat_delay = None
             return delay
 
+        if self.adaptive_heartbeat and self._adapt_heartbeat(now):
+            return
+
         logging.debug('Sending heartbeat')
 
         if self._missed_heartbeats > 5:
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.eventloop
+    ~~~~~~~~~~~~~~~~~~
+
+    Event loop helpers. Timers and callbacks of the tornadio internals
+    (heartbeats, session expiration, scheduler, admission control, etc)
+    only use `add_timeout`, `remove_timeout` and `add_callback` of the
+    Tornado IOLoop, so any object with these methods and `time()`, like
+    `testing.SimulatedLoop`, can be used instead.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import time
+
+from tornado import ioloop
+
+def get_loop(loop=None):
+    """Return `loop` or, if it is not set, Tornado IOLoop instance"""
+    # Simulated loop defines __len__, so idle one is false
+    if loop is None:
+        return ioloop.IOLoop.instance()
+
+    return loop
+
+def get_clock(loop):
+    """Return function which returns current time of the `loop`. Tornado
+    IOLoop schedules by `time.time()`."""
+    return getattr(loop, 'time', time.time)
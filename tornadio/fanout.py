@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.fanout
+    ~~~~~~~~~~~~~~~
+
+    Cooperative delivery of large broadcasts in time-budgeted slices.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import logging
+
+from collections import deque
+
+from tornadio import proto, outbound, eventloop
+
+class Broadcast(object):
+    """Delivery of one message to many connections. Returned by
+    `FanOut.send`, can be used to watch progress or to cancel it."""
+    def __init__(self, targets, message, priority, callback, started):
+        self.message = message
+        self.priority = priority
+        self.callback = callback
+
+        self._targets = targets
+        self._pos = 0
+
+        # Number of connections message is sent to
+        self.total = len(targets)
+        # Number of connections which received the message
+        self.sent = 0
+        # Number of connections which were closed or failed
+        self.skipped = 0
+
+        self.started = started
+        self.finished = None
+        self.cancelled = False
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    @property
+    def remaining(self):
+        """Number of connections which were not processed yet"""
+        return self.total - self._pos
+
+    @property
+    def progress(self):
+        """Processed share of the connections, from 0 to 1"""
+        if not self.total:
+            return 1.0
+
+        return float(self._pos) / self.total
+
+    @property
+    def duration(self):
+        """Time it took to deliver the broadcast, in seconds, or None if it
+        is not finished yet"""
+        if self.finished is None:
+            return None
+
+        return self.finished - self.started
+
+    def cancel(self):
+        """Stop delivery. Connections which already received the message
+        are not affected."""
+        self.cancelled = True
+
+    def deliver(self, count):
+        """Send message to up to `count` next connections. Returns True if
+        there are no connections left."""
+        end = min(self._pos + count, self.total)
+
+        message = self.message
+        priority = self.priority
+
+        for idx in xrange(self._pos, end):
+            conn = self._targets[idx]
+
+            if conn.is_closed:
+                self.skipped += 1
+                continue
+
+            try:
+                conn.send(message.get(conn.codec, conn.binary), priority)
+                self.sent += 1
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logging.error('Error sending broadcast message',
+                              exc_info=True)
+                self.skipped += 1
+
+        self._pos = end
+
+        return end >= self.total
+
+class FanOut(object):
+    """Sends messages to many connections without blocking the IOLoop.
+
+    Sending to tens of thousands of connections in one go keeps IOLoop
+    busy for long time, so heartbeats, polling requests and incoming
+    messages of everyone else wait. Broadcasts are delivered by slices
+    instead: each IOLoop iteration sends messages for at most `budget`
+    seconds and continues on the next iteration, once pending I/O was
+    handled. Time is checked after every chunk, so slice may run over
+    the budget by one chunk.
+
+    Concurrent broadcasts take turns, `chunk_size` connections at a time,
+    so big broadcast does not hold back smaller ones started after it.
+
+    Every router has one, available as `router.fanout`.
+    """
+    def __init__(self, io_loop, budget=0.01, chunk_size=100):
+        self.io_loop = eventloop.get_loop(io_loop)
+        self.clock = eventloop.get_clock(self.io_loop)
+        self.budget = budget
+        self.chunk_size = chunk_size
+
+        self._queue = deque()
+        self._scheduled = False
+
+        # Number of finished broadcasts
+        self.completed = 0
+        # Number of slices run
+        self.slices = 0
+        # Longest slice, in seconds
+        self.max_slice = 0.0
+
+    def __len__(self):
+        """Number of broadcasts in progress"""
+        return len(self._queue)
+
+    @property
+    def pending(self):
+        """Number of connections waiting for broadcast messages"""
+        return sum(b.remaining for b in self._queue)
+
+    def send(self, targets, message, priority=outbound.NORMAL,
+             callback=None):
+        """Send message to the connections.
+
+        `targets`
+            Iterable of connections. Connections which are closed by the
+            time their turn comes are skipped.
+        `message`
+            Message to send. It is encoded once for each payload codec
+            connections use.
+        `priority`
+            Message priority, see `SocketConnection.send`.
+        `callback`
+            Called with the `Broadcast` once it is delivered or cancelled.
+
+        Delivery starts on the next IOLoop iteration, so messages sent to
+        connections directly may arrive before the broadcast.
+        """
+        broadcast = Broadcast(list(targets),
+                              proto.Prepared(message),
+                              priority,
+                              callback,
+                              self.clock())
+
+        self._queue.append(broadcast)
+        self._schedule()
+
+        return broadcast
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            self.io_loop.add_callback(self._run)
+
+    def _run(self):
+        self._scheduled = False
+
+        queue = self._queue
+
+        start = now = self.clock()
+        deadline = start + self.budget
+
+        # At least one chunk is sent, so broadcasts progress even if
+        # budget is too small
+        while queue:
+            broadcast = queue.popleft()
+
+            if broadcast.cancelled or broadcast.deliver(self.chunk_size):
+                self._finish(broadcast)
+            else:
+                queue.append(broadcast)
+
+            now = self.clock()
+
+            if now >= deadline:
+                break
+
+        self.slices += 1
+        self.max_slice = max(self.max_slice, now - start)
+
+        if queue:
+            self._schedule()
+
+    def _finish(self, broadcast):
+        broadcast.finished = self.clock()
+        broadcast._targets = None
+
+        self.completed += 1
+
+        if broadcast.callback is not None:
+            try:
+                broadcast.callback(broadcast)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logging.error('Error in broadcast callback', exc_info=True)
@@ -11,29 +11,91 @@
 """
 from __future__ import with_statement
 
+import os
+import sys
+import time
 import socket
 import errno
+import logging
 import functools
 
 from tornado import iostream
 
+POLICY_REQUEST = '<policy-file-request/>'
+
+# Python 2 does not expose SO_REUSEPORT, even if platform supports it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
 class FlashPolicyServer(object):
     """Flash Policy server, listens on port 843 by default (useless otherwise)
+
+    Policy file is read once and cached in memory. It is reloaded when
+    `reload` is called or when file modification time changes (checked not
+    more often than once per `check_interval` seconds).
     """
-    def __init__(self, io_loop, port=843, policy_file='flashpolicy.xml'):
+    def __init__(self, io_loop, port=843, policy_file='flashpolicy.xml',
+                 max_connections=1024, read_timeout=5, check_interval=5,
+                 reuse_port=False):
         self.policy_file = policy_file
         self.port = port
+        self.max_connections = max_connections
+        self.read_timeout = read_timeout
+        self.check_interval = check_interval
+
+        self._policy = None
+        self._policy_mtime = None
+        self._policy_checked = 0
+        self._connections = 0
+
+        self.reload()
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            if SO_REUSEPORT is None:
+                raise ValueError('SO_REUSEPORT is not supported on this '
+                                 'platform')
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         sock.setblocking(0)
         sock.bind(('', self.port))
         sock.listen(128)
 
         self.io_loop = io_loop
+        self._socket = sock
         callback = functools.partial(self.connection_ready, sock)
         self.io_loop.add_handler(sock.fileno(), callback, self.io_loop.READ)
 
+    def stop(self):
+        """Stop listening for new connections"""
+        self.io_loop.remove_handler(self._socket.fileno())
+        self._socket.close()
+
+    def reload(self):
+        """Read policy file and cache response"""
+        with open(self.policy_file, 'rb') as file_handle:
+            self._policy = file_handle.read() + '\0'
+
+        self._policy_mtime = os.path.getmtime(self.policy_file)
+        self._policy_checked = time.time()
+
+    def get_policy(self):
+        """Return cached policy response, reloading it if file was changed"""
+        now = time.time()
+
+        if now - self._policy_checked > self.check_interval:
+            self._policy_checked = now
+
+            try:
+                if os.path.getmtime(self.policy_file) != self._policy_mtime:
+                    logging.info('Reloading Flash policy file %s',
+                                 self.policy_file)
+                    self.reload()
+            except (IOError, OSError), ex:
+                logging.error('Failed to reload Flash policy file: %s', ex)
+
+        return self._policy
+
     def connection_ready(self, sock, _fd, _events):
         """Connection ready callback"""
         while True:
@@ -43,14 +105,33 @@ class FlashPolicyServer(object):
                 if ex[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
                     raise
                 return
+
+            if self._connections >= self.max_connections:
+                logging.debug('Too many Flash policy connections, dropping')
+                connection.close()
+                continue
+
             connection.setblocking(0)
-            self.stream = iostream.IOStream(connection, self.io_loop)
-            self.stream.read_bytes(22, self._handle_request)
+            stream = iostream.IOStream(connection, self.io_loop)
 
-    def _handle_request(self, request):
+            self._connections += 1
+            stream.set_close_callback(self._connection_closed)
+
+            timeout = self.io_loop.add_timeout(time.time() + self.read_timeout,
+                                               stream.close)
+            stream.read_bytes(len(POLICY_REQUEST),
+                              functools.partial(self._handle_request,
+                                                stream,
+                                                timeout))
+
+    def _connection_closed(self):
+        self._connections -= 1
+
+    def _handle_request(self, stream, timeout, request):
         """Send policy response"""
-        if request != '<policy-file-request/>':
-            self.stream.close()
+        self.io_loop.remove_timeout(timeout)
+
+        if request != POLICY_REQUEST:
+            stream.close()
         else:
-            with open(self.policy_file, 'rb') as file_handle:
-                self.stream.write(file_handle.read() + '\0')
+            stream.write(self.get_policy(), stream.close)
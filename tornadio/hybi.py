@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.hybi
+    ~~~~~~~~~~~~~
+
+    RFC 6455 (hybi) websocket handshake and framing helpers.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import struct
+
+from base64 import b64encode
+from binascii import hexlify, unhexlify
+from hashlib import sha1
+
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Supported protocol versions
+VERSIONS = ('13', '8', '7')
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+FIN = 0x80
+MASKED = 0x80
+
+# Close status codes
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+# Maximum payload size of the control frame
+MAX_CONTROL_SIZE = 125
+
+def is_hybi_request(request):
+    """Check if websocket request uses RFC 6455 handshake"""
+    # HTTPHeaders does not normalize names for `in` checks
+    return (request.headers.get('Sec-WebSocket-Version') is not None
+            and request.headers.get('Sec-WebSocket-Key') is not None)
+
+def accept_key(key):
+    """Calculate `Sec-WebSocket-Accept` value for the client key"""
+    return b64encode(sha1(key + GUID).digest())
+
+def handshake_response(key):
+    """Return server handshake response for the client key"""
+    return ('HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: %s\r\n\r\n' % accept_key(key))
+
+def frame(opcode, data, mask=None):
+    """Build one frame with the given opcode and payload. Frame is masked
+    with 4-byte `mask`, if it is set, as client frames should be."""
+    length = len(data)
+    masked = MASKED if mask is not None else 0
+
+    if length < 126:
+        header = struct.pack('!BB', FIN | opcode, masked | length)
+    elif length <= 0xFFFF:
+        header = struct.pack('!BBH', FIN | opcode, masked | 126, length)
+    else:
+        header = struct.pack('!BBQ', FIN | opcode, masked | 127, length)
+
+    if mask is not None:
+        # Masking is the same XOR operation
+        return header + mask + unmask(mask, data)
+
+    return header + data
+
+def unmask(mask, data):
+    """Unmask client frame payload.
+
+    XORs payload as one long integer instead of going byte by byte.
+    """
+    length = len(data)
+
+    if not length:
+        return data
+
+    key = (mask * (length // 4 + 1))[:length]
+    value = int(hexlify(data), 16) ^ int(hexlify(key), 16)
+
+    return unhexlify('%0*x' % (length * 2, value))
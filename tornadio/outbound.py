@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.outbound
+    ~~~~~~~~~~~~~~~~~
+
+    Outgoing message priorities.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+from collections import deque
+
+from tornadio import proto
+
+# Message priorities, from the highest to the lowest
+CONTROL = 0
+HIGH = 1
+NORMAL = 2
+BULK = 3
+
+class OutboundQueue(object):
+    """Queue of outgoing messages split into priority lanes.
+
+    With `strict` policy, `pop` returns messages from the highest priority
+    lane first, keeping order of messages within each lane. Bulk messages
+    are limited to `bulk_size` bytes per `pop`, so they are paced and can't
+    delay other messages for long.
+
+    With `fifo` policy, priorities are ignored and messages are returned in
+    order they were queued.
+
+    Bulk messages are encoded with `codec`, if it is set.
+    """
+    def __init__(self, policy='strict', bulk_size=None, codec=None):
+        self.policy = policy
+        self.bulk_size = bulk_size
+        self.codec = codec
+
+        self.lanes = ([], [], [], deque())
+        self.bulk_bytes = 0
+
+        # Conflated message key to its index in the normal lane
+        self.conflated = {}
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def append(self, message, priority=NORMAL):
+        """Queue message with given priority"""
+        if self.policy == 'fifo':
+            priority = NORMAL
+
+        if priority == BULK:
+            # Bulk messages are paced by size, so encode them right away
+            message = proto.prepare(message, self.codec)
+            self.bulk_bytes += len(message)
+
+        self.lanes[priority].append(message)
+
+    def conflate(self, key, message):
+        """Replace queued message with the same key or queue message with
+        normal priority."""
+        lane = self.lanes[NORMAL]
+        index = self.conflated.get(key, None)
+
+        if index is not None:
+            lane[index] = message
+        else:
+            self.conflated[key] = len(lane)
+            lane.append(message)
+
+    def items(self):
+        """Return list of (priority, message) tuples of the queued
+        messages, highest priority first"""
+        return [(priority, message)
+                for priority, lane in enumerate(self.lanes)
+                for message in lane]
+
+    def pop(self):
+        """Remove and return list of messages to send"""
+        messages = []
+
+        for lane in self.lanes[:BULK]:
+            messages.extend(lane)
+            del lane[:]
+
+        self.conflated.clear()
+
+        bulk = self.lanes[BULK]
+        size = 0
+
+        while bulk and (self.bulk_size is None or size < self.bulk_size):
+            message = bulk.popleft()
+            size += len(message)
+            messages.append(message)
+
+        self.bulk_bytes -= size
+
+        return messages
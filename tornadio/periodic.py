@@ -9,17 +9,20 @@
     :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
     :license: Apache, see LICENSE for more details.
 """
-import time, logging
+import logging
+
+from tornadio import eventloop
 
 class Callback(object):
     def __init__(self, callback, callback_time, io_loop):
         self.callback = callback
         self.callback_time = callback_time
-        self.io_loop = io_loop
+        self.io_loop = eventloop.get_loop(io_loop)
+        self.clock = eventloop.get_clock(self.io_loop)
         self._running = False
 
     def calculate_next_run(self):
-        return time.time() + self.callback_time / 1000.0
+        return self.clock() + self.callback_time / 1000.0
 
     def start(self, timeout=None):
         self._running = True
@@ -8,12 +8,16 @@
     :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
     :license: Apache, see LICENSE for more details.
 """
+import struct
 import logging
 
+from collections import OrderedDict, deque
+
 import tornado
 from tornado.websocket import WebSocketHandler
 
-from tornadio import proto
+from tornadio import proto, periodic, hybi, outbound, codec
+from tornadio.persistentsession import PersistentSession
 
 class TornadioWebSocketHandler(WebSocketHandler):
     """WebSocket handler.
@@ -22,8 +26,48 @@ class TornadioWebSocketHandler(WebSocketHandler):
         logging.debug('Initializing WebSocket handler...')
 
         self.router = router
+        self.session_id = session_id
+        self.session = None
         self.connection = None
 
+        # Write buffer watermarks
+        settings = router.settings
+        self._high_watermark = settings['write_buffer_high_watermark']
+        self._low_watermark = settings['write_buffer_low_watermark']
+        self._congestion_policy = settings['write_buffer_policy']
+        self._congestion_timer = None
+        self._pending = None
+        # Conflated and bulk message queues are only allocated when used,
+        # so idle connections do not keep them around
+        self._conflated = None
+        self.is_congested = False
+
+        # Bulk messages waiting for the write buffer to drain
+        self._priority_drain = settings['priority_drain']
+        self._bulk_size = settings['bulk_write_size']
+        self._bulk = None
+        self._bulk_bytes = 0
+        self._bulk_timer = None
+
+        # RFC 6455 state
+        self.is_hybi = False
+        self._native_heartbeats = settings['websocket_native_heartbeats']
+        self._frame_opcode = None
+        self._frame_length = None
+        self._fragments = None
+        self._fragments_opcode = None
+        self._fragments_size = 0
+        self._close_sent = False
+
+        # Inbound size limits
+        self._max_request_size = settings['max_request_size']
+        self._max_message_size = settings['max_message_size']
+
+        # Negotiated payload codec. RFC 6455 clients receive and send
+        # encoded payloads in binary frames, without base64.
+        self.codec = None
+        self.binary = False
+
         super(TornadioWebSocketHandler, self).__init__(router.application,
                                                        router.request)
 
@@ -31,6 +75,10 @@ class TornadioWebSocketHandler(WebSocketHandler):
     # Merged from:
     # https://github.com/facebook/tornado/commit/86bd681ff841f272c5205f24cd2a613535ed2e00
     def _execute(self, transforms, *args, **kwargs):
+        if hybi.is_hybi_request(self.request):
+            self._execute_hybi(*args, **kwargs)
+            return
+
         # Next Tornado will have the built-in support for HAProxy
         if tornado.version_info < (1, 2, 0):
             # Write the initial headers before attempting to read the challenge.
@@ -61,12 +109,231 @@ class TornadioWebSocketHandler(WebSocketHandler):
         else:
             super(TornadioWebSocketHandler, self)._write_response(challenge)
 
+    # RFC 6455 support
+    def _execute_hybi(self, *args, **kwargs):
+        """Handle RFC 6455 handshake"""
+        self.is_hybi = True
+        self.open_args = args
+        self.open_kwargs = kwargs
+
+        headers = self.request.headers
+
+        if headers['Sec-WebSocket-Version'] not in hybi.VERSIONS:
+            self.stream.write('HTTP/1.1 426 Upgrade Required\r\n'
+                              'Sec-WebSocket-Version: %s\r\n\r\n' %
+                              hybi.VERSIONS[0])
+            self._abort()
+            return
+
+        self.stream.write(hybi.handshake_response(headers['Sec-WebSocket-Key']))
+        self.async_callback(self.open)(*args, **kwargs)
+        self._receive_frame()
+
+    def _receive_frame(self):
+        self.stream.read_bytes(2, self._on_frame_start)
+
+    def _on_frame_start(self, data):
+        header, length = struct.unpack('!BB', data)
+
+        # Clients must mask their frames
+        if not length & hybi.MASKED:
+            self._abort()
+            return
+
+        self._frame_fin = header & hybi.FIN
+        self._frame_opcode = header & 0x0f
+        length = length & 0x7f
+
+        # Control frames are small and not fragmented, don't buffer ones
+        # which claim otherwise
+        if (self._frame_opcode >= hybi.OP_CLOSE
+            and (length > hybi.MAX_CONTROL_SIZE or not self._frame_fin)):
+            logging.debug('Invalid control frame, closing connection')
+            self._fail(hybi.CLOSE_PROTOCOL_ERROR)
+            return
+
+        # Read extended length (if any) together with the mask
+        if length == 126:
+            self.stream.read_bytes(6, self._on_frame_length_16)
+        elif length == 127:
+            self.stream.read_bytes(12, self._on_frame_length_64)
+        else:
+            self._frame_length = length
+            self.stream.read_bytes(4, self._on_frame_mask)
+
+    def _on_frame_length_16(self, data):
+        self._frame_length = struct.unpack('!H', data[:2])[0]
+        self._on_frame_mask(data[2:])
+
+    def _on_frame_length_64(self, data):
+        self._frame_length = struct.unpack('!Q', data[:8])[0]
+        self._on_frame_mask(data[8:])
+
+    def _on_frame_mask(self, mask):
+        self._frame_mask = mask
+
+        # Do not read messages which are too big. Control frames are not
+        # part of the message and were checked already.
+        if (self._max_request_size is not None
+            and self._frame_opcode < hybi.OP_CLOSE
+            and (self._frame_length + self._fragments_size
+                 > self._max_request_size)):
+            self._message_too_big()
+            return
+
+        # IOStream won't call back for zero-length reads
+        if self._frame_length == 0:
+            self._on_frame_data('')
+        else:
+            self.stream.read_bytes(self._frame_length, self._on_frame_data)
+
+    def _on_frame_data(self, data):
+        data = hybi.unmask(self._frame_mask, data)
+        opcode = self._frame_opcode
+
+        if opcode >= hybi.OP_CLOSE:
+            self._on_control_frame(opcode, data)
+        elif opcode == hybi.OP_CONTINUATION:
+            if self._fragments is None:
+                self._abort()
+                return
+
+            self._fragments.append(data)
+            self._fragments_size += len(data)
+
+            if self._frame_fin:
+                data = ''.join(self._fragments)
+                opcode = self._fragments_opcode
+                self._fragments = None
+                self._fragments_size = 0
+                self._on_data_frame(opcode, data)
+        elif self._frame_fin:
+            self._on_data_frame(opcode, data)
+        else:
+            self._fragments = [data]
+            self._fragments_opcode = opcode
+            self._fragments_size = len(data)
+
+        if not self.client_terminated:
+            self._receive_frame()
+
+    def _on_data_frame(self, opcode, data):
+        if opcode == hybi.OP_TEXT:
+            data = data.decode('utf-8', 'replace')
+
+        self.async_callback(self.on_message)(data, opcode == hybi.OP_BINARY)
+
+    def _on_control_frame(self, opcode, data):
+        if opcode == hybi.OP_CLOSE:
+            self.client_terminated = True
+            self.close()
+        elif opcode == hybi.OP_PING:
+            self.stream.write(hybi.frame(hybi.OP_PONG, data))
+        elif opcode == hybi.OP_PONG:
+            if self.connection is not None:
+                self.async_callback(self.connection.heartbeat_received)(data)
+
+    def _message_too_big(self):
+        """Close connection which sent message above the size limit"""
+        logging.debug('Incoming message is too big, closing connection')
+        self._fail(hybi.CLOSE_TOO_BIG)
+
+    def _fail(self, status):
+        """Stop reading and close connection with given close status"""
+        # Stop handling incoming messages
+        self.client_terminated = True
+
+        if not self.is_hybi:
+            # Draft handler reads next message right after this one
+            self.router.loop.add_callback(self.stream.close)
+            return
+
+        # Close stream once close frame is sent
+        self._close_sent = True
+        self.stream.write(hybi.frame(hybi.OP_CLOSE, struct.pack('!H', status)),
+                          self.stream.close)
+
+    def write_message(self, message, binary=False):
+        """Send message to the client. Binary frames are only available
+        for RFC 6455 clients."""
+        if not self.is_hybi:
+            super(TornadioWebSocketHandler, self).write_message(message)
+            return
+
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+
+        opcode = hybi.OP_BINARY if binary else hybi.OP_TEXT
+        self.stream.write(hybi.frame(opcode, message))
+
+    def close(self):
+        if not self.is_hybi:
+            super(TornadioWebSocketHandler, self).close()
+            return
+
+        if self.stream.closed():
+            return
+
+        if self.client_terminated:
+            if self._waiting is not None:
+                self.router.loop.remove_timeout(self._waiting)
+                self._waiting = None
+
+            # Close stream once all pending data is sent
+            if not self._close_sent:
+                self._close_sent = True
+                self.stream.write(hybi.frame(hybi.OP_CLOSE, ''),
+                                  self.stream.close)
+            else:
+                self.stream.write('', self.stream.close)
+        else:
+            if not self._close_sent:
+                self._close_sent = True
+                self.stream.write(hybi.frame(hybi.OP_CLOSE, ''))
+
+            # Give client some time to reply with its close frame
+            if self._waiting is None:
+                self._waiting = self.router.loop.add_timeout(
+                    self.router.clock() + 5, self._abort)
+
+    def send_heartbeat(self, number):
+        """Send heartbeat to the client. For RFC 6455 clients, uses ping
+        control frames if `websocket_native_heartbeats` is enabled.
+
+        Returns False if heartbeat was not written, because connection is
+        congested."""
+        if self.is_congested and self._congestion_policy is not None:
+            return False
+
+        if self.is_hybi and self._native_heartbeats:
+            self.stream.write(hybi.frame(hybi.OP_PING, str(number)))
+        else:
+            self.send('~h~%d' % number, outbound.CONTROL)
+
+        return True
+
     def open(self, *args, **kwargs):
+        # Draft websocket messages are read until the end marker, so limit
+        # the read buffer to stop reading oversized messages early
+        if not self.is_hybi and self._max_request_size is not None:
+            self.stream.max_buffer_size = (self._max_request_size
+                                           + self.stream.read_chunk_size)
+
+        self.codec = codec.negotiate(self.get_argument('codec', None),
+                                     self.router.settings['payload_codecs'])
+        self.binary = self.codec is not None and self.is_hybi
+
+        if self.router.settings['websocket_resume']:
+            self._open_session(*args, **kwargs)
+            return
+
         # Create connection instance
         heartbeat_interval = self.router.settings['heartbeat_interval']
         self.connection = self.router.connection(self,
-                                                 self.router.io_loop,
+                                                 self.router.loop,
                                                  heartbeat_interval)
+        self.connection.set_registry(self.router.registry)
+        self.connection.set_scheduler(self.router.scheduler)
 
         # Initialize heartbeats
         self.connection.reset_heartbeat()
@@ -77,21 +344,227 @@ class TornadioWebSocketHandler(WebSocketHandler):
 
         self.connection.on_open(self.request, *args, **kwargs)
 
-    def on_message(self, message):
-        self.async_callback(self.connection.raw_message)(message)
+    def _open_session(self, *args, **kwargs):
+        """Resume existing session or create new resumable one"""
+        if self.session_id:
+            session = self.router.sessions.get(self.session_id)
+
+            if isinstance(session, PersistentSession):
+                try:
+                    last_seen = int(self.get_argument('seq', 0))
+                except ValueError:
+                    last_seen = 0
+
+                if session.resume(self, last_seen):
+                    logging.debug('Resumed session %s', self.session_id)
+                    self.session = session
+                    return
+
+        self.session = self.router.sessions.create(
+            PersistentSession,
+            self.router.settings['websocket_resume_timeout'],
+            router=self.router,
+            handler=self,
+            args=args,
+            kwargs=kwargs)
+
+    def on_message(self, message, binary=False):
+        if (self._max_request_size is not None
+            and len(message) > self._max_request_size):
+            self._message_too_big()
+            return
+
+        self.async_callback(self._raw_message)(message, binary)
+
+    def _raw_message(self, message, binary):
+        try:
+            self.connection.raw_message(message, self._max_message_size,
+                                        binary)
+        except proto.MessageTooBig:
+            self._message_too_big()
 
     def on_close(self):
+        self._stop_congestion_timer()
+        self._pending = None
+        self._conflated = None
+
+        self._stop_bulk_timer()
+        self._bulk = None
+        self._bulk_bytes = 0
+
+        # Keep resumable session alive for a while
+        if self.session is not None:
+            self.session.detach(self)
+            return
+
         if self.connection is not None:
             try:
-                self.connection.on_close()
+                self.connection.handle_close()
             finally:
-                self.connection.is_closed = True
                 self.connection.stop_heartbeat()
 
-    def send(self, message):
-        self.write_message(proto.encode(message))
+    def send(self, message, priority=outbound.NORMAL):
+        if self.is_congested and self._congestion_policy is not None:
+            self._send_congested(message)
+            return
+
+        # Everything but bulk messages is written right away, overtaking
+        # bulk messages which are still queued
+        if priority == outbound.BULK and self._priority_drain == 'strict':
+            self._queue_bulk(message)
+        else:
+            self.write_message(proto.encode(message, self.codec, self.binary),
+                               self.binary)
+
         self.connection.delay_heartbeat()
 
+        if (self._high_watermark is not None and not self.is_congested
+            and self.buffered_bytes > self._high_watermark):
+            self._set_congested()
+
+    def send_conflated(self, key, message):
+        # Conflation does not depend on the write buffer policy
+        if self.is_congested:
+            if not self.stream.closed():
+                if self._conflated is None:
+                    self._conflated = OrderedDict()
+
+                self._conflated[key] = message
+            return
+
+        self.send(message)
+
+    @property
+    def buffered_bytes(self):
+        """Amount of data, in bytes, waiting in the write buffer. Paced bulk
+        messages which were not written yet are not counted, they are
+        available as `bulk_bytes`."""
+        return self._write_buffer_size()
+
+    @property
+    def bulk_bytes(self):
+        """Amount of data, in bytes, in bulk messages waiting to be written
+        to the write buffer"""
+        return self._bulk_bytes
+
+    def _write_buffer_size(self):
+        buf = self.stream._write_buffer
+
+        # Tornado 1.1 keeps write buffer as a string
+        if isinstance(buf, str):
+            return len(buf)
+
+        return sum(len(chunk) for chunk in buf)
+
+    # Bulk messages pacing
+    def _queue_bulk(self, message):
+        message = proto.prepare(message, self.codec, self.binary)
+
+        if self._bulk is None:
+            self._bulk = deque()
+
+        self._bulk.append(message)
+        self._bulk_bytes += len(message)
+
+        self._write_bulk()
+
+    def _write_bulk(self):
+        """Write queued bulk messages while there is little data in the
+        write buffer"""
+        if self.stream.closed():
+            self._stop_bulk_timer()
+            return
+
+        bulk = self._bulk
+
+        while bulk and (self._bulk_size is None
+                        or self._write_buffer_size() < self._bulk_size):
+            message = bulk.popleft()
+            self._bulk_bytes -= len(message)
+            self.write_message(message, self.binary)
+
+        if not bulk:
+            # Do not keep empty queue around
+            self._bulk = None
+            self._stop_bulk_timer()
+        elif self._bulk_timer is None:
+            interval = self.router.settings['write_buffer_check_interval']
+            self._bulk_timer = periodic.Callback(self._write_bulk,
+                                                 interval * 1000,
+                                                 self.router.loop)
+            self._bulk_timer.start()
+
+    def _stop_bulk_timer(self):
+        if self._bulk_timer is not None:
+            self._bulk_timer.stop()
+            self._bulk_timer = None
+
+    # Congestion management
+    def _send_congested(self, message):
+        """Handle outgoing message while connection is congested"""
+        # There is no point in sending heartbeats to the congested client
+        if isinstance(message, basestring) and message.startswith(proto.HEARTBEAT):
+            return
+
+        if self._congestion_policy == 'conflate':
+            self._pending = message
+
+    def _set_congested(self):
+        logging.debug('Connection is congested, %d bytes buffered',
+                      self.buffered_bytes)
+
+        self.is_congested = True
+
+        self.connection.on_congested()
+
+        if self._congestion_policy == 'close':
+            # Do not wait for the closing handshake - client is not reading
+            # anything anyway.
+            self._abort()
+            return
+
+        interval = self.router.settings['write_buffer_check_interval'] * 1000
+        self._congestion_timer = periodic.Callback(self._check_congestion,
+                                                   interval,
+                                                   self.router.loop)
+        self._congestion_timer.start()
+
+    def _check_congestion(self):
+        """Periodic check if congested connection was drained"""
+        if self.stream.closed():
+            self._stop_congestion_timer()
+            return
+
+        if self.buffered_bytes > self._low_watermark:
+            return
+
+        logging.debug('Connection drained')
+
+        self._stop_congestion_timer()
+        self.is_congested = False
+
+        self.connection.on_drained()
+
+        if self._pending is not None:
+            message = self._pending
+            self._pending = None
+            self.send(message)
+
+        conflated = self._conflated
+        self._conflated = None
+
+        if conflated:
+            for key, message in conflated.iteritems():
+                if self.is_congested:
+                    self.send_conflated(key, message)
+                else:
+                    self.send(message)
+
+    def _stop_congestion_timer(self):
+        if self._congestion_timer is not None:
+            self._congestion_timer.stop()
+            self._congestion_timer = None
+
 class TornadioFlashSocketHandler(TornadioWebSocketHandler):
     def __init__(self, router, session_id):
         logging.debug('Initializing FlashSocket handler...')
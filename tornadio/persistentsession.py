@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.persistentsession
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module implements resumable session class for persistent transports.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import logging
+
+from collections import deque
+
+from tornadio import proto, session, outbound
+
+class PersistentSession(session.Session):
+    """This class represents virtual protocol connection for the websocket
+    transport with resume support.
+
+    Each outgoing frame is prefixed with `~s~<sequence>` message and few last
+    frames are kept in the replay buffer. If websocket is dropped, session
+    lives for `websocket_resume_timeout` seconds, so client can reconnect
+    with its session ID and last seen sequence number and receive frames it
+    missed without going through `on_open` again.
+    """
+    def __init__(self, session_id, expiry, router, handler,
+                 args, kwargs):
+        # Initialize session
+        super(PersistentSession, self).__init__(session_id, expiry,
+                                                router.clock)
+
+        # Set connection
+        self.connection = router.connection(self,
+                                     router.loop,
+                                     router.settings['heartbeat_interval'])
+        self.connection.set_registry(router.registry)
+        self.connection.set_scheduler(router.scheduler)
+
+        self.handler = None
+        self.sequence = 0
+
+        # Frames are kept encoded, so they are encoded for the websocket
+        # which created the session
+        self.codec = handler.codec
+        self.binary = handler.binary
+
+        self.replay_buffer = deque(
+            maxlen=router.settings['websocket_resume_buffer'])
+
+        # Forward some methods to connection
+        self.on_open = self.connection.on_open
+        self.raw_message = self.connection.raw_message
+        self.on_close = self.connection.on_close
+
+        self.reset_heartbeat = self.connection.reset_heartbeat
+        self.stop_heartbeat = self.connection.stop_heartbeat
+        self.delay_heartbeat = self.connection.delay_heartbeat
+
+        self.attach(handler)
+
+        # Notify that channel was opened
+        self.on_open(router.request, *args, **kwargs)
+
+    def on_delete(self, forced):
+        """Called by the session management class when item is
+        about to get deleted/expired. Session will live while there is
+        websocket attached to it.
+        """
+        if not forced and self.handler is not None and not self.is_closed:
+            self.promote()
+        else:
+            self.close()
+
+    def attach(self, handler):
+        """Associate websocket handler with the session and send session ID
+        to the client."""
+        self.handler = handler
+        handler.connection = self.connection
+
+        handler.send(self.session_id)
+
+        self.promote()
+        self.reset_heartbeat()
+
+    def detach(self, handler):
+        """Remove associated websocket handler. Session will be kept for the
+        grace period, waiting for client to reconnect.
+        """
+        if self.handler is not handler:
+            return False
+
+        self.handler = None
+        self.stop_heartbeat()
+
+        # Start grace period
+        self.promote()
+
+        return True
+
+    def resume(self, handler, last_seen):
+        """Attach reconnected websocket and send frames client missed.
+
+        Returns False if session can't be resumed - it is still attached to
+        other websocket or frames client missed are not available anymore.
+        """
+        if self.handler is not None or self.is_closed:
+            return False
+
+        if self.replay_buffer:
+            first = self.replay_buffer[0][0]
+        else:
+            first = self.sequence + 1
+
+        if last_seen + 1 < first or last_seen > self.sequence:
+            logging.debug('Can not resume session %s from %d',
+                          self.session_id, last_seen)
+            self.close()
+            return False
+
+        self.attach(handler)
+
+        for seq, frame in self.replay_buffer:
+            if seq > last_seen:
+                handler.send(frame)
+
+        return True
+
+    def send(self, message, priority=outbound.NORMAL):
+        """Number the message, keep it for the replay and send it to the
+        client if websocket is attached.
+
+        Numbered messages must arrive in order, so priority is ignored.
+        """
+        self.sequence += 1
+
+        frame = self._frame(message)
+        self.replay_buffer.append((self.sequence, frame))
+
+        if self.handler is not None:
+            self.handler.send(frame)
+
+    def _frame(self, message):
+        """Encode message prefixed with its sequence number"""
+        return proto.EncodedMessage(proto.encode('%s%d' % (proto.SEQUENCE,
+                                                           self.sequence))
+                                    + proto.encode(message, self.codec,
+                                                   self.binary))
+
+    def send_conflated(self, key, message):
+        """Send message to the client. Numbered messages are kept for the
+        replay as is, so conflation only happens while websocket is
+        congested."""
+        self.sequence += 1
+
+        frame = self._frame(message)
+        self.replay_buffer.append((self.sequence, frame))
+
+        if self.handler is not None:
+            self.handler.send_conflated(key, frame)
+
+    def send_heartbeat(self, number):
+        """Send heartbeat to the client. Heartbeats are not numbered.
+        Returns False if there is no websocket attached."""
+        if self.handler is None:
+            return False
+
+        return self.handler.send_heartbeat(number)
+
+    def close(self):
+        """Forcibly close connection and notify connection object about that.
+        """
+        if not self.connection.is_closed:
+            try:
+                # Notify that connection was closed
+                self.connection.handle_close()
+            finally:
+                self.stop_heartbeat()
+
+        self.replay_buffer.clear()
+
+        handler = self.handler
+        self.handler = None
+
+        if handler is not None:
+            handler.close()
+
+    @property
+    def buffered_bytes(self):
+        """Amount of data, in bytes, waiting to be sent to the client"""
+        if self.handler is None:
+            return 0
+
+        return self.handler.buffered_bytes
+
+    @property
+    def is_closed(self):
+        """Check if connection was closed or not"""
+        return self.connection.is_closed
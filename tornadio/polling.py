@@ -8,7 +8,6 @@
     :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
     :license: Apache, see LICENSE for more details.
 """
-import time
 try:
     import simplejson as json
 except ImportError:
@@ -17,7 +16,39 @@ except ImportError:
 from urllib import unquote
 from tornado.web import RequestHandler, HTTPError, asynchronous
 
-from tornadio import pollingsession
+from tornadio import proto, pollingsession, codec
+
+# Adaptive XHR polling holds GET for this many expected intervals between
+# messages
+HOLD_INTERVALS = 4
+
+MULTIPART_BOUNDARY = '--socketio\n'
+MULTIPART_HEADER = 'Content-Type: text/plain; charset=UTF-8\n\n'
+MULTIPART_FOOTER = '\n' + MULTIPART_BOUNDARY
+
+EVENTSOURCE_FRAME = 'id: %s:%d\ndata: %s\n\n'
+EVENTSOURCE_JSON_FRAME = 'id: %s:%d\nevent: json\ndata: %s\n\n'
+
+HTMLFILE_PREAMBLE = '<html><body>%s' % (' ' * 244)
+HTMLFILE_FRAME = '<script>parent.s_(%s),document);</script>'
+
+class FrameCache(object):
+    """Remembers last framed chunk of the streaming transport.
+
+    When same payload is sent to many streaming clients (see
+    `proto.prepare`), it will be framed only once.
+    """
+    def __init__(self, formatter):
+        self.formatter = formatter
+        self.data = None
+        self.chunk = None
+
+    def __call__(self, data):
+        if data is not self.data and data != self.data:
+            self.chunk = self.formatter(data)
+            self.data = data
+
+        return self.chunk
 
 class TornadioPollingHandlerBase(RequestHandler):
     """All polling transport implementations derive from this class.
@@ -34,6 +65,9 @@ class TornadioPollingHandlerBase(RequestHandler):
     6. If there were no GET requests for more than 15 seconds (default), virtual
     connection will be closed - session entry will expire
     """
+    # Session class used for new virtual connections
+    session_class = pollingsession.PollingSession
+
     def __init__(self, router, session_id):
         """Default constructor.
 
@@ -51,18 +85,24 @@ class TornadioPollingHandlerBase(RequestHandler):
         # Initialize session either by creating new one or
         # getting it from container
         if not self.session_id:
-            session_expiry = self.router.settings['session_expiry']
+            settings = self.router.settings
+
+            # Client can ask for compact payload codec
+            payload_codec = codec.negotiate(self.get_argument('codec', None),
+                                            settings['payload_codecs'])
 
             self.session = self.router.sessions.create(
-                pollingsession.PollingSession,
-                session_expiry,
+                self.session_class,
+                settings['session_expiry'],
                 router=self.router,
                 args=args,
-                kwargs=kwargs)
+                kwargs=kwargs,
+                codec=payload_codec)
         else:
             self.session = self.router.sessions.get(self.session_id)
 
-            if self.session is None or self.session.is_closed:
+            if (not isinstance(self.session, pollingsession.PollingSession)
+                or self.session.is_closed):
                 # TODO: Send back disconnect message?
                 raise HTTPError(401, 'Invalid session')
 
@@ -83,6 +123,25 @@ class TornadioPollingHandlerBase(RequestHandler):
         """Called by the session when some data is available"""
         raise NotImplementedError()
 
+    def suspend(self):
+        """Called by the session when it was moved to another process.
+        Finishes request, so client reconnects."""
+        self.on_connection_close()
+
+        # Streaming response has no length, so close connection once it
+        # is written
+        self.request.connection.no_keep_alive = True
+        self.finish()
+
+    def _raw_message(self, data):
+        """Pass data posted by the client to the session. Messages are
+        handled as they are decoded, oversized message fails the request."""
+        try:
+            self.session.raw_message(data,
+                                     self.router.settings['max_message_size'])
+        except proto.MessageTooBig:
+            raise HTTPError(413)
+
     @asynchronous
     def options(self, *args, **kwargs):
         """XHR cross-domain OPTIONS handler"""
@@ -122,15 +181,47 @@ class TornadioXHRPollingSocketHandler(TornadioPollingHandlerBase):
     socket.io client-side will just make another GET request.
     2. When new data is available on server-side, it will be sent through the
     open GET connection or cached otherwise.
+    3. If `xhr_polling_adaptive` is enabled, GET hold time depends on the
+    session traffic: quiet sessions are held longer, busy ones shorter. Hold
+    time is reduced when server is overloaded.
     """
     def __init__(self, router, session_id):
         self._timeout = None
 
-        self._timeout_interval = router.settings['xhr_polling_timeout']
-
         super(TornadioXHRPollingSocketHandler, self).__init__(router,
                                                               session_id)
 
+    def get_hold_time(self):
+        """Return how long GET request can wait for data, in seconds"""
+        settings = self.router.settings
+
+        if not settings['xhr_polling_adaptive']:
+            return settings['xhr_polling_timeout']
+
+        min_hold = settings['xhr_polling_min_timeout']
+        max_hold = settings['xhr_polling_max_timeout']
+
+        # Hold for few expected intervals between messages. Long hold saves
+        # empty round trips, which is what matters for quiet sessions. But
+        # while GET is held, client might silently go away (network change,
+        # suspended tab) and whatever is written next is lost, as polling
+        # responses are not acknowledged. Busy session would lose many
+        # messages that way, while few extra empty polls cost it little
+        # compared to its traffic, so it is held for shorter time.
+        rate = self.session.message_rate()
+        if rate > 0:
+            hold = min(max_hold, max(min_hold, HOLD_INTERVALS / rate))
+        else:
+            hold = max_hold
+
+        # Shrink hold time if IOLoop is lagging
+        max_lag = settings['xhr_polling_overload_lag']
+        lag = self.router.scheduler.lag
+        if lag > max_lag:
+            hold = max(min_hold, hold * max_lag / lag)
+
+        return hold
+
     @asynchronous
     def get(self, *args, **kwargs):
         if not self.session.set_handler(self):
@@ -139,14 +230,15 @@ class TornadioXHRPollingSocketHandler(TornadioPollingHandlerBase):
             raise HTTPError(401, 'Forbidden')
 
         if not self.session.send_queue:
-            self._timeout = self.router.io_loop.add_timeout(
-                time.time() + self._timeout_interval,
+            self._timeout = self.router.scheduler.add(
+                self.router.clock() + self.get_hold_time(),
                 self._polling_timeout)
         else:
             self.session.flush()
 
     def _polling_timeout(self):
-        # TODO: Fix me
+        self._timeout = None
+
         if self.session:
             self.data_available('')
 
@@ -166,13 +258,21 @@ class TornadioXHRPollingSocketHandler(TornadioPollingHandlerBase):
         else:
             data = self.get_argument('data', None)
 
-        self.async_callback(self.session.raw_message)(data)
+        self.async_callback(self._raw_message)(data)
+
+        # Request was already answered with an error
+        if self._finished:
+            return
 
         self.set_header('Content-Type', 'text/plain; charset=UTF-8')
         self.write('ok')
         self.finish()
 
     def _detach(self):
+        if self._timeout is not None:
+            self.router.scheduler.remove(self._timeout)
+            self._timeout = None
+
         if self.session:
             self.session.remove_handler(self)
             self.session = None
@@ -180,6 +280,10 @@ class TornadioXHRPollingSocketHandler(TornadioPollingHandlerBase):
     def on_connection_close(self):
         self._detach()
 
+    def suspend(self):
+        # Empty response, client will poll again
+        self.data_available('')
+
     def data_available(self, raw_data):
         self.preflight()
         self.set_header('Content-Type', 'text/plain; charset=UTF-8')
@@ -207,7 +311,7 @@ class TornadioXHRMultipartSocketHandler(TornadioPollingHandlerBase):
         self.set_header('Content-Type',
                         'multipart/x-mixed-replace;boundary="socketio; charset=UTF-8"')
         self.set_header('Connection', 'keep-alive')
-        self.write('--socketio\n')
+        self.write(MULTIPART_BOUNDARY)
 
         # Dump any queued messages
         self.session.flush()
@@ -221,7 +325,11 @@ class TornadioXHRMultipartSocketHandler(TornadioPollingHandlerBase):
             raise HTTPError(401, 'unauthorized')
 
         data = self.get_argument('data')
-        self.async_callback(self.session.raw_message)(data)
+        self.async_callback(self._raw_message)(data)
+
+        # Request was already answered with an error
+        if self._finished:
+            return
 
         self.set_header('Content-Type', 'text/plain; charset=UTF-8')
         self.write('ok')
@@ -232,11 +340,12 @@ class TornadioXHRMultipartSocketHandler(TornadioPollingHandlerBase):
             self.session.stop_heartbeat()
             self.session.remove_handler(self)
 
+    frame = FrameCache(
+        lambda data: ''.join((MULTIPART_HEADER, data, MULTIPART_FOOTER)))
+
     def data_available(self, raw_data):
         self.preflight()
-        self.write("Content-Type: text/plain; charset=UTF-8\n\n")
-        self.write(raw_data + '\n')
-        self.write('--socketio\n')
+        self.write(self.frame(raw_data))
         self.flush()
 
         self.session.delay_heartbeat()
@@ -257,7 +366,7 @@ class TornadioHtmlFileSocketHandler(TornadioPollingHandlerBase):
         self.set_header('Content-Type', 'text/html; charset=UTF-8')
         self.set_header('Connection', 'keep-alive')
         self.set_header('Transfer-Encoding', 'chunked')
-        self.write('<html><body>%s' % (' ' * 244))
+        self.write(HTMLFILE_PREAMBLE)
 
         # Dump any queued messages
         self.session.flush()
@@ -271,7 +380,11 @@ class TornadioHtmlFileSocketHandler(TornadioPollingHandlerBase):
             raise HTTPError(401, 'unauthorized')
 
         data = self.get_argument('data')
-        self.async_callback(self.session.raw_message)(data)
+        self.async_callback(self._raw_message)(data)
+
+        # Request was already answered with an error
+        if self._finished:
+            return
 
         self.set_header('Content-Type', 'text/plain; charset=UTF-8')
         self.write('ok')
@@ -282,10 +395,91 @@ class TornadioHtmlFileSocketHandler(TornadioPollingHandlerBase):
             self.session.stop_heartbeat()
             self.session.remove_handler(self)
 
+    frame = FrameCache(lambda data: HTMLFILE_FRAME % json.dumps(data))
+
     def data_available(self, raw_data):
-        self.write(
-            '<script>parent.s_(%s),document);</script>' % json.dumps(raw_data)
-            )
+        self.write(self.frame(raw_data))
+        self.flush()
+
+        self.session.delay_heartbeat()
+
+class TornadioEventSourceSocketHandler(TornadioXHRMultipartSocketHandler):
+    """Server-Sent Events (EventSource) transport implementation.
+
+    Transport properties:
+    1. One persistent GET connection used to receive data from the server,
+    each batch of messages is sent as one event
+    2. POST requests are used to send data to the server, same as for the
+    XHR Multipart transport
+    3. Event IDs are `<session_id>:<sequence>`, so when browser reconnects
+    with `Last-Event-ID` header, session is picked up and events which were
+    sent after the last seen one are sent again
+    4. If batch contains carriage return characters, which can not be
+    represented in the event stream, it is sent as JSON encoded string in
+    the `json` event
+    """
+    session_class = pollingsession.EventSourceSession
+
+    def __init__(self, router, session_id):
+        self._last_event_id = None
+
+        super(TornadioEventSourceSocketHandler, self).__init__(router,
+                                                               session_id)
+
+    def _execute(self, transforms, *args, **kwargs):
+        last_event_id = self.request.headers.get('Last-Event-ID', None)
+
+        if last_event_id:
+            session_id, _, seq = last_event_id.partition(':')
+
+            # EventSource reconnects using the original URL, which does
+            # not contain session ID
+            if (not self.session_id
+                and self.router.sessions.get(session_id) is not None):
+                self.session_id = session_id
+
+            if seq.isdigit() and session_id == self.session_id:
+                self._last_event_id = int(seq)
+
+        super(TornadioEventSourceSocketHandler, self)._execute(transforms,
+                                                               *args,
+                                                               **kwargs)
+
+    @asynchronous
+    def get(self, *args, **kwargs):
+        if not self.session.set_handler(self):
+            raise HTTPError(401, 'Forbidden')
+
+        self.preflight()
+        self.set_header('Content-Type', 'text/event-stream; charset=UTF-8')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Connection', 'keep-alive')
+
+        # Send events client might have missed
+        if self._last_event_id is not None:
+            self.session.replay(self._last_event_id)
+
+        # Dump any queued messages and make sure headers are sent
+        self.session.flush()
+        self.flush()
+
+        # We need heartbeats
+        self.session.reset_heartbeat()
+
+    def data_available(self, raw_data):
+        self.send_event(self.session.event_id, raw_data)
+
+    def send_event(self, event_id, raw_data):
+        """Send one event to the client"""
+        if '\r' in raw_data:
+            self.write(EVENTSOURCE_JSON_FRAME % (self.session.session_id,
+                                                 event_id,
+                                                 json.dumps(raw_data)))
+        else:
+            self.write(EVENTSOURCE_FRAME % (self.session.session_id,
+                                            event_id,
+                                            raw_data.replace('\n',
+                                                             '\ndata: ')))
         self.flush()
 
         self.session.delay_heartbeat()
@@ -8,7 +8,14 @@
     :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
     :license: Apache, see LICENSE for more details.
 """
-from tornadio import proto, session
+import math
+
+from collections import deque
+
+from tornadio import proto, session, outbound
+
+# Time window for the outgoing message rate estimation, in seconds
+RATE_WINDOW = 30.0
 
 class PollingSession(session.Session):
     """This class represents virtual protocol connection for polling transports.
@@ -16,19 +23,43 @@ class PollingSession(session.Session):
     For disconnected protocols, like XHR-Polling, it will cache outgoing
     messages, if there is on going GET connection - will pass cached/current
     messages to the actual transport protocol implementation.
+
+    If `state` is passed, session is restored from the state returned by
+    `dump` instead of being opened.
+
+    If `codec` is set, non-string messages are encoded with it instead of
+    JSON.
     """
     def __init__(self, session_id, expiry, router,
-                 args, kwargs):
+                 args, kwargs, state=None, codec=None):
         # Initialize session
-        super(PollingSession, self).__init__(session_id, expiry)
+        super(PollingSession, self).__init__(session_id, expiry,
+                                             router.clock)
+
+        self.codec = codec
 
         # Set connection
         self.connection = router.connection(self,
-                                     router.io_loop,
+                                     router.loop,
                                      router.settings['heartbeat_interval'])
+        self.connection.set_registry(router.registry)
+        self.connection.set_scheduler(router.scheduler)
 
         self.handler = None
-        self.send_queue = []
+        self.send_queue = outbound.OutboundQueue(
+            router.settings['priority_drain'],
+            router.settings['bulk_write_size'],
+            codec)
+
+        # Pacing of the bulk messages for streaming transports
+        self._io_loop = router.loop
+        self._clock = router.clock
+        self._bulk_interval = router.settings['write_buffer_check_interval']
+        self._bulk_timeout = None
+
+        # Outgoing message rate estimation
+        self._rate = 0.0
+        self._rate_time = self._clock()
 
         # Forward some methods to connection
         self.on_open = self.connection.on_open
@@ -39,6 +70,10 @@ class PollingSession(session.Session):
         self.stop_heartbeat = self.connection.stop_heartbeat
         self.delay_heartbeat = self.connection.delay_heartbeat
 
+        if state is not None:
+            self.restore(state)
+            return
+
         # Send session_id
         self.send(session_id)
 
@@ -91,7 +126,11 @@ class PollingSession(session.Session):
         self.promote()
 
     def flush(self):
-        """Send all pending messages to the associated request handler (if any)
+        """Send pending messages to the associated request handler (if any).
+
+        Higher priority messages are sent first. If there are more bulk
+        messages than can be sent at once, they will be sent with the next
+        polling request or, for streaming transports, a bit later.
         """
         if self.handler is None:
             return
@@ -99,28 +138,172 @@ class PollingSession(session.Session):
         if not self.send_queue:
             return
 
-        self.handler.data_available(proto.encode(self.send_queue))
-        self.send_queue = []
+        self.handler.data_available(proto.encode(self.send_queue.pop(),
+                                                 self.codec))
+
+        self._schedule_bulk()
+
+    def _schedule_bulk(self):
+        """Schedule flush of the remaining bulk messages, if handler is
+        still attached"""
+        if (self.send_queue and self.handler is not None
+            and self._bulk_timeout is None):
+            self._bulk_timeout = self._io_loop.add_timeout(
+                self._clock() + self._bulk_interval, self._flush_bulk)
+
+    def _flush_bulk(self):
+        self._bulk_timeout = None
+        self.flush()
+
+    def message_rate(self):
+        """Return exponentially weighted rate of outgoing messages, in
+        messages per second."""
+        elapsed = self._clock() - self._rate_time
+        return self._rate * math.exp(-elapsed / RATE_WINDOW)
 
-    def send(self, message):
+    def _track_rate(self):
+        now = self._clock()
+        elapsed = now - self._rate_time
+
+        self._rate = (self._rate * math.exp(-elapsed / RATE_WINDOW)
+                      + 1.0 / RATE_WINDOW)
+        self._rate_time = now
+
+    def send(self, message, priority=outbound.NORMAL):
         """Append message to the queue and send it right away, if there's
         connection available.
         """
-        self.send_queue.append(message)
+        self._track_rate()
+        self.send_queue.append(message, priority)
+
+        self.flush()
+
+    def send_conflated(self, key, message):
+        """Replace queued message with the same key or append message to
+        the queue."""
+        self._track_rate()
+        self.send_queue.conflate(key, message)
+
+        self.flush()
+
+    def send_heartbeat(self, number):
+        """Send heartbeat message to the client. Returns True if it was
+        sent right away, False if it waits for the next poll."""
+        direct = self.handler is not None
 
+        # Heartbeats do not count towards the message rate, so they don't
+        # shorten the hold time of idle clients
+        self.send_queue.append('~h~%d' % number, outbound.CONTROL)
         self.flush()
 
+        return direct
+
     def close(self):
         """Forcibly close connection and notify connection object about that.
         """
+        if self._bulk_timeout is not None:
+            self._io_loop.remove_timeout(self._bulk_timeout)
+            self._bulk_timeout = None
+
         if not self.connection.is_closed:
-            try:
-                # Notify that connection was closed
-                self.connection.on_close()
-            finally:
-                self.connection.is_closed = True
+            # Notify that connection was closed
+            self.connection.handle_close()
+
+    def dump(self, now):
+        """Return picklable session state to restore session in another
+        process. `now` is current time."""
+        conn = self.connection
+        conn.wake()
+
+        return dict(cls=self.__class__,
+                    session_id=self.session_id,
+                    codec=self.codec and self.codec.name,
+                    expiry=self.expiry,
+                    ttl=max(self.expiry_date, self.promoted) - now,
+                    queue=self.send_queue.items(),
+                    state=conn.hibernate_state(),
+                    keys=list(conn.registry_keys()))
+
+    def restore(self, state):
+        """Restore queued messages and connection state saved by `dump`"""
+        for priority, message in state['queue']:
+            self.send_queue.append(message, priority)
+
+        self.connection.restore_state(state['state'])
+
+        if state['keys']:
+            self.connection.register(*state['keys'])
+
+        self.connection.on_restore()
+
+    def suspend(self):
+        """Stop serving session, which was moved to another process.
+
+        Client request is finished, so client reconnects, and connection is
+        closed without calling `on_close`.
+        """
+        if self._bulk_timeout is not None:
+            self._io_loop.remove_timeout(self._bulk_timeout)
+            self._bulk_timeout = None
+
+        if self.handler is not None:
+            self.handler.suspend()
+
+        self.connection.detach()
 
     @property
     def is_closed(self):
         """Check if connection was closed or not"""
         return self.connection.is_closed
+
+class EventSourceSession(PollingSession):
+    """Polling session for the EventSource transport.
+
+    Numbers sent batches and keeps few last of them, so reconnected client
+    can get events it missed.
+    """
+    def __init__(self, session_id, expiry, router,
+                 args, kwargs, state=None, codec=None):
+        self.event_id = 0
+        self.history = deque(maxlen=router.settings['eventsource_history'])
+
+        super(EventSourceSession, self).__init__(session_id, expiry, router,
+                                                 args, kwargs, state, codec)
+
+    def dump(self, now):
+        state = super(EventSourceSession, self).dump(now)
+        state['event_id'] = self.event_id
+        state['history'] = list(self.history)
+        return state
+
+    def restore(self, state):
+        self.event_id = state['event_id']
+        self.history.extend(state['history'])
+
+        super(EventSourceSession, self).restore(state)
+
+    def flush(self):
+        """Send all pending messages as one numbered event"""
+        if self.handler is None:
+            return
+
+        if not self.send_queue:
+            return
+
+        raw_data = proto.encode(self.send_queue.pop(), self.codec)
+
+        self.event_id += 1
+        self.history.append((self.event_id, raw_data))
+
+        self.handler.data_available(raw_data)
+
+        self._schedule_bulk()
+
+    def replay(self, last_event_id):
+        """Send events which were sent after `last_event_id` again"""
+        if self.handler is None:
+            return
+
+        for event_id, raw_data in self.history:
+            if event_id > last_event_id:
+                self.handler.send_event(event_id, raw_data)
@@ -21,41 +21,254 @@ except ImportError:
             return super(DecimalEncoder, self).default(o)
     json_decimal_args = {"cls":DecimalEncoder}
 
+import base64
+
+from collections import OrderedDict
+
 FRAME = '~m~'
 HEARTBEAT = '~h~'
 JSON = '~j~'
+SEQUENCE = '~s~'
+BINARY = '~b~'
+
+class EncodedMessage(str):
+    """Message which was already encoded to the socket.io wire format.
+
+    Created by `prepare`, passed through `encode` as is.
+    """
+    __slots__ = ()
+
+def prepare(message, codec=None, binary=False):
+    """Encode message once, so it can be sent to many clients without
+    encoding it again for each of them. See `encode` for `codec` and
+    `binary` arguments.
+
+    For example:
+
+        msg = proto.prepare({'event': 'tick'})
+        for client in clients:
+            client.send(msg)
+    """
+    return EncodedMessage(encode(message, codec, binary))
+
+class Prepared(object):
+    """Message encoded once for each payload codec it is sent with. Use it
+    to send one message to many connections which might have negotiated
+    different codecs:
+
+        msg = proto.Prepared({'event': 'tick'})
+        for conn in connections:
+            conn.send(msg.get(conn.codec, conn.binary))
+    """
+    __slots__ = ('message', '_encoded')
+
+    def __init__(self, message):
+        self.message = message
+        self._encoded = {}
+
+    def get(self, codec=None, binary=False):
+        """Return message encoded with `codec`, see `encode`"""
+        # Strings are not encoded with codecs
+        if isinstance(self.message, basestring):
+            key = None
+        else:
+            key = (codec, binary)
+
+        encoded = self._encoded.get(key)
+
+        if encoded is None:
+            encoded = prepare(self.message, codec, binary)
+            self._encoded[key] = encoded
+
+        return encoded
+
+# Marker for cache keys based on the object identity
+_IDENTITY = object()
+
+class EncodeCache(object):
+    """Bounded LRU cache of encoded messages.
+
+    Use it for messages which are sent over and over again, like status or
+    configuration blobs, so they are not encoded for every send:
+
+        cache = proto.EncodeCache()
+
+        def on_open(self, *args, **kwargs):
+            self.send(cache.encode(CONFIG, 'config', self.codec, self.binary))
+
+    Strings are cached by content. Other messages are cached by `key` or,
+    if key is not provided, by identity - such messages must not be modified
+    after they were cached. Messages are cached separately for each `codec`
+    and `binary` pair they were encoded with, see `encode`.
+    """
+    def __init__(self, max_items=1024, max_bytes=16 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self._items = OrderedDict()
+        self.bytes = 0
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def encode(self, message, key=None, codec=None, binary=False):
+        """Return encoded message, encoding it only if it is not cached"""
+        identity = False
+        size = 0
+
+        if key is None:
+            if isinstance(message, basestring):
+                key = message
+            else:
+                key = (_IDENTITY, id(message))
+                identity = True
+
+        # String keys are kept in memory as well
+        if isinstance(key, basestring):
+            size = len(key)
+
+        # Strings are not encoded with codecs
+        if isinstance(message, basestring):
+            codec = None
+            binary = False
+
+        key = (key, codec, binary)
+
+        entry = self._items.pop(key, None)
+
+        # Identity keys are only valid while same object is cached
+        if entry is not None and identity and entry[0] is not message:
+            self.bytes -= entry[2]
+            entry = None
+
+        if entry is not None:
+            self.hits += 1
+            self._items[key] = entry
+            return entry[1]
+
+        self.misses += 1
 
-def encode(message):
+        encoded = prepare(message, codec, binary)
+        size += len(encoded)
+
+        if size <= self.max_bytes:
+            self._items[key] = (message, encoded, size)
+            self.bytes += size
+            self._evict()
+
+        return encoded
+
+    def invalidate(self, key):
+        """Remove message from the cache, for all codecs"""
+        for item in [item for item in self._items if item[0] == key]:
+            self.bytes -= self._items.pop(item)[2]
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def _evict(self):
+        while (len(self._items) > self.max_items
+               or self.bytes > self.max_bytes):
+            _, entry = self._items.popitem(last=False)
+            self.bytes -= entry[2]
+            self.evictions += 1
+
+def encode(message, codec=None, binary=False):
     """Encode message to the socket.io wire format.
 
     1. If message is list, it will encode each separate list item as a message
     2. If message is a unicode or ascii string, it will be encoded as is
     3. If message some arbitrary python object or a dict, it will be JSON
-    encoded
+    encoded or, if `codec` is set, encoded with it. Encoded payload is
+    base64-encoded, unless `binary` is True.
+    4. If message was prepared with `prepare`, it will be returned as is
     """
-    encoded = ''
-    if isinstance(message, list):
-        for msg in message:
-            encoded += encode(msg)
+    if isinstance(message, EncodedMessage):
+        return message
+    elif isinstance(message, list):
+        if len(message) == 1:
+            return encode(message[0], codec, binary)
+        return ''.join([encode(msg, codec, binary) for msg in message])
     elif (not isinstance(message, (unicode, str))
           and isinstance(message, (object, dict))):
-        if message is not None:
-            encoded += encode('~j~' + json.dumps(message, **json_decimal_args))
+        if message is None:
+            return ''
+
+        if codec is None:
+            return encode('~j~' + json.dumps(message, **json_decimal_args))
+
+        data = codec.dumps(message)
+
+        if not binary:
+            data = base64.b64encode(data)
+
+        return "%s%d%s%s%s" % (FRAME, len(data) + 3, FRAME, BINARY, data)
     else:
         msg = message.encode('utf-8')
-        encoded += "%s%d%s%s" % (FRAME, len(msg), FRAME, msg)
+        return "%s%d%s%s" % (FRAME, len(msg), FRAME, msg)
 
-    return encoded
+class LazyJSON(object):
+    """JSON message which is parsed on first access.
 
-def decode(data):
-    """Decode socket.io messages
+    `raw` is JSON text as it was received from the client, `value` is parsed
+    message. Parsed value is cached.
+    """
+    __slots__ = ('raw', '_value', '_parsed')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._value = None
+        self._parsed = False
+
+    @property
+    def value(self):
+        if not self._parsed:
+            self._value = json.loads(self.raw)
+            self._parsed = True
+
+        return self._value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def get(self, key, default=None):
+        return self.value.get(key, default)
 
-    Returns message tuples, first item in a tuple is message type (see
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            return self.raw == other.raw
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'LazyJSON(%r)' % self.raw
+
+class MessageTooBig(ValueError):
+    """Raised by `decode` for messages larger than allowed"""
+
+def iterdecode(data, lazy=False, max_size=None, codec=None, binary=False):
+    """Decode socket.io messages one by one.
+
+    Yields message tuples, first item in a tuple is message type (see
     message declarations in the beginning of the file) and second item
     is decoded message.
-    """
-    messages = []
 
+    If `lazy` is True, JSON messages are returned as `LazyJSON` objects.
+
+    If `codec` is set, `~b~` messages are decoded with it. Their payload is
+    expected to be base64-encoded, unless `binary` is True.
+
+    If `max_size` is set, `MessageTooBig` is raised for the message which
+    is larger than `max_size` bytes, before message is copied or parsed.
+    """
     idx = 0
 
     while data[idx:idx+3] == FRAME:
@@ -68,6 +281,9 @@ def decode(data):
 
         msg_len = int(data[len_start:idx])
 
+        if max_size is not None and msg_len > max_size:
+            raise MessageTooBig('Message of %d bytes is too big' % msg_len)
+
         msg_type = data[idx:idx + 3]
 
         # Skip message type
@@ -76,13 +292,35 @@ def decode(data):
         msg_data = data[idx:idx + msg_len]
 
         if msg_data.startswith(JSON):
-            msg_data = json.loads(msg_data[3:])
+            if lazy:
+                msg_data = LazyJSON(msg_data[3:])
+            else:
+                msg_data = json.loads(msg_data[3:])
         elif msg_data.startswith(HEARTBEAT):
             msg_type = HEARTBEAT
             msg_data = msg_data[3:]
+        elif codec is not None and msg_data.startswith(BINARY):
+            msg_type = BINARY
+            msg_data = msg_data[3:]
+
+            if not binary:
+                try:
+                    msg_data = base64.b64decode(msg_data)
+                except TypeError:
+                    raise ValueError('Invalid base64 payload')
+
+            msg_data = codec.loads(str(msg_data))
+        elif msg_data.startswith(SEQUENCE):
+            msg_type = SEQUENCE
+            msg_data = msg_data[3:]
 
-        messages.append((msg_type, msg_data))
+        yield (msg_type, msg_data)
 
         idx += msg_len
 
-    return messages
+def decode(data, lazy=False, max_size=None, codec=None, binary=False):
+    """Decode socket.io messages
+
+    Returns list of message tuples, see `iterdecode`.
+    """
+    return list(iterdecode(data, lazy, max_size, codec, binary))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.registry
+    ~~~~~~~~~~~~~~~~~
+
+    Registry of live connections indexed by application-defined keys.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+from tornadio import proto, outbound
+
+class Registry(object):
+    """Index of live connections.
+
+    Every router has one registry, available as `router.registry`.
+    Connections register themselves under any hashable keys, like user ID,
+    tenant or device:
+
+        class MyConnection(SocketConnection):
+            def on_open(self, request, *args, **kwargs):
+                self.register(('user', get_user_id(request)))
+
+    and can be found or messaged by these keys later on:
+
+        MyRouter.registry.send_to([('user', 1), ('user', 2)], 'Hello')
+
+    Connections are removed from the registry when they are closed.
+    """
+    def __init__(self, fanout=None):
+        self._index = {}
+        self._keys = {}
+
+        # Number of live connections, registered or not
+        self.connections = 0
+
+        # Fan-out scheduler used by `broadcast`
+        self.fanout = fanout
+
+    def __len__(self):
+        """Number of registered connections"""
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def add(self, conn, *keys):
+        """Register connection under given keys"""
+        conn_keys = self._keys.setdefault(conn, set())
+
+        for key in keys:
+            self._index.setdefault(key, set()).add(conn)
+            conn_keys.add(key)
+
+    def remove(self, conn, *keys):
+        """Remove connection from given keys or, if no keys were passed,
+        from the registry."""
+        conn_keys = self._keys.get(conn)
+
+        if conn_keys is None:
+            return
+
+        if not keys:
+            keys = list(conn_keys)
+
+        for key in keys:
+            conns = self._index.get(key)
+
+            if conns is not None:
+                conns.discard(conn)
+
+                if not conns:
+                    del self._index[key]
+
+            conn_keys.discard(key)
+
+        if not conn_keys:
+            del self._keys[conn]
+
+    def get(self, key):
+        """Return set of connections registered under the key"""
+        return set(self._index.get(key, ()))
+
+    def keys_of(self, conn):
+        """Return set of keys connection is registered under"""
+        return set(self._keys.get(conn, ()))
+
+    def _targets(self, keys):
+        targets = set()
+
+        for key in keys:
+            conns = self._index.get(key)
+
+            if conns:
+                targets.update(conns)
+
+        return targets
+
+    def send_to(self, keys, message, priority=outbound.NORMAL):
+        """Send message to all connections registered under any of the keys.
+
+        Message is encoded once for each payload codec connections use and
+        each connection receives it once, even if it is registered under
+        several of the keys. Returns number of connections message was sent
+        to.
+        """
+        targets = self._targets(keys)
+
+        if not targets:
+            return 0
+
+        message = proto.Prepared(message)
+
+        count = 0
+        for conn in targets:
+            if not conn.is_closed:
+                conn.send(message.get(conn.codec, conn.binary), priority)
+                count += 1
+
+        return count
+
+    def broadcast(self, keys, message, priority=outbound.NORMAL,
+                  callback=None):
+        """Same as `send_to`, but message is delivered by the fan-out
+        scheduler in time-budgeted slices, so sending to many connections
+        does not block the IOLoop. Returns `fanout.Broadcast`, `callback`
+        is called with it once message is delivered.
+        """
+        return self.fanout.send(self._targets(keys), message, priority,
+                                callback)
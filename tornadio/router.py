@@ -8,12 +8,12 @@
     :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
     :license: Apache, see LICENSE for more details.
 """
-import logging
+import logging, functools
 
-from tornado import ioloop
-from tornado.web import RequestHandler, HTTPError
+from tornado.web import ErrorHandler
 
-from tornadio import persistent, polling, session
+from tornadio import persistent, polling, session, admission, scheduler
+from tornadio import registry, periodic, eventloop, snapshot, balance, fanout
 
 PROTOCOLS = {
     'websocket': persistent.TornadioWebSocketHandler,
@@ -22,6 +22,7 @@ PROTOCOLS = {
     'xhr-multipart': polling.TornadioXHRMultipartSocketHandler,
     'htmlfile': polling.TornadioHtmlFileSocketHandler,
     'jsonp-polling': polling.TornadioJSONPSocketHandler,
+    'eventsource': polling.TornadioEventSourceSocketHandler,
     }
 
 DEFAULT_SETTINGS = {
@@ -32,55 +33,252 @@ DEFAULT_SETTINGS = {
     # Heartbeat time in seconds. Do not change this value unless
     # you absolutely sure that new value will work.
     'heartbeat_interval': 12,
+    # Use websocket ping/pong control frames instead of the ~h~ heartbeat
+    # messages for RFC 6455 clients. Only enable if your client-side does
+    # not depend on receiving heartbeat messages.
+    'websocket_native_heartbeats': False,
     # Enabled protocols
     'enabled_protocols': ['websocket', 'flashsocket', 'xhr-multipart',
-                          'xhr-polling', 'jsonp-polling', 'htmlfile'],
+                          'xhr-polling', 'jsonp-polling', 'htmlfile',
+                          'eventsource'],
+    # Keep websocket sessions alive after disconnection, so client can
+    # reconnect and resume session without losing messages.
+    'websocket_resume': False,
+    # How long to wait for the websocket client to reconnect, in seconds
+    'websocket_resume_timeout': 30,
+    # Number of last sent websocket frames kept for resume
+    'websocket_resume_buffer': 64,
     # XHR-Polling request timeout, in seconds
     'xhr_polling_timeout': 20,
+    # Adapt XHR-Polling request timeout to the session traffic and server
+    # load. xhr_polling_timeout is not used if enabled.
+    'xhr_polling_adaptive': False,
+    # Minimum and maximum adaptive XHR-Polling request timeout, in seconds
+    'xhr_polling_min_timeout': 5,
+    'xhr_polling_max_timeout': 30,
+    # IOLoop lag, in seconds, after which adaptive XHR-Polling request
+    # timeout is reduced
+    'xhr_polling_overload_lag': 0.1,
+    # Resolution of the shared timer scheduler, in seconds
+    'scheduler_resolution': 0.5,
+    # Number of last sent EventSource events kept for Last-Event-ID resume
+    'eventsource_history': 32,
+    # Websocket write buffer high watermark, in bytes. When more than this
+    # amount of data is waiting to be sent to the client, connection is
+    # considered congested. None (default) disables the check.
+    'write_buffer_high_watermark': None,
+    # Websocket write buffer low watermark, in bytes. Congested connection
+    # is considered drained once buffered data drops below this value.
+    'write_buffer_low_watermark': 1024 * 1024,
+    # What to do with outgoing messages while connection is congested:
+    # None - send them as usual, only notify the connection, 'drop' -
+    # discard them, 'conflate' - keep only the most recent one and send it
+    # once drained, 'close' - close the connection.
+    'write_buffer_policy': None,
+    # How often to check if congested connection was drained, in seconds
+    'write_buffer_check_interval': 0.1,
+    # Outgoing message priorities: 'strict' - higher priority messages are
+    # sent first and bulk messages are paced, 'fifo' - messages are sent in
+    # order they were queued, priority is ignored.
+    'priority_drain': 'strict',
+    # Maximum amount of bulk priority data, in bytes, sent in one polling
+    # response or kept in the websocket write buffer. Rest of the bulk
+    # messages wait until it is sent. None disables pacing.
+    'bulk_write_size': 64 * 1024,
+    # Maximum rate of new sessions, per second. None disables admission
+    # control.
+    'handshake_rate': None,
+    # Number of new sessions admitted right away before rate limit kicks in.
+    # Defaults to handshake_rate.
+    'handshake_burst': None,
+    # Number of new sessions waiting for admission. If queue is full, new
+    # sessions are rejected with 503 response.
+    'handshake_queue': 1000,
+    # Retry-After value for rejected sessions, in seconds
+    'handshake_retry_after': 5,
+    # Maximum time new session can wait in the admission queue, in seconds.
+    # Sessions which waited longer are rejected with 503 response.
+    'handshake_queue_timeout': 10,
+    # Node is overloaded when it has more live connections, IOLoop lag (in
+    # seconds) or resident memory (in bytes) than these limits. New sessions
+    # of the overloaded node are asked to retry, with URL of less loaded
+    # peer if there is one. None disables the check.
+    'load_max_connections': None,
+    'load_max_lag': None,
+    'load_max_memory': None,
+    # Base URLs of the peer nodes, like 'http://10.0.0.2:8001'. Their load
+    # reports are fetched from `load_report_path`.
+    'load_peers': [],
+    'load_report_path': '/socket.io-load',
+    # How often to check node and peers load, in seconds
+    'load_check_interval': 5,
+    # Overloaded node takes new sessions again once its load drops below
+    # this value
+    'load_recover': 0.9,
+    # Broadcasts sent with `registry.broadcast` are delivered in slices of
+    # at most this many seconds per IOLoop iteration
+    'fanout_budget': 0.01,
+    # Number of connections concurrent broadcasts send to in turn
+    'fanout_chunk_size': 100,
+    # Maximum size of one incoming socket.io message, in bytes. None
+    # disables the check.
+    'max_message_size': None,
+    # Maximum size of the POST request body or websocket message, in
+    # bytes. None disables the check.
+    'max_request_size': None,
+    # Payload codecs clients can ask for with the `codec` handshake
+    # argument, for example ['msgpack']. Non-string messages are sent
+    # encoded with the codec instead of JSON.
+    'payload_codecs': [],
     }
 
 
-class SocketRouterBase(RequestHandler):
-    """Main request handler.
+class SocketRouterBase(object):
+    """Main request dispatcher.
 
-    Manages creation of appropriate transport protocol implementations and
-    passing control to them.
+    Tornado application constructs it for every matched socket.io request.
+    It is not a RequestHandler - it only resolves transport protocol
+    implementation from the URL and passes control to it, so transport
+    handler is the only RequestHandler created for the request.
     """
     _connection = None
     _route = None
+    _protocols = None
     _sessions = None
     _sessions_cleanup = None
+    _admission = None
+    _scheduler = None
     settings = None
+    registry = None
+    fanout = None
+    load_monitor = None
+    loop = None
+    clock = None
+
+    def __init__(self, application, request, **kwargs):
+        self.application = application
+        self.request = request
 
     def _execute(self, transforms, *args, **kwargs):
         try:
             extra = kwargs['extra']
             proto_name = kwargs['protocol']
-            proto_init = kwargs['protocol_init']
             session_id = kwargs['session_id']
 
-            logging.debug('Incoming session %s(%s) Session ID: %s Extra: %s' % (
-                proto_name,
-                proto_init,
-                session_id,
-                extra
-                ))
-
-            # If protocol is disabled, raise HTTPError
-            if proto_name not in self.settings['enabled_protocols']:
-                raise HTTPError(403, 'Forbidden')
-
-            protocol = PROTOCOLS.get(proto_name, None)
-
-            if protocol:
-                handler = protocol(self, session_id)
-                handler._execute(transforms, *extra, **kwargs)
-            else:
-                raise Exception('Handler for protocol "%s" is not available' %
-                                proto_name)
+            logging.debug('Incoming session %s(%s) Session ID: %s Extra: %s',
+                          proto_name,
+                          kwargs['protocol_init'],
+                          session_id,
+                          extra)
+
+            # Only enabled protocols are available
+            protocol = self._protocols.get(proto_name, None)
+
+            if protocol is None:
+                self._send_error(transforms, 403)
+                return
+
+            # Reject oversized uploads before looking at them. Tornado
+            # HTTPServer reads the whole body first, up to IOStream buffer
+            # size.
+            max_size = self.settings['max_request_size']
+            if max_size is not None and len(self.request.body) > max_size:
+                self._send_too_large()
+                return
+
+            if not self._is_resume(protocol, session_id):
+                # Send new sessions elsewhere, existing ones stay
+                if self.load_monitor.check():
+                    self._send_overloaded(self.load_monitor.pick_peer())
+                    return
+
+                # Throttle new sessions
+                if self._admission is not None:
+                    if not self._admission.admit(
+                        functools.partial(self._dispatch, transforms, protocol,
+                                          session_id, extra, kwargs),
+                        self._send_retry):
+                        self._send_retry()
+                    return
+
+            self._dispatch(transforms, protocol, session_id, extra, kwargs)
         except ValueError:
             # TODO: Debugging
-            raise HTTPError(403, 'Forbidden')
+            self._send_error(transforms, 403)
+
+    def _dispatch(self, transforms, protocol, session_id, extra, kwargs):
+        """Pass request to the transport handler"""
+        # Client might have gone while handshake was waiting for admission
+        if self.request.connection.stream.closed():
+            return
+
+        handler = protocol(self, session_id)
+        handler._execute(transforms, *extra, **kwargs)
+
+    def _is_resume(self, protocol, session_id):
+        """Check if request belongs to existing session which transport
+        will pick up"""
+        if not session_id:
+            # EventSource reconnects to the original URL with Last-Event-ID
+            last_event_id = self.request.headers.get('Last-Event-ID', '')
+            session_id = last_event_id.partition(':')[0]
+
+            if not session_id:
+                return False
+
+        # Websockets ignore session ID unless sessions are resumable
+        if (issubclass(protocol, persistent.TornadioWebSocketHandler)
+            and not self.settings['websocket_resume']):
+            return False
+
+        return self._sessions.get(session_id) is not None
+
+    def _send_retry(self):
+        """Cheap reply for handshakes which were not admitted"""
+        if self.request.connection.stream.closed():
+            return
+
+        self.request.write('HTTP/1.1 503 Service Unavailable\r\n'
+                           'Retry-After: %d\r\n'
+                           'Content-Length: 0\r\n\r\n' %
+                           self.settings['handshake_retry_after'])
+        self.request.finish()
+
+    def _send_overloaded(self, peer):
+        """Cheap reply for handshakes of the overloaded node. Asks client
+        to retry and, if there is less loaded `peer`, passes its URL in the
+        `X-Socket-IO-Peer` header and in the response body.
+
+        Client is not redirected, as socket.io client would send the rest
+        of the session requests to the original host.
+        """
+        if peer is None:
+            self._send_retry()
+            return
+
+        if self.request.connection.stream.closed():
+            return
+
+        self.request.write('HTTP/1.1 503 Service Unavailable\r\n'
+                           'Retry-After: %d\r\n'
+                           'X-Socket-IO-Peer: %s\r\n'
+                           'Content-Type: text/plain\r\n'
+                           'Content-Length: %d\r\n\r\n%s' %
+                           (self.settings['handshake_retry_after'],
+                            peer, len(peer), peer))
+        self.request.finish()
+
+    def _send_too_large(self):
+        """Cheap reply for oversized requests"""
+        self.request.write('HTTP/1.1 413 Request Entity Too Large\r\n'
+                           'Content-Length: 0\r\n\r\n')
+        self.request.finish()
+
+    def _send_error(self, transforms, status_code):
+        """Reply with HTTP error without constructing transport handler"""
+        handler = ErrorHandler(self.application, self.request,
+                               status_code=status_code)
+        handler._execute(transforms)
 
     @property
     def connection(self):
@@ -91,11 +289,43 @@ class SocketRouterBase(RequestHandler):
     def sessions(self):
         return self._sessions
 
+    @property
+    def scheduler(self):
+        return self._scheduler
+
     @classmethod
     def route(cls):
         """Returns prepared Tornado routes"""
         return cls._route
 
+    @classmethod
+    def load_route(cls):
+        """Returns Tornado route which serves load report of the node, so
+        peers can fetch it"""
+        return (cls.settings['load_report_path'],
+                balance.LoadReportHandler,
+                dict(monitor=cls.load_monitor))
+
+    @classmethod
+    def save_sessions(cls, target):
+        """Move live polling sessions out of this process.
+
+        Sessions are written to `target` (file name or file-like object,
+        like `socket.makefile()`), then their requests are finished and
+        connections are closed without calling `on_close`. Returns number
+        of saved sessions.
+        """
+        return snapshot.save(cls(None, None), target)
+
+    @classmethod
+    def load_sessions(cls, source):
+        """Restore polling sessions saved by `save_sessions`, so clients
+        can continue using them. Returns number of restored sessions.
+
+        Snapshot is unpickled, so `source` must be trusted.
+        """
+        return snapshot.load(cls(None, None), source)
+
     @classmethod
     def tornadio_initialize(cls, connection, user_settings, resource,
                             io_loop=None, extra_re=None, extra_sep=None):
@@ -109,8 +339,9 @@ class SocketRouterBase(RequestHandler):
         # Associate connection object
         cls._connection = connection
 
-        # Initialize io_loop
-        cls.io_loop = io_loop or ioloop.IOLoop.instance()
+        # Initialize io_loop and clock used by the internals
+        cls.io_loop = cls.loop = eventloop.get_loop(io_loop)
+        cls.clock = eventloop.get_clock(cls.loop)
 
         # Associate settings
         settings = DEFAULT_SETTINGS.copy()
@@ -120,13 +351,54 @@ class SocketRouterBase(RequestHandler):
 
         cls.settings = settings
 
+        # Resolve enabled protocol implementations
+        cls._protocols = dict((name, PROTOCOLS[name])
+                              for name in settings['enabled_protocols']
+                              if name in PROTOCOLS)
+
         # Initialize sessions
-        cls._sessions = session.SessionContainer()
+        cls._sessions = session.SessionContainer(cls.clock)
 
         check_interval = settings['session_check_interval'] * 1000
-        cls._sessions_cleanup = ioloop.PeriodicCallback(cls._sessions.expire,
-                                                        check_interval,
-                                                        cls.io_loop).start()
+        cls._sessions_cleanup = periodic.Callback(cls._sessions.expire,
+                                                  check_interval,
+                                                  cls.loop)
+        cls._sessions_cleanup.start()
+
+        # Initialize broadcast fan-out and connection registry
+        cls.fanout = fanout.FanOut(cls.loop,
+                                   settings['fanout_budget'],
+                                   settings['fanout_chunk_size'])
+        cls.registry = registry.Registry(cls.fanout)
+
+        # Initialize shared timer scheduler
+        cls._scheduler = scheduler.Scheduler(cls.loop,
+                                             settings['scheduler_resolution'])
+
+        # Initialize admission control
+        if settings['handshake_rate']:
+            cls._admission = admission.AdmissionControl(
+                cls.loop,
+                settings['handshake_rate'],
+                settings['handshake_burst'],
+                settings['handshake_queue'],
+                settings['handshake_queue_timeout'])
+
+        # Initialize load monitor
+        cls.load_monitor = balance.LoadMonitor(
+            cls.io_loop,
+            cls.registry,
+            cls._scheduler,
+            settings['load_max_connections'],
+            settings['load_max_lag'],
+            settings['load_max_memory'],
+            settings['load_peers'],
+            settings['load_check_interval'],
+            settings['load_report_path'],
+            settings['load_recover'])
+
+        if cls.load_monitor.enabled:
+            cls.load_monitor.start()
 
         # Copied from SocketTornad.IO with minor formatting
         if extra_re:
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.scheduler
+    ~~~~~~~~~~~~~~~~~~
+
+    Coarse-grained timer scheduler shared by many connections.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import math
+import logging
+
+from tornadio import eventloop
+
+class Timer(object):
+    """Scheduled callback. Returned by `Scheduler.add`"""
+    __slots__ = ('deadline', 'callback', 'bucket')
+
+    def __init__(self, deadline, callback, bucket):
+        self.deadline = deadline
+        self.callback = callback
+        self.bucket = bucket
+
+class Scheduler(object):
+    """Runs many timers from one IOLoop timeout.
+
+    Timers are grouped into buckets of `resolution` seconds, so adding and
+    removing timer is O(1) and there is only one IOLoop timeout no matter
+    how many timers are scheduled. Deadlines are rounded up to the bucket
+    boundary and ticks are aligned to boundaries, so timers never fire
+    early and fire up to `resolution` seconds (plus IOLoop lag) late.
+
+    Scheduler also measures how late its ticks are (`lag`), which is a good
+    indication of the IOLoop load.
+    """
+    def __init__(self, io_loop, resolution=0.5):
+        self.io_loop = eventloop.get_loop(io_loop)
+        self.clock = eventloop.get_clock(self.io_loop)
+        self.resolution = resolution
+
+        self._buckets = {}
+        self._count = 0
+        self._last_bucket = None
+        self._next_tick = None
+        self._timeout = None
+
+        # Smoothed tick lag, in seconds
+        self.lag = 0.0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, deadline, callback):
+        """Schedule `callback` to run at `deadline`"""
+        if self._timeout is None:
+            self._last_bucket = int(self.clock() / self.resolution) - 1
+            self._schedule()
+
+        # Bucket N runs at N * resolution, so round up. Buckets which were
+        # already processed won't be looked at again.
+        bucket = max(int(math.ceil(deadline / self.resolution)),
+                     self._last_bucket + 1)
+
+        timer = Timer(deadline, callback, bucket)
+        self._buckets.setdefault(bucket, set()).add(timer)
+        self._count += 1
+
+        return timer
+
+    def remove(self, timer):
+        """Cancel scheduled timer"""
+        timers = self._buckets.get(timer.bucket)
+
+        if timers is not None and timer in timers:
+            timers.remove(timer)
+            self._count -= 1
+
+            if not timers:
+                del self._buckets[timer.bucket]
+
+    def _schedule(self):
+        # Tick at the start of the next bucket
+        self._next_tick = ((int(self.clock() / self.resolution) + 1)
+                           * self.resolution)
+        self._timeout = self.io_loop.add_timeout(self._next_tick, self._tick)
+
+    def _tick(self):
+        self._timeout = None
+
+        now = self.clock()
+        self.lag = self.lag * 0.8 + max(0.0, now - self._next_tick) * 0.2
+
+        current = int(now / self.resolution)
+
+        for bucket in xrange(self._last_bucket + 1, current + 1):
+            timers = self._buckets.pop(bucket, None)
+
+            if not timers:
+                continue
+
+            self._count -= len(timers)
+
+            for timer in timers:
+                try:
+                    timer.callback()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    logging.error('Error in scheduled callback', exc_info=True)
+
+        self._last_bucket = current
+
+        if self._count:
+            self._schedule()
+        else:
+            self.lag = 0.0
@@ -39,6 +39,11 @@ class SocketServer(HTTPServer):
 
         flash_policy_file = settings.get('flash_policy_file', None)
         flash_policy_port = settings.get('flash_policy_port', None)
+        flash_policy_max_connections = settings.get(
+            'flash_policy_max_connections', 1024)
+        flash_policy_timeout = settings.get('flash_policy_timeout', 5)
+        flash_policy_reuse_port = settings.get('flash_policy_reuse_port',
+                                               False)
         socket_io_port = settings.get('socket_io_port', 8001)
         socket_io_address = settings.get('socket_io_address', '')
 
@@ -64,7 +69,10 @@ class SocketServer(HTTPServer):
                 FlashPolicyServer(
                     io_loop = io_loop,
                     port=flash_policy_port,
-                    policy_file=flash_policy_file)
+                    policy_file=flash_policy_file,
+                    max_connections=flash_policy_max_connections,
+                    read_timeout=flash_policy_timeout,
+                    reuse_port=flash_policy_reuse_port)
             except Exception, ex:
                 logging.error('Failed to start Flash policy server: %s', ex)
 
@@ -20,20 +20,21 @@ class Session(object):
     Derive from this object to store additional data.
     """
 
-    def __init__(self, session_id, expiry=None):
+    def __init__(self, session_id, expiry=None, clock=None):
         self.session_id = session_id
         self.promoted = None
         self.expiry = expiry
+        self._clock = clock or time
 
         if self.expiry is not None:
-            self.expiry_date = time() + self.expiry
+            self.expiry_date = self._clock() + self.expiry
 
     def promote(self):
         """Mark object is living, so it won't be collected during next
         run of the session garbage collector.
         """
         if self.expiry is not None:
-            self.promoted = time() + self.expiry
+            self.promoted = self._clock() + self.expiry
 
     def on_delete(self, forced):
         """Triggered when object was expired or deleted."""
@@ -54,13 +55,31 @@ def _random_key():
     return i.hexdigest()
 
 class SessionContainer(object):
-    def __init__(self):
+    def __init__(self, clock=None):
+        """Default constructor.
+
+        `clock`
+            Function which returns current time. Sessions should use the
+            same clock. Defaults to `time.time`.
+        """
         self._items = dict()
         self._queue = []
+        self._clock = clock or time
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        """Iterate over session objects"""
+        return self._items.itervalues()
 
     def create(self, session, expiry=None, **kwargs):
-        """Create new session object."""
-        kwargs['session_id'] = _random_key()
+        """Create new session object.
+
+        Random session ID is generated, unless `session_id` was passed.
+        """
+        if kwargs.get('session_id') is None:
+            kwargs['session_id'] = _random_key()
         kwargs['expiry'] = expiry
 
         session = session(**kwargs)
@@ -93,7 +112,7 @@ class SessionContainer(object):
             return
 
         if current_time is None:
-            current_time = time()
+            current_time = self._clock()
 
         while self._queue:
             # Top most item is not expired yet
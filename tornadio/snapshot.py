@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.snapshot
+    ~~~~~~~~~~~~~~~~~
+
+    Saving and restoring polling sessions, so they survive server restart.
+
+    Snapshots are pickled: they keep session classes and arbitrary
+    application state from `hibernate_attrs`, which JSON can't represent.
+    Loading pickle runs code, so only load snapshots written by your own
+    processes and keep them where nobody else can write. Snapshots also
+    contain live session IDs, so files are created readable by the owner
+    only.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import os, logging
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from tornadio import pollingsession, codec
+
+# Snapshot format version
+VERSION = 1
+
+def save(router, target):
+    """Suspend live polling sessions of the router and write them to
+    `target`, file name or file-like object. File is created with 0600
+    permissions.
+
+    Returns number of saved sessions.
+    """
+    now = router.clock()
+
+    sessions = [s for s in list(router.sessions)
+                if isinstance(s, pollingsession.PollingSession)
+                and not s.is_closed]
+
+    data = pickle.dumps(dict(version=VERSION,
+                             time=now,
+                             sessions=[s.dump(now) for s in sessions]),
+                        pickle.HIGHEST_PROTOCOL)
+
+    if isinstance(target, basestring):
+        # Write to temporary file first, so other process never sees
+        # partially written snapshot
+        tmp_name = target + '.tmp'
+
+        f = os.fdopen(os.open(tmp_name,
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600),
+                      'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        os.rename(tmp_name, target)
+    else:
+        target.write(data)
+
+    # Sessions are served by another process from now on
+    for s in sessions:
+        s.suspend()
+
+    return len(sessions)
+
+def load(router, source):
+    """Restore polling sessions from `source`, file name or file-like
+    object, written by `save`.
+
+    `source` is unpickled, so it must come from a trusted process - never
+    pass data which could have been written or altered by anyone else.
+
+    Sessions which would have expired by now or which already exist are
+    skipped. Returns number of restored sessions.
+    """
+    if isinstance(source, basestring):
+        if not os.path.exists(source):
+            return 0
+
+        f = open(source, 'rb')
+        try:
+            data = pickle.load(f)
+        finally:
+            f.close()
+    else:
+        data = pickle.load(source)
+
+    if data.get('version') != VERSION:
+        logging.warning('Unsupported session snapshot version %r',
+                        data.get('version'))
+        return 0
+
+    elapsed = max(0, router.clock() - data['time'])
+
+    count = 0
+    for state in data['sessions']:
+        if state['ttl'] <= elapsed:
+            continue
+
+        if router.sessions.get(state['session_id']) is not None:
+            continue
+
+        router.sessions.create(state['cls'],
+                               state['expiry'],
+                               session_id=state['session_id'],
+                               router=router,
+                               args=(),
+                               kwargs={},
+                               state=state,
+                               codec=codec.CODECS.get(state['codec']))
+        count += 1
+
+    return count
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.statesync
+    ~~~~~~~~~~~~~~~~~~
+
+    JSON state synchronization with versioned patches.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+def _escape(key):
+    """Escape key for JSON pointer"""
+    return unicode(key).replace(u'~', u'~0').replace(u'/', u'~1')
+
+def _unescape(token):
+    return token.replace(u'~1', u'/').replace(u'~0', u'~')
+
+def _key(key):
+    """Convert dictionary key the way JSON encoder does"""
+    if isinstance(key, basestring):
+        return key
+
+    return json.dumps(key).strip('"')
+
+def _copy(value):
+    """Copy JSON-compatible value. Containers are copied, tuples become
+    lists and dictionary keys are converted the way JSON encoder does."""
+    if isinstance(value, dict):
+        return dict((_key(key), _copy(item))
+                    for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return [_copy(item) for item in value]
+
+    return value
+
+def _equal(old, new):
+    """Check if scalar values are the same for JSON"""
+    if old != new:
+        return False
+
+    # 1 == 1.0 == True, but they are different JSON values
+    return (type(old) == type(new)
+            or (isinstance(old, basestring) and isinstance(new, basestring)))
+
+def _sync(old, new, path, ops):
+    """Append operations which transform `old` into `new` to `ops` and return
+    copy of `new`. Parts which did not change are shared with `old`, so they
+    are neither copied nor walked."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        if old == new:
+            return old
+
+        items = [(_key(key), value) for key, value in new.iteritems()]
+        keys = set(key for key, _ in items)
+
+        for key in old:
+            if key not in keys:
+                ops.append({'op': 'remove', 'path': path + u'/' + _escape(key)})
+
+        result = {}
+        for key, value in items:
+            item_path = path + u'/' + _escape(key)
+
+            if key in old:
+                result[key] = _sync(old[key], value, item_path, ops)
+            else:
+                result[key] = _copy(value)
+                ops.append({'op': 'add', 'path': item_path,
+                            'value': result[key]})
+
+        return result
+    elif (isinstance(old, list) and isinstance(new, (list, tuple))
+          and len(old) == len(new)):
+        if old == new:
+            return old
+
+        return [_sync(old_value, new_value, u'%s/%d' % (path, idx), ops)
+                for idx, (old_value, new_value) in enumerate(zip(old, new))]
+    elif _equal(old, new):
+        return old
+
+    value = _copy(new)
+    ops.append({'op': 'replace', 'path': path, 'value': value})
+    return value
+
+def diff(old, new, path=u''):
+    """Return list of JSON patch (RFC 6902) operations which transform `old`
+    into `new`.
+
+    Dictionaries are compared key by key, lists of the same length item by
+    item. Everything else is replaced as a whole.
+    """
+    ops = []
+    _sync(old, new, path, ops)
+    return ops
+
+def apply_patch(data, patch):
+    """Apply JSON patch created by `diff` to `data`. Returns patched data,
+    `data` is modified in place unless root is replaced."""
+    for op in patch:
+        path = op['path']
+
+        if not path:
+            data = op['value']
+            continue
+
+        tokens = [_unescape(token) for token in path.split(u'/')[1:]]
+
+        target = data
+        for token in tokens[:-1]:
+            if isinstance(target, list):
+                token = int(token)
+            target = target[token]
+
+        key = tokens[-1]
+        if isinstance(target, list):
+            key = int(key)
+
+        if op['op'] == 'remove':
+            del target[key]
+        else:
+            target[key] = op['value']
+
+    return data
+
+class StateSync(object):
+    """Keeps last sent version of the JSON state and creates messages with
+    patches against it.
+
+    Can be used per connection:
+
+        class MyConnection(SocketConnection):
+            def on_open(self, *args, **kwargs):
+                self.state = StateSync('doc')
+
+            def document_changed(self, doc):
+                msg = self.state.update(doc)
+                if msg is not None:
+                    self.send(msg)
+
+    or shared between many connections (for example, per room), with the
+    message encoded once:
+
+        msg = room.state.update(doc)
+        if msg is not None:
+            msg = proto.prepare(msg)
+            for conn in room.connections:
+                conn.send(msg)
+
+    Messages look like `{"state": name, "version": 2, "patch": [...]}` or
+    `{"state": name, "version": 2, "snapshot": {...}}`. Client applies patch
+    only if it has previous version, otherwise it should ask for the resync
+    and server should reply with `snapshot()`.
+    """
+    def __init__(self, name, data=None):
+        self.name = name
+        self.version = 0
+        self.data = None
+
+        # Encoded size of the state, when it was last measured
+        self._size = 0
+
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        """Update state and return message to send or None, if nothing
+        changed. If patch is not smaller than full snapshot, snapshot message
+        is returned instead.
+
+        State is only encoded to measure the snapshot if patch is at least
+        half as large as the state was when it was measured last time.
+        """
+        if not self.version:
+            # Keep own copy of the state, so changes to `data` are detected
+            self.data = _copy(data)
+        else:
+            patch = []
+            new_data = _sync(self.data, data, u'', patch)
+
+            if not patch:
+                return None
+
+            self.data = new_data
+
+        self.version += 1
+
+        if self.version > 1:
+            size = len(json.dumps(patch))
+
+            if size * 2 >= self._size:
+                self._size = len(json.dumps(self.data))
+
+            if size < self._size:
+                return {'state': self.name,
+                        'version': self.version,
+                        'patch': patch}
+        else:
+            self._size = len(json.dumps(self.data))
+
+        return self.snapshot()
+
+    def snapshot(self):
+        """Return message with the full state, for new subscribers or
+        client resync."""
+        return {'state': self.name,
+                'version': self.version,
+                'snapshot': self.data}
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+    tornadio.testing
+    ~~~~~~~~~~~~~~~~
+
+    Simulated event loop with virtual time and simple blocking clients for
+    tests and benchmarks.
+
+    :copyright: (c) 2011 by the Serge S. Koval, see AUTHORS for more details.
+    :license: Apache, see LICENSE for more details.
+"""
+import os
+import socket
+import struct
+import urllib
+import urllib2
+
+from base64 import b64encode
+from heapq import heappush, heappop
+from urlparse import urlparse
+
+from tornadio import proto, hybi
+
+class Timeout(object):
+    """Scheduled callback of the `SimulatedLoop`"""
+    __slots__ = ('deadline', 'number', 'callback')
+
+    def __init__(self, deadline, number, callback):
+        self.deadline = deadline
+        self.number = number
+        self.callback = callback
+
+    def __cmp__(self, other):
+        return cmp((self.deadline, self.number),
+                   (other.deadline, other.number))
+
+class SimulatedLoop(object):
+    """Event loop which runs in virtual time. Implements timer methods of
+    the Tornado IOLoop used by tornadio.
+
+    Nothing runs until `advance` or `run_until` is called. Time jumps from
+    one timeout to the next instantly and timeouts with the same deadline
+    run in order they were added, so results are deterministic. Exceptions
+    raised by callbacks are not caught.
+
+    Pass it as `io_loop` to `get_router` or directly to connections,
+    sessions and scheduler:
+
+        loop = SimulatedLoop()
+        sessions = SessionContainer(loop.time)
+
+        # Ten minutes in the simulated world
+        loop.advance(600)
+    """
+    def __init__(self, start=1000000000.0):
+        self.now = start
+
+        self._timeouts = []
+        self._callbacks = []
+        self._count = 0
+
+        # Statistics
+        self.calls = 0
+
+    def __len__(self):
+        """Number of pending timeouts, including cancelled ones"""
+        return len(self._timeouts)
+
+    def time(self):
+        return self.now
+
+    def add_timeout(self, deadline, callback):
+        self._count += 1
+
+        timeout = Timeout(deadline, self._count, callback)
+        heappush(self._timeouts, timeout)
+
+        return timeout
+
+    def remove_timeout(self, handle):
+        handle.callback = None
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def run_callbacks(self):
+        """Run callbacks added with `add_callback`, including ones added
+        while running them"""
+        while self._callbacks:
+            callbacks = self._callbacks
+            self._callbacks = []
+
+            for callback in callbacks:
+                self.calls += 1
+                callback()
+
+    def run_until(self, deadline):
+        """Run everything which is due up to `deadline` and set current time
+        to it"""
+        self.run_callbacks()
+
+        timeouts = self._timeouts
+
+        while timeouts and timeouts[0].deadline <= deadline:
+            timeout = heappop(timeouts)
+
+            if timeout.callback is None:
+                continue
+
+            self.now = max(self.now, timeout.deadline)
+
+            self.calls += 1
+            timeout.callback()
+
+            self.run_callbacks()
+
+        self.now = max(self.now, deadline)
+
+    def advance(self, seconds):
+        """Advance virtual time by `seconds`"""
+        self.run_until(self.now + seconds)
+
+class Client(object):
+    """Base class of the blocking socket.io clients.
+
+    `codec` is `codec.Codec` instance to ask server for. Non-string
+    messages are exchanged encoded with it instead of JSON, if server
+    accepted it.
+    """
+    def __init__(self, codec=None):
+        self.codec = codec
+        self.binary = False
+        self.session_id = None
+
+        # Received data messages, which were not returned yet
+        self._received = []
+
+    def _query(self):
+        if self.codec is None:
+            return ''
+
+        return '?' + urllib.urlencode({'codec': self.codec.name})
+
+    def _handle(self, data, binary=False):
+        """Decode incoming data. Keeps data messages and replies to the
+        heartbeats."""
+        for msg_type, msg_data in proto.iterdecode(data, False, None,
+                                                   self.codec, binary):
+            if msg_type == proto.HEARTBEAT:
+                self.send(proto.HEARTBEAT + msg_data)
+            elif msg_type != proto.SEQUENCE:
+                self._received.append(msg_data)
+
+    def _connect(self):
+        """Wait for the first message, which is session ID"""
+        while not self._received:
+            self._read()
+
+        self.session_id = self._received.pop(0)
+
+    def receive(self):
+        """Wait for the messages from the server and return list of them"""
+        while not self._received:
+            self._read()
+
+        received = self._received
+        self._received = []
+        return received
+
+    def _read(self):
+        raise NotImplementedError()
+
+    def send(self, message):
+        """Send message or list of messages to the server"""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class PollingClient(Client):
+    """XHR polling client. Client can't tell if server accepted the codec, so
+    only ask for codecs server has enabled.
+
+        client = PollingClient('http://localhost:8001/socket.io')
+        client.send({'event': 'hello'})
+        print client.receive()
+    """
+    def __init__(self, url, codec=None, timeout=30):
+        super(PollingClient, self).__init__(codec)
+
+        self.url = url.rstrip('/') + '/xhr-polling/'
+        self.timeout = timeout
+
+        self._handle(urllib2.urlopen(self.url + self._query(),
+                                     timeout=self.timeout).read())
+        self._connect()
+
+    def _read(self):
+        self._handle(urllib2.urlopen(self.url + self.session_id,
+                                     timeout=self.timeout).read())
+
+    def send(self, message):
+        data = urllib.urlencode({'data': proto.encode(message, self.codec)})
+        urllib2.urlopen(self.url + self.session_id, data,
+                        timeout=self.timeout).read()
+
+class WebSocketClient(Client):
+    """RFC 6455 websocket client. If server accepted the codec, messages
+    are exchanged in binary frames and encoded payloads are not
+    base64-encoded.
+
+        client = WebSocketClient('ws://localhost:8001/socket.io')
+        client.send({'event': 'hello'})
+        print client.receive()
+    """
+    def __init__(self, url, codec=None, timeout=30):
+        super(WebSocketClient, self).__init__(codec)
+
+        parts = urlparse(url)
+
+        self.sock = socket.create_connection((parts.hostname,
+                                              parts.port or 80), timeout)
+
+        path = parts.path.rstrip('/') + '/websocket' + self._query()
+        self.sock.sendall('GET %s HTTP/1.1\r\n'
+                          'Host: %s\r\n'
+                          'Upgrade: websocket\r\n'
+                          'Connection: Upgrade\r\n'
+                          'Sec-WebSocket-Key: %s\r\n'
+                          'Sec-WebSocket-Version: 13\r\n\r\n' %
+                          (path, parts.netloc, b64encode(os.urandom(16))))
+
+        response = ''
+        while not response.endswith('\r\n\r\n'):
+            response += self._recv(1)
+
+        if not response.startswith('HTTP/1.1 101'):
+            raise IOError('Websocket handshake failed: %s' %
+                          response.split('\r\n')[0])
+
+        self._connect()
+
+        # Server sends binary frames only if it accepted the codec
+        if not self.binary:
+            self.codec = None
+
+    def _recv(self, size):
+        data = []
+
+        while size:
+            chunk = self.sock.recv(size)
+
+            if not chunk:
+                raise IOError('Connection closed')
+
+            data.append(chunk)
+            size -= len(chunk)
+
+        return ''.join(data)
+
+    def _read(self):
+        header, length = struct.unpack('!BB', self._recv(2))
+        opcode = header & 0x0f
+
+        if length == 126:
+            length = struct.unpack('!H', self._recv(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._recv(8))[0]
+
+        data = self._recv(length)
+
+        if opcode == hybi.OP_CLOSE:
+            raise IOError('Connection closed')
+        elif opcode == hybi.OP_PING:
+            self.sock.sendall(hybi.frame(hybi.OP_PONG, data, os.urandom(4)))
+        elif opcode == hybi.OP_TEXT:
+            self._handle(data.decode('utf-8'))
+        elif opcode == hybi.OP_BINARY:
+            self.binary = True
+            self._handle(data, True)
+
+    def send(self, message):
+        data = proto.encode(message, self.codec, self.binary)
+        opcode = hybi.OP_BINARY if self.binary else hybi.OP_TEXT
+
+        self.sock.sendall(hybi.frame(opcode, data, os.urandom(4)))
+
+    def close(self):
+        self.sock.close()